@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Deterministic radiotap + 802.11 frame mixes for the benchmarks.
+
+The frames are built with dpkt's own header classes: beacons with a
+realistic IE set from a fixed population of APs, probe requests from
+stations using random MACs, QoS data to and from the APs and control
+frames (ACK, RTS, CTS). The same seed always gives the same frames.
+
+    python bench/corpus.py [-n count] [-s seed] -w corpus.pcap
+"""
+
+import getopt
+import os
+import random
+import struct
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dpkt import ieee80211, pcap
+from dpkt.ieee80211 import IEEE80211
+
+# frame kind -> share of the mix
+DEFAULT_MIX = (
+    ('beacon', 0.40),
+    ('probe_req', 0.10),
+    ('qos_data', 0.38),
+    ('ctl', 0.12),
+)
+
+BROADCAST = b'\xff' * 6
+
+# radiotap: TSFT, flags, rate, channel, antenna signal, all naturally aligned
+_RADIOTAP = struct.Struct('<BBHIQBBHHbx')
+_RADIOTAP_PRESENT = 0x2f
+_CHANNELS = (2412, 2437, 2462, 5180, 5240, 5745)
+
+
+def radiotap(tsft, freq, signal, rate=0x0c):
+    flags = 0x00a0 if freq < 5000 else 0x0140
+    return _RADIOTAP.pack(0, 0, _RADIOTAP.size, _RADIOTAP_PRESENT, tsft, 0, rate, freq, flags, signal)
+
+
+def _frag_seq(seq):
+    # frag_seq is decoded big endian from the little endian wire field
+    le = (seq & 0xfff) << 4
+    return ((le & 0xff) << 8) | (le >> 8)
+
+
+def _ie(id, body):
+    return bytes(IEEE80211.IE(id=id, len=len(body), data=body))
+
+
+def _hdr(type, subtype, to_ds=0, from_ds=0):
+    hdr = IEEE80211()
+    hdr.type = type
+    hdr.subtype = subtype
+    hdr.to_ds = to_ds
+    hdr.from_ds = from_ds
+    return bytes(hdr)
+
+
+class _AP(object):
+    def __init__(self, rnd, index):
+        self.bssid = bytes([0x00, 0x1a, 0x2b, rnd.randrange(256), rnd.randrange(256), index & 0xff])
+        self.ssid = ('net-%03d' % index).encode('ascii')
+        self.channel = rnd.choice((1, 6, 11, 36, 48, 149))
+        self.freq = _CHANNELS[(1, 6, 11, 36, 48, 149).index(self.channel)]
+        self.signal = rnd.randrange(-90, -35)
+        self.seq = rnd.randrange(4096)
+        self.tsf = rnd.randrange(1 << 40)
+        self.dtim = 0
+        self.ies = b''.join((
+            _ie(ieee80211.IE_RATES, b'\x82\x84\x8b\x96\x0c\x12\x18\x24'),
+            _ie(ieee80211.IE_DS, bytes([self.channel])),
+        ))
+        self.tail = b''.join((
+            _ie(42, b'\x00'),                                       # ERP
+            _ie(ieee80211.IE_RSN, b'\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x02\x0c\x00'),
+            _ie(ieee80211.IE_ESR, b'\x30\x48\x60\x6c'),
+            _ie(ieee80211.IE_HT_CAPA, bytes(26)),
+            _ie(ieee80211.IE_HT_INFO, bytes([self.channel]) + bytes(21)),
+            _ie(ieee80211.IE_EXT_CAPA, b'\x04\x00\x08\x00\x00\x00\x00\x40'),
+            _ie(ieee80211.IE_VENDOR, b'\x00\x50\xf2\x02\x01\x01\x80\x00\x03\xa4\x00\x00\x27\xa4\x00\x00'
+                                     b'\x42\x43\x5e\x00\x62\x32\x2f\x00'),
+            _ie(ieee80211.IE_VENDOR, b'\x00\x10\x18\x02\x00\x00\x1c\x00\x00'),
+        ))
+
+    def beacon(self):
+        self.seq = (self.seq + 1) & 0xfff
+        self.tsf += 102400
+        self.dtim = (self.dtim + 1) % 3
+        mgmt = IEEE80211.MGMT_Frame(dst=BROADCAST, src=self.bssid, bssid=self.bssid, frag_seq=_frag_seq(self.seq))
+        body = IEEE80211.Beacon(timestamp=self.tsf, interval=100, capability=0x1104)
+        tim = _ie(ieee80211.IE_TIM, bytes([self.dtim, 3, 0, 0]))
+        return (_hdr(ieee80211.MGMT_TYPE, ieee80211.M_BEACON) + bytes(mgmt) + bytes(body) +
+                _ie(ieee80211.IE_SSID, self.ssid) + self.ies + tim + self.tail)
+
+
+class _Station(object):
+    def __init__(self, rnd, ap):
+        self.rnd = rnd
+        self.ap = ap
+        self.mac = self.random_mac()
+        self.signal = rnd.randrange(-90, -40)
+        self.seq = rnd.randrange(4096)
+        self.vendor = rnd.choice((b'\x00\x17\xf2\x0a\x00\x01\x04\x00\x00\x00\x00',
+                                  b'\x00\x10\x18\x02\x00\x00\x10\x00\x00',
+                                  b'\x50\x6f\x9a\x16\x03\x01\x03'))
+
+    def random_mac(self):
+        rnd = self.rnd
+        return bytes([0x02 | (rnd.randrange(64) << 2)] + [rnd.randrange(256) for i in range(5)])
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xfff
+        return self.seq
+
+    def probe_req(self):
+        if self.rnd.random() < 0.2:
+            # MAC randomization: a new address for the next scan
+            self.mac = self.random_mac()
+        mgmt = IEEE80211.MGMT_Frame(dst=BROADCAST, src=self.mac, bssid=BROADCAST,
+                                    frag_seq=_frag_seq(self.next_seq()))
+        ies = b''.join((
+            _ie(ieee80211.IE_SSID, b''),
+            _ie(ieee80211.IE_RATES, b'\x02\x04\x0b\x16\x0c\x12\x18\x24'),
+            _ie(ieee80211.IE_ESR, b'\x30\x48\x60\x6c'),
+            _ie(ieee80211.IE_HT_CAPA, bytes(26)),
+            _ie(ieee80211.IE_EXT_CAPA, b'\x00\x00\x08\x04\x00\x00\x00\x40'),
+            _ie(ieee80211.IE_VENDOR, self.vendor),
+        ))
+        return _hdr(ieee80211.MGMT_TYPE, ieee80211.M_PROBE_REQ) + bytes(mgmt) + ies
+
+    def qos_data(self):
+        rnd = self.rnd
+        seq = _frag_seq(self.next_seq())
+        if rnd.random() < 0.5:
+            hdr = _hdr(ieee80211.DATA_TYPE, ieee80211.D_QOS_DATA, to_ds=1)
+            addr = IEEE80211.DataToDS(bssid=self.ap.bssid, src=self.mac, dst=b'\x00\x0c\x29\x00\x00\x01', frag_seq=seq)
+        else:
+            hdr = _hdr(ieee80211.DATA_TYPE, ieee80211.D_QOS_DATA, from_ds=1)
+            addr = IEEE80211.DataFromDS(dst=self.mac, bssid=self.ap.bssid, src=b'\x00\x0c\x29\x00\x00\x01', frag_seq=seq)
+        qos = IEEE80211.QoS_Data(control=rnd.randrange(8))
+        payload = b'\xaa\xaa\x03\x00\x00\x00\x08\x00' + bytes(rnd.randrange(40, 1400))
+        return hdr + bytes(addr) + bytes(qos) + payload
+
+    def ctl(self):
+        kind = self.rnd.randrange(3)
+        if kind == 0:
+            return _hdr(ieee80211.CTL_TYPE, ieee80211.C_ACK) + bytes(IEEE80211.ACK(dst=self.mac))
+        if kind == 1:
+            return _hdr(ieee80211.CTL_TYPE, ieee80211.C_RTS) + bytes(IEEE80211.RTS(dst=self.ap.bssid, src=self.mac))
+        return _hdr(ieee80211.CTL_TYPE, ieee80211.C_CTS) + bytes(IEEE80211.CTS(dst=self.mac))
+
+
+def generate(count, seed=1, aps=50, stations=300, mix=DEFAULT_MIX):
+    """Return count radiotap frames as a list of (timestamp, bytes)."""
+    rnd = random.Random(seed)
+    ap_list = [_AP(rnd, i) for i in range(aps)]
+    sta_list = [_Station(rnd, rnd.choice(ap_list)) for i in range(stations)]
+    kinds = [k for k, share in mix]
+    weights = [share for k, share in mix]
+    ts = 1500000000.0
+    tsft = rnd.randrange(1 << 40)
+    frames = []
+    for kind in rnd.choices(kinds, weights, k=count):
+        gap = rnd.expovariate(2000.0)
+        ts += gap
+        tsft += int(gap * 1e6)
+        if kind == 'beacon':
+            ap = rnd.choice(ap_list)
+            frame = radiotap(tsft, ap.freq, ap.signal + rnd.randrange(-3, 4)) + ap.beacon()
+        else:
+            sta = rnd.choice(sta_list)
+            frame = radiotap(tsft, sta.ap.freq, sta.signal + rnd.randrange(-3, 4)) + getattr(sta, kind)()
+        frames.append((ts, frame))
+    return frames
+
+
+def write_pcap(path, frames):
+    with open(path, 'wb') as f:
+        w = pcap.Writer(f, snaplen=65535, linktype=pcap.DLT_IEEE802_11_RADIO)
+        for ts, frame in frames:
+            w.writepkt(frame, ts)
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:s:w:')
+    count, seed, path = 10000, 1, None
+    for o, a in opts:
+        if o == '-n':
+            count = int(a)
+        elif o == '-s':
+            seed = int(a)
+        elif o == '-w':
+            path = a
+    if path is None:
+        print(__doc__)
+        return
+    frames = generate(count, seed)
+    write_pcap(path, frames)
+    print('%d frames, %d bytes written to %s' % (len(frames), sum(len(f) for t, f in frames), path))
+
+
+if __name__ == '__main__':
+    main()
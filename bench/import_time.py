@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Startup cost of importing dpkt and the sniffer.
+
+Every sample runs in a fresh interpreter. Reports the wall time of the
+import statement, the peak RSS of the process and the number of dpkt
+modules loaded afterwards.
+
+    python bench/import_time.py [-n runs] [--json] [module...]
+"""
+
+import getopt
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = '''
+import resource, sys, time
+t = time.perf_counter()
+import %s
+t = time.perf_counter() - t
+print(t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      len([m for m in sys.modules if m == 'dpkt' or m.startswith('dpkt.')]))
+'''
+
+
+def sample(module):
+    out = subprocess.check_output([sys.executable, '-c', _PROBE % module], cwd=ROOT)
+    t, rss, mods = out.split()
+    return float(t), int(rss), int(mods)
+
+
+def measure(module, runs=10):
+    samples = [sample(module) for i in range(runs)]
+    times = sorted(s[0] for s in samples)
+    return {
+        'module': module,
+        'runs': runs,
+        'min_ms': times[0] * 1e3,
+        'median_ms': times[len(times) // 2] * 1e3,
+        'maxrss_kb': max(s[1] for s in samples),
+        'dpkt_modules': samples[-1][2],
+    }
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:', ['json'])
+    runs = 10
+    as_json = False
+    for o, a in opts:
+        if o == '-n':
+            runs = int(a)
+        elif o == '--json':
+            as_json = True
+    results = [measure(m, runs) for m in (args or ['dpkt', 'sniffer'])]
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print('%-10s min %6.1f ms  median %6.1f ms  maxrss %6d kB  dpkt modules %d' % (
+            r['module'], r['min_ms'], r['median_ms'], r['maxrss_kb'], r['dpkt_modules']))
+
+
+if __name__ == '__main__':
+    main()
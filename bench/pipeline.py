@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""End-to-end capture pipeline benchmark.
+
+Feeds a synthetic frame mix (bench/corpus.py) through
+SnifferWorker.on_raw_packet_received with the default plugins and no
+sinks, and reports frames/s, per frame handler latency (p50/p99/max) and
+memory: the mean peak of memory allocated while handling one frame and
+the blocks still allocated per frame afterwards (the databases growing
+plus anything leaked). Timings are from the fastest of -r runs.
+
+    python bench/pipeline.py [-n frames] [-s seed] [-r runs] [-m direct|socket]
+                             [--save file.json] [--compare file.json]
+                             [--threshold percent] [--json]
+
+direct hands the prepared buffers to the worker through a fake socket,
+socket sends every frame over an AF_UNIX socketpair first and includes the
+syscalls. --save writes the results as a JSON baseline, --compare prints
+the change against a baseline and exits with status 1 if throughput or
+p99 latency regressed by more than the threshold (default 10%).
+"""
+
+import gc
+import getopt
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpus
+import eloop
+import sniffer
+from sniffer import SnifferWorker, SCM_TIMESTAMPNS, _timespec
+
+
+class _Replay(object):
+    """Stands in for the raw socket, returns one prepared frame per call."""
+
+    def __init__(self, frames):
+        self.msgs = [(buf, [(socket.SOL_SOCKET, SCM_TIMESTAMPNS, _timespec.pack(int(ts), int(ts % 1 * 1e9)))], 0, None)
+                     for ts, buf in frames]
+        self.next = iter(self.msgs).__next__
+
+    def recvmsg(self, bufsize, ancbufsize=0, flags=0):
+        return self.next()
+
+
+def _worker():
+    s = sniffer.Sniffer()
+    s.disable_transport = True
+    w = SnifferWorker(s)
+    w.dispatch = sniffer.plugins.build_dispatch(s.plugins)
+    return s, w
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def run_direct(frames):
+    s, w = _worker()
+    fd = _Replay(frames)
+    handler = w.on_raw_packet_received
+    clock = time.perf_counter_ns
+    latencies = [0] * len(frames)
+    start = clock()
+    for i in range(len(frames)):
+        t0 = clock()
+        handler(fd, eloop.EVENT_READ, None)
+        latencies[i] = clock() - t0
+    return clock() - start, latencies, s
+
+
+def run_socket(frames):
+    s, w = _worker()
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    b.setsockopt(socket.SOL_SOCKET, sniffer.SO_TIMESTAMPNS, 1)
+    handler = w.on_raw_packet_received
+    clock = time.perf_counter_ns
+    latencies = [0] * len(frames)
+    try:
+        start = clock()
+        for i, (ts, buf) in enumerate(frames):
+            a.send(buf)
+            t0 = clock()
+            handler(b, eloop.EVENT_READ, None)
+            latencies[i] = clock() - t0
+        return clock() - start, latencies, s
+    finally:
+        a.close()
+        b.close()
+
+
+def measure_memory(frames):
+    """Return (mean peak bytes allocated per frame, blocks retained per frame).
+
+    The first frames warm up the pool and the caches, the next half of the
+    rest is counted for retained blocks with tracemalloc off (it allocates
+    blocks of its own) and the remaining frames are traced for the peaks,
+    all on the same worker.
+    """
+    s, w = _worker()
+    fd = _Replay(frames)
+    handler = w.on_raw_packet_received
+    warm = min(1000, len(frames) // 4)
+    for i in range(warm):
+        handler(fd, eloop.EVENT_READ, None)
+    counted = (len(frames) - warm) // 2
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for i in range(counted):
+        handler(fd, eloop.EVENT_READ, None)
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    traced = len(frames) - warm - counted
+    tracemalloc.start()
+    get_traced_memory, reset_peak = tracemalloc.get_traced_memory, tracemalloc.reset_peak
+    peaks = 0
+    for i in range(traced):
+        before = get_traced_memory()[0]
+        reset_peak()
+        handler(fd, eloop.EVENT_READ, None)
+        peaks += get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peaks / traced, retained / counted
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(count=20000, seed=1, mode='direct', runs=3):
+    frames = corpus.generate(count, seed)
+    run = run_socket if mode == 'socket' else run_direct
+    # one pass to warm up, then the fastest run counts
+    run(frames)
+    elapsed, latencies, s = min((run(frames) for i in range(runs)), key=lambda r: r[0])
+    latencies.sort()
+    alloc_peak, retained = measure_memory(frames)
+    return {
+        'rev': _git_rev(),
+        'python': platform.python_version(),
+        'mode': mode,
+        'frames': count,
+        'seed': seed,
+        'runs': runs,
+        'frames_per_s': count / (elapsed * 1e-9),
+        'latency_p50_us': _percentile(latencies, 0.50) / 1e3,
+        'latency_p99_us': _percentile(latencies, 0.99) / 1e3,
+        'latency_max_us': latencies[-1] / 1e3,
+        'alloc_peak_bytes_per_frame': alloc_peak,
+        'retained_blocks_per_frame': retained,
+        'aps': sum(len(aps) for aps in s.ap_database.ap_macs.values()),
+        'stations': sum(len(stas) for stas in s.sta_database.sta_macs.values()),
+        'plugins': dict((p.name, p.stats()) for p in s.plugins),
+    }
+
+
+def report(r):
+    print('%s  %s  python %s  %d frames (seed %d, best of %d)' % (
+        r['rev'], r['mode'], r['python'], r['frames'], r['seed'], r['runs']))
+    print('  throughput  %10.0f frames/s' % r['frames_per_s'])
+    print('  latency     p50 %.1f us  p99 %.1f us  max %.1f us' % (
+        r['latency_p50_us'], r['latency_p99_us'], r['latency_max_us']))
+    print('  memory      %.0f bytes peak/frame  %.3f blocks retained/frame' % (
+        r['alloc_peak_bytes_per_frame'], r['retained_blocks_per_frame']))
+    print('  databases   %d aps  %d stations' % (r['aps'], r['stations']))
+    for name, st in sorted(r['plugins'].items()):
+        print('  %-14s %8d calls  %6.2f us/call' % (name, st['calls'], st['us_per_call']))
+
+
+# metric -> True if higher is better
+_COMPARED = (
+    ('frames_per_s', True),
+    ('latency_p50_us', False),
+    ('latency_p99_us', False),
+    ('alloc_peak_bytes_per_frame', False),
+    ('retained_blocks_per_frame', False),
+)
+
+
+def compare(base, r, threshold):
+    """Print the change per metric, return True if nothing regressed."""
+    ok = True
+    print('against %s (%s, %d frames)' % (base.get('rev'), base.get('mode'), base.get('frames', 0)))
+    for key, higher_is_better in _COMPARED:
+        old, new = base.get(key), r[key]
+        if not old:
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold and key in ('frames_per_s', 'latency_p99_us'):
+            flag = '  REGRESSION'
+            ok = False
+        print('  %-28s %12.2f -> %12.2f  %+6.1f%%%s' % (key, old, new, change, flag))
+    return ok
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:s:r:m:', ['save=', 'compare=', 'threshold=', 'json'])
+    count, seed, runs, mode = 20000, 1, 3, 'direct'
+    save = baseline = None
+    threshold = 10.0
+    as_json = False
+    for o, a in opts:
+        if o == '-n':
+            count = int(a)
+        elif o == '-s':
+            seed = int(a)
+        elif o == '-r':
+            runs = int(a)
+        elif o == '-m':
+            if a not in ('direct', 'socket'):
+                raise SystemExit('unknown mode %s' % a)
+            mode = a
+        elif o == '--save':
+            save = a
+        elif o == '--compare':
+            baseline = a
+        elif o == '--threshold':
+            threshold = float(a)
+        elif o == '--json':
+            as_json = True
+    r = benchmark(count, seed, mode, runs)
+    if as_json:
+        print(json.dumps(r, indent=2, sort_keys=True))
+    else:
+        report(r)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(r, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            if not compare(json.load(f), r, threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
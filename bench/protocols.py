@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""Per protocol dpkt parse and build microbenchmarks.
+
+Every case unpacks the packets of a small corpus in bench/corpora/ with
+one dpkt class, then packs the parsed objects again. Reports ns/packet for
+both directions (the fastest of several timed repeats) and the mean peak
+of memory allocated per unpack.
+
+    python bench/protocols.py [-t seconds] [--json] [case...]
+    python bench/protocols.py --compare <rev> [<rev>] [case...]
+    python bench/protocols.py --build
+
+--compare runs the suite against the dpkt package of each git revision
+(the working tree if only one is given, '.' for the working tree) with
+the corpora and harness of the working tree, and prints the change.
+--build regenerates the corpora; they are checked in so that the numbers
+stay comparable across revisions.
+"""
+
+import getopt
+import importlib
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPORA = os.path.join(ROOT, 'bench', 'corpora')
+
+DLT_USER0 = 147
+
+
+def _http_unpack(http, buf):
+    s = buf.decode('latin-1')
+    if s.startswith('HTTP/'):
+        return http.Response(s)
+    return http.Request(s)
+
+
+def _tls_unpack(ssl, buf):
+    rec = ssl.TLSRecord(buf)
+    if rec.type == 22:
+        ssl.TLSHandshake(rec.data)
+    return rec
+
+
+# name -> (module, class or unpack function, linktype)
+CASES = (
+    ('radiotap', 'radiotap', 'Radiotap', 127),
+    ('ieee80211', 'ieee80211', 'IEEE80211', 105),
+    ('ethernet', 'ethernet', 'Ethernet', 1),
+    ('ip', 'ip', 'IP', DLT_USER0),
+    ('ip6', 'ip6', 'IP6', DLT_USER0),
+    ('tcp', 'tcp', 'TCP', DLT_USER0),
+    ('udp', 'udp', 'UDP', DLT_USER0),
+    ('dns', 'dns', 'DNS', DLT_USER0),
+    ('http', 'http', _http_unpack, DLT_USER0),
+    ('ssl', 'ssl', _tls_unpack, DLT_USER0),
+    ('dhcp', 'dhcp', 'DHCP', DLT_USER0),
+    ('netflow', 'netflow', 'Netflow5', DLT_USER0),
+)
+
+
+def _pack(obj):
+    # http messages are still built as text
+    if isinstance(obj, bytes):
+        return obj
+    try:
+        return bytes(obj)
+    except TypeError:
+        return str(obj)
+
+
+def load(name):
+    from dpkt import pcap
+    with open(os.path.join(CORPORA, name + '.pcap'), 'rb') as f:
+        return [bytes(buf) for ts, buf in pcap.Reader(f)]
+
+
+def _timeit(fn, items, min_time):
+    """Return the fastest ns per item of repeated passes over items."""
+    clock = time.perf_counter_ns
+    best = None
+    spent = 0
+    while spent < min_time * 1e9 or best is None:
+        t0 = clock()
+        for item in items:
+            fn(item)
+        elapsed = clock() - t0
+        spent += elapsed
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(items)
+
+
+def _alloc(fn, items):
+    tracemalloc.start()
+    get_traced_memory, reset_peak = tracemalloc.get_traced_memory, tracemalloc.reset_peak
+    peaks = 0
+    for item in items:
+        before = get_traced_memory()[0]
+        reset_peak()
+        fn(item)
+        peaks += get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peaks / len(items)
+
+
+def run_case(name, module, unpack, min_time=0.2):
+    mod = importlib.import_module('dpkt.' + module)
+    if isinstance(unpack, str):
+        unpack = getattr(mod, unpack)
+    else:
+        unpack = unpack.__get__(mod)
+    packets = load(name)
+    result = {
+        'packets': len(packets),
+        'bytes': sum(len(p) for p in packets),
+    }
+    try:
+        objs = [unpack(p) for p in packets]
+        result['unpack_ns'] = _timeit(unpack, packets, min_time)
+        result['unpack_alloc'] = _alloc(unpack, packets)
+        for obj in objs:
+            _pack(obj)
+        result['pack_ns'] = _timeit(_pack, objs, min_time)
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return result
+
+
+def run(names=None, min_time=0.2):
+    results = {}
+    for name, module, unpack, linktype in CASES:
+        if names and name not in names:
+            continue
+        results[name] = run_case(name, module, unpack, min_time)
+    return results
+
+
+def report(results):
+    print('%-10s %7s %9s %12s %12s %14s' % ('case', 'packets', 'bytes/pkt', 'unpack ns', 'pack ns', 'alloc B/unpack'))
+    for name, r in results.items():
+        line = '%-10s %7d %9.0f' % (name, r['packets'], r['bytes'] / r['packets'])
+        for key, fmt in (('unpack_ns', ' %12.0f'), ('pack_ns', ' %12.0f'), ('unpack_alloc', ' %14.0f')):
+            line += fmt % r[key] if key in r else ' %*s' % (int(fmt[2:4]), '-')
+        if 'error' in r:
+            line += '  ' + r['error']
+        print(line)
+
+
+def _tree(rev, tmpdir):
+    """Return a directory holding the dpkt package of rev."""
+    if rev == '.':
+        return ROOT
+    path = os.path.join(tmpdir, rev.replace('/', '_'))
+    os.mkdir(path)
+    archive = subprocess.Popen(['git', 'archive', rev, 'dpkt'], cwd=ROOT, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', path], stdin=archive.stdout)
+    if archive.wait():
+        raise SystemExit('git archive %s failed' % rev)
+    return path
+
+
+def _run_tree(path, names, min_time):
+    cmd = [sys.executable, os.path.abspath(__file__), '--json', '--dpkt', path, '-t', str(min_time)] + names
+    try:
+        return json.loads(subprocess.check_output(cmd, cwd=ROOT))
+    except subprocess.CalledProcessError:
+        raise SystemExit('benchmark of %s failed' % path)
+
+
+def compare(old_rev, new_rev, names, min_time):
+    tmpdir = tempfile.mkdtemp(prefix='dpkt-bench-')
+    try:
+        old = _run_tree(_tree(old_rev, tmpdir), names, min_time)
+        new = _run_tree(_tree(new_rev, tmpdir), names, min_time)
+    finally:
+        shutil.rmtree(tmpdir)
+    print('%-10s %s -> %s' % ('', old_rev, new_rev))
+    for key, label in (('unpack_ns', 'unpack ns'), ('pack_ns', 'pack ns'), ('unpack_alloc', 'alloc B/unpack')):
+        print(label)
+        for name in new:
+            a, b = old.get(name, {}).get(key), new[name].get(key)
+            if a is None or b is None:
+                print('  %-10s %12s -> %12s' % (name, '-' if a is None else '%.0f' % a, '-' if b is None else '%.0f' % b))
+                continue
+            print('  %-10s %12.0f -> %12.0f  %+6.1f%%' % (name, a, b, (b - a) / a * 100 if a else 0.0))
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 't:', ['json', 'compare=', 'dpkt=', 'build'])
+    min_time = 0.2
+    as_json = False
+    old_rev = dpkt_path = None
+    for o, a in opts:
+        if o == '-t':
+            min_time = float(a)
+        elif o == '--json':
+            as_json = True
+        elif o == '--compare':
+            old_rev = a
+        elif o == '--dpkt':
+            dpkt_path = a
+        elif o == '--build':
+            sys.path.insert(0, ROOT)
+            build()
+            return
+    if old_rev:
+        new_rev = '.'
+        if args and args[0] not in [c[0] for c in CASES]:
+            new_rev = args.pop(0)
+        compare(old_rev, new_rev, args, min_time)
+        return
+    sys.path.insert(0, dpkt_path or ROOT)
+    results = run(args, min_time)
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+# corpora
+# -------
+
+_HTTP = (
+    b'GET /index.html HTTP/1.1\r\nHost: www.example.com\r\nUser-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n'
+    b'Accept: text/html,application/xhtml+xml\r\nAccept-Language: en-US,en;q=0.5\r\n'
+    b'Accept-Encoding: gzip, deflate\r\nConnection: keep-alive\r\n\r\n',
+    b'POST /api/v1/report HTTP/1.1\r\nHost: collector.example.com\r\nContent-Type: application/json\r\n'
+    b'Content-Length: 47\r\n\r\n{"bssid": "00:1a:2b:3c:4d:5e", "signal": -52}\r\n',
+    b'GET /generate_204 HTTP/1.1\r\nHost: connectivitycheck.gstatic.com\r\nConnection: close\r\n\r\n',
+    b'HTTP/1.1 200 OK\r\nDate: Mon, 12 Dec 2005 22:33:23 GMT\r\nServer: Apache\r\n'
+    b'Content-Type: text/html; charset=UTF-8\r\nContent-Length: 64\r\n\r\n' + b'<html>' + b'x' * 51 + b'</html>',
+    b'HTTP/1.1 204 No Content\r\nContent-Length: 0\r\nDate: Mon, 12 Dec 2005 22:33:23 GMT\r\n\r\n',
+    b'HTTP/1.1 200 OK\r\nContent-Type: text/javascript; charset=utf-8\r\nTransfer-Encoding: chunked\r\n'
+    b'Set-Cookie: S=gmail=agg; Domain=.google.com; Path=/\r\nServer: GFE/1.3\r\n\r\n'
+    b'a\r\n0123456789\r\n10\r\n0123456789abcdef\r\n0\r\n\r\n',
+    b'HTTP/1.1 302 Found\r\nLocation: https://www.example.com/\r\nSet-Cookie: a=1; path=/\r\n'
+    b'Set-Cookie: b=2; path=/\r\nContent-Length: 0\r\n\r\n',
+)
+
+_CLIENT_HELLO = bytes.fromhex(
+    '0100009d0303' + '5008220ce5e0e78b6891afe204498c9363feffbe03235a2d9e05b7d990eb708d' +
+    '20' + '09bc0192e008e6fa8fe47998fca91311ba30ddde14a9587dc674b11c3d3e5ed1' +
+    '0020c02bc02fc02cc030cca9cca8c013c014009c009d002f0035000a00ffc009c00a' + '0100' +
+    '0034' + '0000000e000c0000096c6f63616c686f7374' + '000a00080006001700180019' + '000b00020100' +
+    '000d000e000c040105010601040305030603')
+
+
+def _dns_queries(dns, rnd):
+    names = (b'www.google.com', b'connectivitycheck.gstatic.com', b'api.example.org', b'time.android.com',
+             b'_spotify-connect._tcp.local', b'1.1.211.141.in-addr.arpa')
+    out = []
+    for name in names:
+        q = dns.DNS(id=rnd.randrange(1 << 16), qd=[dns.DNS.Q(name=name, type=dns.DNS_A)])
+        out.append(bytes(q))
+        r = dns.DNS(id=q.id, op=dns.DNS_RA, rcode=dns.DNS_RCODE_NOERR, qd=q.qd,
+                    an=[dns.DNS.RR(name=name, type=dns.DNS_A, ttl=300,
+                                   rdata=bytes(rnd.randrange(256) for i in range(4))) for j in range(3)])
+        out.append(bytes(r))
+    return out
+
+
+def build():
+    import corpus
+    from dpkt import pcap, ethernet, ip, ip6, tcp, udp, dns, dhcp, netflow, ssl, ieee80211
+
+    rnd = random.Random(42)
+    cases = dict((c[0], []) for c in CASES)
+
+    frames = [buf for ts, buf in corpus.generate(64, seed=7)]
+    cases['radiotap'] = frames
+    cases['ieee80211'] = [buf[struct.unpack_from('<H', buf, 2)[0]:] for buf in frames]
+
+    # one client and a handful of servers, TCP with and without options, UDP with DNS payloads
+    dns_payloads = _dns_queries(dns, rnd)
+    client4, client6 = b'\xc0\xa8\x01\x17', b'\xfe\x80' + bytes(6) + b'\x02\x1a\x2b\xff\xfe\x3c\x4d\x5e'
+    for i in range(48):
+        v6 = rnd.random() < 0.25
+        if rnd.random() < 0.7:
+            opts = rnd.choice((b'', b'\x01\x01\x08\x0a' + bytes(8), b'\x02\x04\x05\xb4\x01\x03\x03\x07\x04\x02\x00\x00'))
+            l4 = tcp.TCP(sport=rnd.randrange(32768, 61000), dport=rnd.choice((80, 443, 8080)),
+                         seq=rnd.randrange(1 << 32), ack=rnd.randrange(1 << 32), flags=tcp.TH_ACK | tcp.TH_PUSH,
+                         win=rnd.randrange(1 << 16), opts=opts,
+                         data=bytes(rnd.randrange(256) for j in range(rnd.choice((0, 1, 37, 536, 1200)))))
+            l4.off = 5 + len(opts) // 4
+            proto = ip.IP_PROTO_TCP
+        else:
+            payload = rnd.choice(dns_payloads)
+            l4 = udp.UDP(sport=rnd.randrange(32768, 61000), dport=53, data=payload, ulen=8 + len(payload))
+            proto = ip.IP_PROTO_UDP
+        if v6:
+            # IP6 only becomes complete when parsed, build it from the header bytes
+            hdr = ip6.IP6(src=client6, dst=b'\x20\x01\x0d\xb8' + bytes(11) + bytes([rnd.randrange(1, 8)]),
+                          nxt=proto, hlim=64, plen=len(l4))
+            hdr.v = 6
+            l3 = ip6.IP6(hdr.pack_hdr() + bytes(l4))
+            l3.data.sum = 0
+            etype = ethernet.ETH_TYPE_IP6
+        else:
+            l3 = ip.IP(src=client4, dst=bytes([93, 184, 216, rnd.randrange(1, 32)]), p=proto,
+                       id=rnd.randrange(1 << 16), ttl=64, data=l4)
+            etype = ethernet.ETH_TYPE_IP
+        frame = bytes(ethernet.Ethernet(src=b'\x02\x1a\x2b\x3c\x4d\x5e', dst=b'\x00\x0c\x29\x00\x00\x01',
+                                        type=etype, data=l3))
+        cases['ethernet'].append(frame)
+        cases['ip6' if v6 else 'ip'].append(frame[14:])
+        cases['tcp' if proto == ip.IP_PROTO_TCP else 'udp'].append(bytes(l4))
+
+    cases['dns'] = dns_payloads
+    cases['http'] = list(_HTTP)
+    cases['ssl'] = [bytes(ssl.TLSRecord(type=22, version=0x0301, data=_CLIENT_HELLO))]
+    for n in (32, 64, 517, 1400, 16384):
+        cases['ssl'].append(bytes(ssl.TLSRecord(type=23, version=0x0303, data=bytes(rnd.randrange(256) for i in range(n)))))
+
+    discover = dhcp.DHCP(dhcp._TEST_DHCP)
+    for i in range(8):
+        discover.xid = rnd.randrange(1 << 32)
+        discover.chaddr = bytes(rnd.randrange(256) for j in range(6)) + bytes(10)
+        cases['dhcp'].append(bytes(discover))
+
+    sample = netflow.Netflow5(getattr(netflow, '__sample_v5'))
+    for count in (1, 5, 10, 29):
+        nf = netflow.Netflow5(version=5, sys_uptime=sample.sys_uptime, unix_sec=sample.unix_sec,
+                              flow_sequence=rnd.randrange(1 << 32), data=sample.data[:count])
+        cases['netflow'].append(bytes(nf))
+
+    if not os.path.isdir(CORPORA):
+        os.mkdir(CORPORA)
+    for name, module, unpack, linktype in CASES:
+        with open(os.path.join(CORPORA, name + '.pcap'), 'wb') as f:
+            w = pcap.Writer(f, snaplen=65535, linktype=linktype)
+            for i, buf in enumerate(cases[name]):
+                w.writepkt(buf, 1500000000 + i)
+        print('%-10s %3d packets' % (name, len(cases[name])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""Classic BPF filters for radiotap monitor sockets.
+
+A selection is a list of Rule objects, or its text form understood by
+parse_selection(), e.g.::
+
+    "mgmt; data to_ds !from_ds; data from_ds !to_ds"
+    "mgmt beacon probe_req"
+
+compile_selection() turns it into a classic BPF program that reads the
+little endian radiotap it_len to find the 802.11 frame control field and
+accepts a frame if any rule matches. attach_filter() installs the program
+on a socket with SO_ATTACH_FILTER, so frames nobody wants are dropped in
+the kernel before they are copied to user space.
+"""
+
+import ctypes
+import socket
+import struct
+from dpkt import ieee80211
+
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+SO_DETACH_FILTER = getattr(socket, 'SO_DETACH_FILTER', 27)
+
+# instruction classes
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ST = 0x02
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+# ld/ldx sizes and modes
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_IMM = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MEM = 0x60
+# alu/jmp operations and sources
+BPF_ADD = 0x00
+BPF_AND = 0x50
+BPF_OR = 0x40
+BPF_LSH = 0x60
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_K = 0x00
+BPF_X = 0x08
+BPF_A = 0x10
+# misc
+BPF_TAX = 0x00
+
+ACCEPT = 0xffff
+
+_FC_TYPE_MASK = 0x0c
+_FC_TYPE_SHIFT = 2
+_FC_SUBTYPE_MASK = 0xf0
+_FC_SUBTYPE_SHIFT = 4
+_FC_TO_DS = 0x01
+_FC_FROM_DS = 0x02
+
+_TYPES = {
+    'mgmt': ieee80211.MGMT_TYPE,
+    'ctl': ieee80211.CTL_TYPE,
+    'data': ieee80211.DATA_TYPE,
+}
+
+_SUBTYPES = {
+    ieee80211.MGMT_TYPE: {
+        'assoc_req': ieee80211.M_ASSOC_REQ,
+        'assoc_resp': ieee80211.M_ASSOC_RESP,
+        'reassoc_req': ieee80211.M_REASSOC_REQ,
+        'reassoc_resp': ieee80211.M_REASSOC_RESP,
+        'probe_req': ieee80211.M_PROBE_REQ,
+        'probe_resp': ieee80211.M_PROBE_RESP,
+        'beacon': ieee80211.M_BEACON,
+        'atim': ieee80211.M_ATIM,
+        'disassoc': ieee80211.M_DISASSOC,
+        'auth': ieee80211.M_AUTH,
+        'deauth': ieee80211.M_DEAUTH,
+        'action': ieee80211.M_ACTION,
+    },
+    ieee80211.CTL_TYPE: {
+        'bar': ieee80211.C_BLOCK_ACK_REQ,
+        'back': ieee80211.C_BLOCK_ACK,
+        'ps_poll': ieee80211.C_PS_POLL,
+        'rts': ieee80211.C_RTS,
+        'cts': ieee80211.C_CTS,
+        'ack': ieee80211.C_ACK,
+        'cf_end': ieee80211.C_CF_END,
+        'cf_end_ack': ieee80211.C_CF_END_ACK,
+    },
+    ieee80211.DATA_TYPE: {
+        'data': ieee80211.D_DATA,
+        'null': ieee80211.D_NULL,
+        'qos_data': ieee80211.D_QOS_DATA,
+        'qos_null': ieee80211.D_QOS_NULL,
+    },
+}
+
+
+class Rule(object):
+    """Frames of one type, optionally restricted to some subtypes and to
+    the state of the to_ds/from_ds flags (None means don't care)."""
+
+    def __init__(self, type, subtypes=None, to_ds=None, from_ds=None):
+        self.type = type
+        self.subtypes = tuple(subtypes) if subtypes else ()
+        self.to_ds = to_ds
+        self.from_ds = from_ds
+
+    def __repr__(self):
+        return 'Rule(%r, %r, to_ds=%r, from_ds=%r)' % (self.type, self.subtypes, self.to_ds, self.from_ds)
+
+
+def parse_selection(text):
+    """Parse "type [subtype...] [to_ds|!to_ds] [from_ds|!from_ds]; ..."."""
+    rules = []
+    for part in text.split(';'):
+        tokens = part.split()
+        if not tokens:
+            continue
+        try:
+            type = _TYPES[tokens[0]]
+        except KeyError:
+            raise ValueError('unknown frame type %r' % tokens[0])
+        rule = Rule(type)
+        subtypes = []
+        for tok in tokens[1:]:
+            if tok in ('to_ds', '!to_ds'):
+                rule.to_ds = tok[0] != '!'
+            elif tok in ('from_ds', '!from_ds'):
+                rule.from_ds = tok[0] != '!'
+            elif tok in _SUBTYPES[type]:
+                subtypes.append(_SUBTYPES[type][tok])
+            else:
+                raise ValueError('unknown %s subtype %r' % (tokens[0], tok))
+        rule.subtypes = tuple(subtypes)
+        rules.append(rule)
+    return rules
+
+
+def _insn(code, jt=0, jf=0, k=0):
+    return [code, jt, jf, k]
+
+
+def compile_selection(rules, snaplen=ACCEPT):
+    """Return the BPF program for rules as a list of (code, jt, jf, k)."""
+    if isinstance(rules, str):
+        rules = parse_selection(rules)
+
+    # X = it_len (little endian), M[0] = fc byte 0, M[1] = fc flags
+    prog = [
+        _insn(BPF_LD | BPF_B | BPF_ABS, k=3),
+        _insn(BPF_ALU | BPF_LSH | BPF_K, k=8),
+        _insn(BPF_MISC | BPF_TAX),
+        _insn(BPF_LD | BPF_B | BPF_ABS, k=2),
+        _insn(BPF_ALU | BPF_OR | BPF_X),
+        _insn(BPF_MISC | BPF_TAX),
+        _insn(BPF_LD | BPF_B | BPF_IND, k=1),
+        _insn(BPF_ST, k=1),
+        _insn(BPF_LD | BPF_B | BPF_IND, k=0),
+        _insn(BPF_ST, k=0),
+    ]
+    # jump targets are labels ('next', i) / ('ds', i) until resolved below
+    labels = {}
+    for i, rule in enumerate(rules):
+        labels[('rule', i)] = len(prog)
+        nxt = ('rule', i + 1)
+        prog.append(_insn(BPF_LD | BPF_MEM, k=0))
+        if rule.subtypes:
+            prog.append(_insn(BPF_ALU | BPF_AND | BPF_K, k=_FC_TYPE_MASK | _FC_SUBTYPE_MASK))
+            for j, st in enumerate(rule.subtypes):
+                val = (rule.type << _FC_TYPE_SHIFT) | (st << _FC_SUBTYPE_SHIFT)
+                last = j == len(rule.subtypes) - 1
+                prog.append(_insn(BPF_JMP | BPF_JEQ | BPF_K, ('ds', i), nxt if last else 0, val))
+        else:
+            prog.append(_insn(BPF_ALU | BPF_AND | BPF_K, k=_FC_TYPE_MASK))
+            prog.append(_insn(BPF_JMP | BPF_JEQ | BPF_K, ('ds', i), nxt, rule.type << _FC_TYPE_SHIFT))
+        labels[('ds', i)] = len(prog)
+        mask = val = 0
+        if rule.to_ds is not None:
+            mask |= _FC_TO_DS
+            val |= _FC_TO_DS if rule.to_ds else 0
+        if rule.from_ds is not None:
+            mask |= _FC_FROM_DS
+            val |= _FC_FROM_DS if rule.from_ds else 0
+        if mask:
+            prog.append(_insn(BPF_LD | BPF_MEM, k=1))
+            prog.append(_insn(BPF_ALU | BPF_AND | BPF_K, k=mask))
+            prog.append(_insn(BPF_JMP | BPF_JEQ | BPF_K, 0, nxt, val))
+        prog.append(_insn(BPF_RET | BPF_K, k=snaplen))
+    labels[('rule', len(rules))] = len(prog)
+    prog.append(_insn(BPF_RET | BPF_K, k=0))
+
+    for pc, insn in enumerate(prog):
+        for f in (1, 2):
+            if isinstance(insn[f], tuple):
+                off = labels[insn[f]] - pc - 1
+                if not 0 <= off <= 255:
+                    raise ValueError('selection too large for classic BPF')
+                insn[f] = off
+    return [tuple(insn) for insn in prog]
+
+
+def assemble(prog):
+    """Return the program as an array of struct sock_filter."""
+    return b''.join(struct.pack('=HBBI', *insn) for insn in prog)
+
+
+def attach_filter(sock, prog):
+    buf = ctypes.create_string_buffer(assemble(prog))
+    fprog = struct.pack('HL', len(prog), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def detach_filter(sock):
+    sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+
+def run(prog, pkt):
+    """Interpret prog against pkt like the kernel does (subset of opcodes
+    emitted by compile_selection); returns the number of bytes accepted."""
+    a = x = 0
+    mem = [0] * 16
+    pc = 0
+    while True:
+        code, jt, jf, k = prog[pc]
+        pc += 1
+        cls = code & 0x07
+        if cls == BPF_LD:
+            mode = code & 0xe0
+            if mode == BPF_MEM:
+                a = mem[k]
+            else:
+                off = k + (x if mode == BPF_IND else 0)
+                if off >= len(pkt):
+                    return 0
+                a = pkt[off]
+        elif cls == BPF_ST:
+            mem[k] = a
+        elif cls == BPF_ALU:
+            src = x if code & BPF_X else k
+            op = code & 0xf0
+            if op == BPF_AND:
+                a &= src
+            elif op == BPF_OR:
+                a |= src
+            elif op == BPF_LSH:
+                a = (a << src) & 0xffffffff
+            elif op == BPF_ADD:
+                a = (a + src) & 0xffffffff
+        elif cls == BPF_MISC:
+            x = a
+        elif cls == BPF_JMP:
+            if code & 0xf0 == BPF_JA:
+                pc += k
+            else:
+                pc += jt if a == k else jf
+        elif cls == BPF_RET:
+            return min(k, len(pkt))
+
+
+def _frame(fc0, fc1):
+    # radiotap header with an it_len of 0x0108 to exercise the high byte
+    rt = b'\x00\x00\x08\x01\x00\x00\x00\x00' + b'\x00' * (0x108 - 8)
+    return rt + bytes([fc0, fc1]) + b'\x00' * 22
+
+
+def test_compile():
+    beacon = _frame(0x80, 0x00)
+    probe_req = _frame(0x40, 0x00)
+    ack = _frame(0xd4, 0x00)
+    data_to_ds = _frame(0x08, 0x01)
+    data_from_ds = _frame(0x08, 0x02)
+    qos_wds = _frame(0x88, 0x03)
+
+    prog = compile_selection('mgmt; data to_ds !from_ds; data from_ds !to_ds')
+    assert [bool(run(prog, p)) for p in (beacon, probe_req, ack, data_to_ds, data_from_ds, qos_wds)] == \
+        [True, True, False, True, True, False]
+
+    prog = compile_selection('mgmt beacon probe_req')
+    assert [bool(run(prog, p)) for p in (beacon, probe_req, ack, data_to_ds, _frame(0x50, 0))] == \
+        [True, True, False, False, False]
+
+    assert run(compile_selection(''), beacon) == 0
+    assert run(compile_selection('mgmt'), beacon[:0x108]) == 0
+    assert len(assemble(prog)) == 8 * len(prog)
+
+
+def test_attach():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        attach_filter(b, compile_selection('mgmt beacon'))
+        a.send(_frame(0xd4, 0))
+        a.send(_frame(0x80, 0))
+        assert b.recv(4096) == _frame(0x80, 0)
+        detach_filter(b)
+    finally:
+        a.close()
+        b.close()
+
+
+if __name__ == '__main__':
+    test_compile()
+    test_attach()
+    print('Tests Successful...')
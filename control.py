@@ -0,0 +1,290 @@
+"""Control socket: line requests, JSON line replies.
+
+A client sends one command per line ("DUMP STA since=1500000000 limit=100").
+Every reply ends with a line holding an "ok" member; a streamed reply
+(DUMP) sends one JSON line per record before it. Commands are handled by
+a function taking the argument list and returning a dict, or an iterator
+of records whose last item is the final dict. The iterator may yield None
+while it has nothing to send, to give the loop back during a long scan.
+
+Streams are produced only while the client keeps up: at most CHUNK
+records or CHUNK_TIME seconds per loop iteration, and nothing while
+HIGH_WATER bytes are still unsent. A dump of the whole station table
+therefore never holds up capture for more than a few milliseconds.
+"""
+
+import json
+import os
+import socket
+import time
+import eloop
+
+
+def _encode(obj):
+    return json.dumps(obj, separators=(',', ':'), default=str).encode('utf8') + b'\n'
+
+
+class _Client(object):
+    __slots__ = ('conn', 'inbuf', 'outbuf', 'stream', 'events')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.stream = None
+        self.events = eloop.EVENT_READ
+
+
+class ControlServer(object):
+
+    CHUNK = 512
+    CHUNK_TIME = 0.002
+    HIGH_WATER = 256 * 1024
+    MAX_LINE = 4096
+    MAX_CLIENTS = 8
+    # pipelined requests handled per loop iteration and client
+    MAX_REQUESTS = 64
+
+    def __init__(self, loop, path, handler):
+        self.eloop = loop
+        self.path = path
+        self.handler = handler
+        self.clients = {}
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.bind(path)
+        self.sock.listen(4)
+        self.eloop.register(self.sock, eloop.EVENT_READ, self._on_accept)
+
+    def close(self):
+        for conn in list(self.clients):
+            self._close(conn)
+        self.eloop.unregister(self.sock)
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _on_accept(self, fd, mask, arg):
+        try:
+            conn, addr = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(self.clients) >= self.MAX_CLIENTS:
+            conn.close()
+            return
+        conn.setblocking(False)
+        self.clients[conn] = _Client(conn)
+        self.eloop.register(conn, eloop.EVENT_READ, self._on_client)
+
+    def _close(self, conn):
+        del self.clients[conn]
+        self.eloop.unregister(conn)
+        conn.close()
+
+    def _on_client(self, conn, mask, arg):
+        client = self.clients[conn]
+        if mask & eloop.EVENT_READ:
+            try:
+                data = conn.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                self._close(conn)
+                return
+            if data:
+                client.inbuf += data
+        self._process(client)
+
+    def _process(self, client):
+        conn = client.conn
+        for i in range(self.MAX_REQUESTS):
+            if client.stream is None:
+                self._next_request(client)
+            if client.stream is not None and len(client.outbuf) < self.HIGH_WATER:
+                self._produce(client)
+            if client.outbuf:
+                try:
+                    n = conn.send(client.outbuf)
+                except (BlockingIOError, InterruptedError):
+                    n = 0
+                except OSError:
+                    self._close(conn)
+                    return
+                del client.outbuf[:n]
+            if client.stream is not None or client.outbuf or b'\n' not in client.inbuf:
+                break
+        events = eloop.EVENT_READ
+        # the rest of the pipelined requests are handled once writable
+        if client.outbuf or client.stream is not None or b'\n' in client.inbuf:
+            events |= eloop.EVENT_WRITE
+        if events != client.events:
+            client.events = events
+            self.eloop.modify(conn, events, self._on_client)
+
+    def _next_request(self, client):
+        pos = client.inbuf.find(b'\n')
+        if pos < 0:
+            if len(client.inbuf) > self.MAX_LINE:
+                client.inbuf = bytearray()
+                client.outbuf += _encode({'ok': False, 'error': 'request too long'})
+            return
+        line = bytes(client.inbuf[:pos]).decode('utf8', 'replace')
+        del client.inbuf[:pos + 1]
+        argv = line.split()
+        if not argv:
+            return
+        try:
+            reply = self.handler(argv)
+        except Exception as e:
+            reply = {'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)}
+        if isinstance(reply, dict):
+            client.outbuf += _encode(reply)
+        else:
+            client.stream = iter(reply)
+
+    def _produce(self, client):
+        deadline = time.perf_counter() + self.CHUNK_TIME
+        out = client.outbuf
+        stream = client.stream
+        for i in range(self.CHUNK):
+            try:
+                item = next(stream)
+            except StopIteration:
+                client.stream = None
+                return
+            except Exception as e:
+                out += _encode({'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)})
+                client.stream = None
+                return
+            if item is None:
+                if time.perf_counter() > deadline:
+                    return
+                continue
+            out += _encode(item)
+            if 'ok' in item:
+                client.stream = None
+                return
+            if len(out) >= self.HIGH_WATER or time.perf_counter() > deadline:
+                return
+
+
+def parse_filters(args):
+    """Split "key=value" arguments into a dict, raise ValueError on others."""
+    filters = {}
+    for a in args:
+        k, sep, v = a.partition('=')
+        if not sep or not k:
+            raise ValueError('expected key=value, got %r' % a)
+        filters[k.lower()] = v
+    return filters
+
+
+def request(path, line, timeout=5.0):
+    """Send one command, return the list of reply objects (records first,
+    the final dict last)."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(path)
+        s.sendall(line.encode('utf8') + b'\n')
+        return list(read_reply(s.makefile('rb')))
+    finally:
+        s.close()
+
+
+def read_reply(f):
+    """Yield the objects of one reply from a file object."""
+    for line in f:
+        obj = json.loads(line)
+        yield obj
+        if 'ok' in obj:
+            return
+    raise EOFError('connection closed in the middle of a reply')
+
+
+def test_stream():
+    import tempfile
+    tmp = tempfile.mkdtemp(prefix='ctrl')
+    path = os.path.join(tmp, 'sock')
+    loop = eloop.EventLoop()
+
+    def handler(argv):
+        if argv[0] == 'COUNT':
+            n = int(argv[1])
+            return iter([{'i': i} for i in range(n)] + [{'ok': True, 'count': n}])
+        if argv[0] == 'FAIL':
+            raise ValueError('no')
+        return {'ok': True, 'argv': argv}
+
+    server = ControlServer(loop, path, handler)
+    server.CHUNK = 100
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    # pipelined requests, the dump takes many loop iterations
+    client.sendall(b'COUNT 5000\nECHO a b\nFAIL\n')
+    client.setblocking(False)
+    buf = bytearray()
+    iterations = [0]
+
+    def on_reply(fd, mask, arg):
+        data = client.recv(65536)
+        buf.extend(data)
+        if buf.count(b'"ok"') == 3 or not data:
+            loop.stop()
+
+    def tick(arg):
+        iterations[0] += 1
+        loop.register_timeout(0, tick)
+
+    loop.register(client, eloop.EVENT_READ, on_reply)
+    loop.register_timeout(0, tick)
+    loop.register_timeout(5, lambda arg: loop.stop())
+    loop.run()
+    lines = [json.loads(l) for l in bytes(buf).splitlines()]
+    assert [l['i'] for l in lines[:5000]] == list(range(5000))
+    assert lines[5000] == {'ok': True, 'count': 5000}
+    assert lines[5001] == {'ok': True, 'argv': ['ECHO', 'a', 'b']}
+    assert lines[5002]['ok'] is False and 'no' in lines[5002]['error']
+    # the loop kept running timers while the dump streamed
+    assert iterations[0] >= 5000 // server.CHUNK
+    loop.unregister(client)
+    client.close()
+
+    # a long pipeline is worked off over several iterations
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    client.sendall(b'\n' * 4000 + b'ECHO x\n')
+    client.setblocking(False)
+    del buf[:]
+
+    def on_echo(fd, mask, arg):
+        data = client.recv(65536)
+        buf.extend(data)
+        if b'"ok"' in buf or not data:
+            loop.stop()
+
+    loop.register(client, eloop.EVENT_READ, on_echo)
+    loop.register_timeout(5, lambda arg: loop.stop())
+    loop.run()
+    assert json.loads(bytes(buf)) == {'ok': True, 'argv': ['ECHO', 'x']}
+    client.close()
+    server.close()
+    assert not os.path.exists(path)
+    os.rmdir(tmp)
+
+    assert parse_filters(['mac=00:11', 'Since=5']) == {'mac': '00:11', 'since': '5'}
+    try:
+        parse_filters(['oops'])
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+if __name__ == '__main__':
+    test_stream()
+    print('Tests Successful...')
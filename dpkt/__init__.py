@@ -9,64 +9,25 @@ __version__ = '1.8.6.2'
 
 from .dpkt import *
 
-from . import ah
-from . import aoe
-from . import aim
-from . import arp
-from . import asn1
-from . import bgp
-from . import cdp
-from . import dhcp
-from . import diameter
-from . import dns
-from . import dtp
-from . import esp
-from . import ethernet
-from . import gre
-from . import gzip
-from . import h225
-from . import hsrp
-from . import http
-from . import icmp
-from . import icmp6
-from . import ieee80211
-from . import igmp
-from . import ip
-from . import ip6
-from . import ipx
-from . import llc
-from . import loopback
-from . import mrt
-from . import netbios
-from . import netflow
-from . import ntp
-from . import ospf
-from . import pcap
-from . import pim
-from . import pmap
-from . import ppp
-from . import pppoe
-from . import qq
-from . import radiotap
-from . import radius
-from . import rfb
-from . import rip
-from . import rpc
-from . import rtp
-from . import rx
-from . import sccp
-from . import sctp
-from . import sip
-from . import sll
-from . import smb
-from . import ssl
-from . import stp
-from . import stun
-from . import tcp
-from . import telnet
-from . import tftp
-from . import tns
-from . import tpkt
-from . import udp
-from . import vrrp
-from . import yahoo
+# protocol modules are imported on first access, e.g. dpkt.ethernet
+_MODULES = frozenset((
+    'ah', 'aoe', 'aim', 'arp', 'asn1', 'bgp', 'cdp', 'dhcp', 'diameter', 'dns',
+    'dtp', 'esp', 'ethernet', 'gre', 'gzip', 'h225', 'hsrp', 'http', 'icmp',
+    'icmp6', 'ieee80211', 'igmp', 'ip', 'ip6', 'ipx', 'llc', 'loopback', 'mrt',
+    'netbios', 'netflow', 'ntp', 'ospf', 'pcap', 'pfilter', 'pim', 'pmap',
+    'ppp', 'pppoe', 'qq', 'radiotap', 'radius', 'rfb', 'rip', 'rpc', 'rtp',
+    'rx', 'sccp', 'sctp', 'sip', 'sll', 'smb', 'ssl', 'stp', 'stun', 'tcp',
+    'telnet', 'tftp', 'tns', 'tpkt', 'udp', 'vrrp', 'yahoo',
+))
+
+
+def __getattr__(name):
+    if name in _MODULES:
+        import importlib
+        # the import binds the submodule as a package attribute
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _MODULES)
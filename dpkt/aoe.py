@@ -15,7 +15,7 @@ class AOE(dpkt.Packet):
         ('cmd', 'B', 0),
         ('tag', 'I', 0),
     )
-    _cmdsw = {}
+    _cmdsw = dpkt.LazyDispatch()
 
     @property
     def ver(self): return self.ver_fl >> 4
@@ -75,20 +75,11 @@ AOE_FLAG_RSP = 1 << 3
 
 def __load_cmds():
     prefix = 'AOE_CMD_'
-    g = globals()
-    try:
-        gi = g.iteritems()
-    except:
-        gi = g.items()
-    for k, v in gi:
+    for k, v in list(globals().items()):
         if k.startswith(prefix):
             name = 'aoe' + k[len(prefix):].lower()
-            try:
-                mod = __import__(name, g, level=1)
-                AOE.set_cmd(v, getattr(mod, name.upper()))
-            except (ImportError, AttributeError):
-                continue
+            AOE._cmdsw.add_lazy(v, name, name.upper())
 
 
-if not AOE._cmdsw:
+if not AOE._cmdsw.pending:
     __load_cmds()
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import warnings
 from timeit import Timer
-from test import pystone
 from time import sleep
 
 
@@ -42,9 +41,15 @@ def duration(function, repeat=10000):
         try:
             time = Timer(lambda: function(*args, **kwargs)).timeit(repeat)
         finally:
-            benchtime, pystones = pystone.pystones()
-            kstones = (pystones * time) / 1000
-            print('%s : time = %f kstones = %f' % (function.__name__, time, kstones))
+            # only imported when used, test.pystone is gone since Python 3.11
+            try:
+                from test import pystone
+            except ImportError:
+                print('%s : time = %f per call = %f' % (function.__name__, time, time / repeat))
+            else:
+                benchtime, pystones = pystone.pystones()
+                kstones = (pystones * time) / 1000
+                print('%s : time = %f kstones = %f' % (function.__name__, time, kstones))
         return function(*args, **kwargs)
 
     return _duration
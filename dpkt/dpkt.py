@@ -3,6 +3,7 @@
 """Simple packet creation and parsing."""
 
 import copy
+import importlib
 import itertools
 import socket
 import struct
@@ -26,19 +27,39 @@ class PackError(Error):
     pass
 
 
+# defaults of these types are shared between instances instead of copied
+_IMMUTABLE = (int, float, complex, bytes, str, tuple, frozenset, type(None))
+
+
 class _MetaPacket(type):
     def __new__(cls, clsname, clsbases, clsdict):
         t = type.__new__(cls, clsname, clsbases, clsdict)
         st = getattr(t, '__hdr__', None)
         if st is not None:
             # XXX - __slots__ only created in __new__()
-            clsdict['__slots__'] = [x[0] for x in st] + ['data']
+            slots = [x[0] for x in st] + ['data']
+            extra = clsdict.get('__extra_slots__')
+            if extra is not None:
+                # the class lists its dynamic attributes, no __dict__
+                slots.extend(extra)
+            else:
+                if not any(b.__dictoffset__ for b in clsbases):
+                    slots.append('__dict__')
+                if not any(b.__weakrefoffset__ for b in clsbases):
+                    slots.append('__weakref__')
+            clsdict['__slots__'] = slots
             t = type.__new__(cls, clsname, clsbases, clsdict)
+            t.__extra_slot_names__ = tuple(sorted(set(
+                n for k in t.__mro__ for n in getattr(k, '__extra_slots__', None) or ()
+                if n not in ('__dict__', '__weakref__'))))
             t.__hdr_fields__ = [x[0] for x in st]
             t.__hdr_fmt__ = getattr(t, '__byte_order__', '>') + ''.join([x[1] for x in st])
-            t.__hdr_len__ = struct.calcsize(t.__hdr_fmt__)
+            t.__hdr_struct__ = struct.Struct(t.__hdr_fmt__)
+            t.__hdr_len__ = t.__hdr_struct__.size
             t.__hdr_defaults__ = dict(list(zip(
                 t.__hdr_fields__, [x[2] for x in st])))
+            t.__hdr_immutable__ = tuple((x[0], x[2]) for x in st if isinstance(x[2], _IMMUTABLE))
+            t.__hdr_mutable__ = tuple(x[0] for x in st if not isinstance(x[2], _IMMUTABLE))
         return t
 
 
@@ -48,6 +69,9 @@ class Packet(metaclass=_MetaPacket):
 
     __hdr__ should be defined as a list of (name, structfmt, default) tuples
     __byte_order__ can be set to override the default ('>')
+    __extra_slots__ lists the attributes unpack() adds besides the header
+    fields and data; instances of such classes have no __dict__. Classes
+    that leave it out (or list '__dict__') keep accepting any attribute.
 
     Example::
 
@@ -71,6 +95,9 @@ class Packet(metaclass=_MetaPacket):
     Foo(baz=' wor', foo=1751477356L, bar=28460, data='ld!')
     """
 
+    __slots__ = ()
+    __extra_slot_names__ = ()
+
     def __init__(self, *args, **kwargs):
         """Packet constructor with ([buf], [field=val,...]) prototype.
 
@@ -83,23 +110,97 @@ class Packet(metaclass=_MetaPacket):
         """
         self.data = b''
         if args:
-            try:
-                self.unpack(args[0])
-            except struct.error:
-                if len(args[0]) < self.__hdr_len__:
-                    raise NeedData
-                raise UnpackError('invalid %s: %r' %
-                                  (self.__class__.__name__, args[0]))
+            self._unpack(args[0])
         else:
-            for k in self.__hdr_fields__:
+            for k, v in self.__hdr_immutable__:
+                setattr(self, k, v)
+            for k in self.__hdr_mutable__:
                 setattr(self, k, copy.copy(self.__hdr_defaults__[k]))
-            try:
-                ki = kwargs.iteritems()
-            except:
-                ki = kwargs.items()
-            for k, v in ki:
+            for k, v in kwargs.items():
                 setattr(self, k, v)
 
+    def _unpack(self, buf):
+        try:
+            self.unpack(buf)
+        except struct.error:
+            if len(buf) < self.__hdr_len__:
+                raise NeedData
+            raise UnpackError('invalid %s: %r' %
+                              (self.__class__.__name__, buf))
+
+    @classmethod
+    def unpack_into(cls, instance, buf, **attrs):
+        """Decode buf into an existing instance of cls instead of a new one.
+
+        The extra slots set by the previous unpack() are cleared first (see
+        _reset()), then attrs (options normally given to the constructor)
+        are assigned.
+        """
+        if cls.__extra_slot_names__:
+            instance._reset()
+        for k, v in attrs.items():
+            setattr(instance, k, v)
+        instance.data = b''
+        instance._unpack(buf)
+        return instance
+
+    def _reset(self):
+        """Drop the attributes unpack() added; classes with many extra
+        slots override this to delete only what was set."""
+        for name in self.__extra_slot_names__:
+            try:
+                object.__delattr__(self, name)
+            except AttributeError:
+                pass
+
+    def _reset_tracked(self):
+        """_reset() for classes whose unpack() records the names it sets
+        in the _dyn slot."""
+        try:
+            dyn = self._dyn
+        except AttributeError:
+            return
+        for name in dyn:
+            try:
+                object.__delattr__(self, name)
+            except AttributeError:
+                pass
+
+    @classmethod
+    def pack_into(cls, buffer, offset=0, **fields):
+        """Pack a header (and data=) into buffer at offset without creating
+        an instance, fields not given take their defaults. Returns the
+        number of bytes written."""
+        data = fields.pop('data', b'')
+        defaults = cls.__hdr_defaults__
+        vals = [fields.pop(k) if k in fields else defaults[k] for k in cls.__hdr_fields__]
+        if fields:
+            raise TypeError('unknown %s fields: %s' % (cls.__name__, ', '.join(fields)))
+        if data:
+            data = bytes(data)
+        # a slice assignment past the end would grow a bytearray instead
+        if offset + cls.__hdr_len__ + len(data) > len(buffer):
+            raise PackError('%s needs %d bytes at offset %d, buffer has %d' % (
+                cls.__name__, cls.__hdr_len__ + len(data), offset, len(buffer)))
+        try:
+            cls.__hdr_struct__.pack_into(buffer, offset, *vals)
+        except struct.error:
+            flat = []
+            for v in vals:
+                if isinstance(v, tuple):
+                    flat.extend(v)
+                else:
+                    flat.append(v)
+            try:
+                cls.__hdr_struct__.pack_into(buffer, offset, *flat)
+            except struct.error as e:
+                raise PackError(str(e))
+        end = offset + cls.__hdr_len__
+        if data:
+            buffer[end:end + len(data)] = data
+            end += len(data)
+        return end - offset
+
     def __len__(self):
         return self.__hdr_len__ + len(self.data)
 
@@ -129,10 +230,12 @@ class Packet(metaclass=_MetaPacket):
                         if isinstance(getattr(self.__class__, prop_name, None), property):
                             l.append('%s=%r' % (prop_name, getattr(self, prop_name)))
         # (3)
-        try:
-            di = self.__dict__.iteritems()
-        except:
-            di = self.__dict__.items()
+        di = list(getattr(self, '__dict__', {}).items())
+        for attr_name in self.__extra_slot_names__:
+            try:
+                di.append((attr_name, getattr(self, attr_name)))
+            except AttributeError:
+                pass
         l.extend(
             ['%s=%r' % (attr_name, attr_value)
              for attr_name, attr_value in di
@@ -152,8 +255,7 @@ class Packet(metaclass=_MetaPacket):
     def pack_hdr(self):
         """Return packed header string."""
         try:
-            return struct.pack(self.__hdr_fmt__,
-                               *[getattr(self, k) for k in self.__hdr_fields__])
+            return self.__hdr_struct__.pack(*[getattr(self, k) for k in self.__hdr_fields__])
         except struct.error:
             vals = []
             for k in self.__hdr_fields__:
@@ -174,10 +276,100 @@ class Packet(metaclass=_MetaPacket):
     def unpack(self, buf):
         """Unpack packet header fields from buf, and set self.data."""
         for k, v in zip(self.__hdr_fields__,
-                                   struct.unpack(self.__hdr_fmt__, buf[:self.__hdr_len__])):
+                        self.__hdr_struct__.unpack_from(buf)):
             setattr(self, k, v)
         self.data = buf[self.__hdr_len__:]
 
+class LazyDispatch(dict):
+    """Dispatch table (value -> Packet class) whose classes are imported on
+    first lookup.
+
+    add_lazy() registers a candidate (module, class) relative to the dpkt
+    package for a key; when several are registered the last one that can
+    be imported wins. Lookups of unknown keys raise KeyError as usual.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.pending = {}
+
+    def add_lazy(self, key, modname, clsname):
+        self.pending.setdefault(key, []).append((modname, clsname))
+
+    def __missing__(self, key):
+        candidates = self.pending.pop(key, ())
+        for modname, clsname in reversed(candidates):
+            try:
+                mod = importlib.import_module('.' + modname, __package__)
+                cls = getattr(mod, clsname)
+            except (ImportError, AttributeError):
+                continue
+            self[key] = cls
+            return cls
+        raise KeyError(key)
+
+    def resolve(self):
+        """Import everything still pending."""
+        for key in list(self.pending):
+            try:
+                self[key]
+            except KeyError:
+                pass
+
+    def copy(self):
+        table = LazyDispatch(self)
+        table.pending = dict((k, list(v)) for k, v in self.pending.items())
+        return table
+
+
+class Pool(object):
+    """Recycles decoded packets, one pool per decoding thread.
+
+    get() hands out an instance of cls decoded from buf, reusing one given
+    back by an earlier release(). Everything handed out stays valid until
+    the next release(); whoever needs a value past that must copy it.
+    """
+
+    def __init__(self):
+        self._free = {}
+        self._used = []
+        self.allocated = 0
+
+    def get(self, cls, buf, **attrs):
+        free = self._free.get(cls)
+        if free:
+            instance = free.pop()
+            if attrs:
+                self._used.append(instance)
+                return cls.unpack_into(instance, buf, **attrs)
+            # unpack_into() inlined for the nested headers
+            if cls.__extra_slot_names__:
+                instance._reset()
+        else:
+            instance = cls.__new__(cls)
+            self.allocated += 1
+            if attrs:
+                self._used.append(instance)
+                return cls.unpack_into(instance, buf, **attrs)
+        self._used.append(instance)
+        instance.data = b''
+        instance._unpack(buf)
+        return instance
+
+    def release(self):
+        free = self._free
+        for instance in self._used:
+            try:
+                free[instance.__class__].append(instance)
+            except KeyError:
+                free[instance.__class__] = [instance]
+        self._used.clear()
+
+    @property
+    def in_use(self):
+        return len(self._used)
+
+
 # XXX - ''.join([(len(`chr(x)`)==3) and chr(x) or '.' for x in range(256)])
 __vis_filter = b"""................................ !"#$%&\'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[.]^_`abcdefghijklmnopqrstuvwxyz{|}~................................................................................................................................."""
 
@@ -200,7 +392,7 @@ def in_cksum_add(s, buf):
     cnt = (n // 2) * 2
     a = array.array('H', buf[:cnt])
     if cnt != n:
-        a.append(struct.unpack('H', buf[-1] + '\x00')[0])
+        a.append(struct.unpack('H', buf[-1:] + b'\x00')[0])
     return s + sum(a)
 
 
@@ -232,6 +424,68 @@ def be32_to_cpu(v):
     else:
         return struct.unpack('>I', struct.pack('=I', v))
 
+def test_pool():
+    class Foo(Packet):
+        __hdr__ = (('foo', 'H', 0),)
+        __extra_slots__ = ('tail', 'opt')
+
+        def unpack(self, buf):
+            Packet.unpack(self, buf)
+            if self.foo == 1:
+                self.tail = self.data
+
+    pool = Pool()
+    a = pool.get(Foo, b'\x00\x01xy', opt=3)
+    assert (a.foo, a.tail, a.opt, pool.in_use) == (1, b'xy', 3, 1)
+    pool.release()
+    b = pool.get(Foo, b'\x00\x02z')
+    assert b is a and pool.allocated == 1
+    assert b.foo == 2 and b.data == b'z'
+    assert not hasattr(b, 'tail') and not hasattr(b, 'opt')
+    try:
+        pool.get(Foo, b'\x00')
+    except NeedData:
+        pass
+    else:
+        assert False
+    pool.release()
+    assert pool.in_use == 0 and pool.allocated == 2
+
+
+def test_pack_into():
+    class Foo(Packet):
+        __hdr__ = (('foo', 'I', 1), ('bar', 'H', 2), ('baz', '4s', b'quux'), ('opts', 'B', []))
+
+    a, b = Foo(), Foo(bar=3)
+    assert (a.foo, a.bar, a.baz, b.bar) == (1, 2, b'quux', 3)
+    assert a.opts == [] and a.opts is not b.opts
+
+    buf = bytearray(20)
+    n = Foo.pack_into(buf, 2, bar=3, opts=0, data=b'xy')
+    assert n == Foo.__hdr_len__ + 2
+    assert bytes(buf[2:2 + n]) == bytes(Foo(bar=3, opts=0, data=b'xy'))
+    # too small a buffer is an error, it is neither grown nor written
+    for data in (b'x' * 10, b''):
+        try:
+            Foo.pack_into(buf, 20 - n + 2 if data else 19, data=data)
+        except PackError:
+            pass
+        else:
+            assert False
+    assert len(buf) == 20 and bytes(buf[2:2 + n]) == bytes(Foo(bar=3, opts=0, data=b'xy'))
+    try:
+        Foo.pack_into(buf, 0, qux=1)
+    except TypeError:
+        pass
+    else:
+        assert False
+
+
+def test_in_cksum():
+    # odd length: the last byte is padded with zero
+    assert in_cksum(b'\x45\x00\x01') == in_cksum(b'\x45\x00\x01\x00')
+
+
 if __name__ == '__main__':
     print("%x" % cpu_to_le32(0x12345678))
     print("%x" % cpu_to_be32(0x12345678))
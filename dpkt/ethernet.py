@@ -51,7 +51,7 @@ class Ethernet(dpkt.Packet):
         ('src', '6s', ''),
         ('type', 'H', ETH_TYPE_IP)
     )
-    _typesw = {}
+    _typesw = dpkt.LazyDispatch()
 
     def _unpack_data(self, buf):
         if self.type == ETH_TYPE_8021Q:
@@ -116,25 +116,16 @@ class Ethernet(dpkt.Packet):
         return cls._typesw[t]
 
 
-# XXX - auto-load Ethernet dispatch table from ETH_TYPE_* definitions
+# XXX - auto-load Ethernet dispatch table from ETH_TYPE_* definitions,
+# the modules are imported on first use
 def __load_types():
-    g = globals()
-    try:
-        gi = g.iteritems()
-    except:
-        gi = g.items()
-    for k, v in gi:
+    for k, v in list(globals().items()):
         if k.startswith('ETH_TYPE_'):
             name = k[9:]
-            modname = name.lower()
-            try:
-                mod = __import__(modname, g, level=1)
-                Ethernet.set_type(v, getattr(mod, name))
-            except (ImportError, AttributeError):
-                continue
+            Ethernet._typesw.add_lazy(v, name.lower(), name)
 
 
-if not Ethernet._typesw:
+if not Ethernet._typesw.pending:
     __load_types()
 
 
@@ -124,4 +124,4 @@ class GRE(dpkt.Packet):
 # XXX - auto-load GRE dispatch table from Ethernet dispatch table
 from . import ethernet
 
-GRE._protosw.update(ethernet.Ethernet._typesw)
+GRE._protosw = ethernet.Ethernet._typesw.copy()
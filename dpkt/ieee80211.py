@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 """IEEE 802.11."""
 
+import array
+import collections
 import socket
 import struct
+import time
 import dpkt
 import sys
 from .decorators import deprecated
@@ -90,6 +93,9 @@ IE_HT_CAPA = 45
 IE_RSN = 48
 IE_ESR = 50
 IE_HT_INFO = 61
+IE_EXT_CAPA = 127
+IE_VHT_CAPA = 191
+IE_VENDOR = 221
 
 FCS_LENGTH = 4
 
@@ -109,6 +115,25 @@ _TID_MASK = 0xf000
 _COMPRESSED_BMP_LENGTH = 8
 _BMP_LENGTH = 128
 
+# Sequence control: frag_seq is unpacked big endian, the field is little endian
+_FRAG_MASK = 0x0f00
+_FRAG_SHIFT = 8
+
+
+class _SeqCtl(object):
+    """frag/seq accessors for headers carrying a frag_seq field."""
+
+    __slots__ = ()
+
+    @property
+    def seq(self):
+        return ((self.frag_seq & 0xff) << 4) | (self.frag_seq >> 12)
+
+    @property
+    def frag(self):
+        return (self.frag_seq & _FRAG_MASK) >> _FRAG_SHIFT
+
+
 # Action frame categories
 BLOCK_ACK = 3
 
@@ -116,12 +141,79 @@ BLOCK_ACK = 3
 BLOCK_ACK_CODE_REQUEST = 0
 BLOCK_ACK_CODE_RESPONSE = 1
 
+# Decode diagnostics reasons
+DIAG_UNKNOWN_SUBTYPE = 0
+DIAG_UNKNOWN_ACTION = 1
+DIAG_MALFORMED = 2
+_DIAG_REASONS = ('unknown_subtype', 'unknown_action', 'malformed')
+
+
+class DecodeDiagnostics(object):
+    """Counts frames the decoder could not handle per (type, subtype, reason).
+
+    With sample_every N > 0 every Nth offending frame is also kept in a ring
+    of the last max_samples raw frames.
+    """
+
+    def __init__(self, sample_every=0, max_samples=64):
+        self.counts = array.array('L', [0]) * (4 * 16 * len(_DIAG_REASONS))
+        self.sample_every = sample_every
+        self.samples = collections.deque(maxlen=max_samples)
+        self._skip = sample_every
+
+    def record(self, type, subtype, reason, buf=None):
+        self.counts[((type << 4) | subtype) * len(_DIAG_REASONS) + reason] += 1
+        if self.sample_every and buf is not None:
+            self._skip -= 1
+            if self._skip <= 0:
+                self._skip = self.sample_every
+                self.samples.append((time.time(), type, subtype, reason, bytes(buf)))
+
+    def set_sampling(self, sample_every, max_samples=None):
+        self.sample_every = self._skip = sample_every
+        if max_samples is not None:
+            self.samples = collections.deque(self.samples, maxlen=max_samples)
+
+    def total(self):
+        return sum(self.counts)
+
+    def reset(self):
+        self.counts = array.array('L', [0]) * len(self.counts)
+        self.samples.clear()
+
+    def to_dict(self):
+        n = len(_DIAG_REASONS)
+        counts = []
+        for i, count in enumerate(self.counts):
+            if count:
+                counts.append({'type': i // n >> 4, 'subtype': i // n & 0xf,
+                               'reason': _DIAG_REASONS[i % n], 'count': count})
+        samples = [{'time': t, 'type': type, 'subtype': subtype,
+                    'reason': _DIAG_REASONS[reason], 'frame': buf.hex()}
+                   for t, type, subtype, reason, buf in self.samples]
+        return {'counts': counts, 'samples': samples}
+
+
+# shared by all decoders, nothing is printed
+diagnostics = DecodeDiagnostics()
+
 
 class IEEE80211(dpkt.Packet):
     __hdr__ = (
         ('framectl', 'H', 0),
         ('duration', 'H', 0)
     )
+    # IEs without a name below are kept in _other_ies, see __getattr__
+    __extra_slots__ = (
+        'fcs_present', 'parse_ies', 'pool', '_dyn', 'fcs', 'mgmt', 'capability', 'qos_data',
+        # frame bodies
+        'beacon', 'assoc_req', 'assoc_resp', 'diassoc', 'reassoc_req', 'reassoc_resp',
+        'auth', 'probe_resp', 'deauth', 'action', 'rts', 'cts', 'ack', 'bar', 'back',
+        'cf_end', 'data_frame',
+        # information elements
+        'ies', '_other_ies', 'ssid', 'rate', 'fh', 'ds', 'cf', 'tim', 'ibss',
+        'ht_capa', 'esr', 'ht_info',
+    )
 
     @property
     def version(self):
@@ -280,8 +372,22 @@ class IEEE80211(dpkt.Packet):
     def _set_order(self, val): self.order = val
     # =================================================
 
-    def unpack_ies(self, buf):
+    def __getattr__(self, name):
+        # ie_<id> for IEs without a name
+        if name[:3] == 'ie_' and name != '_other_ies':
+            try:
+                return self._other_ies[int(name[3:])]
+            except (AttributeError, KeyError, ValueError):
+                pass
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+    def unpack_ies(self, buf, wanted=None):
+        """Decode the IEs in buf, only those with an id in wanted if given."""
         self.ies = []
+        self._other_ies = {}
+        dyn = self._dyn
+        dyn.append('ies')
+        dyn.append('_other_ies')
 
         ie_decoder = {
             IE_SSID: ('ssid', self.IE),
@@ -302,20 +408,31 @@ class IEEE80211(dpkt.Packet):
                 ie_id = struct.unpack('B', buf[0])[0]
             else:
                 ie_id = buf[0]
+            if wanted is not None and ie_id not in wanted:
+                buf = buf[2 + (buf[1] if sys.version_info >= (3,) else ord(buf[1])):]
+                continue
             try:
                 parser = ie_decoder[ie_id][1]
                 name = ie_decoder[ie_id][0]
             except KeyError:
                 parser = self.IE
-                name = 'ie_' + str(ie_id)
-            ie = parser(buf)
+                name = None
+            ie = self._decode(parser, buf)
 
             ie.data = buf[2:2 + ie.len]
-            setattr(self, name, ie)
+            if name is None:
+                self._other_ies[ie_id] = ie
+            else:
+                setattr(self, name, ie)
+                dyn.append(name)
             self.ies.append(ie)
             buf = buf[2 + ie.len:]
 
     class Capability(object):
+        __slots__ = ('ess', 'ibss', 'cf_poll', 'cf_poll_req', 'privacy', 'short_preamble',
+                     'pbcc', 'hopping', 'spec_mgmt', 'qos', 'short_slot', 'apsd', 'dsss',
+                     'delayed_blk_ack', 'imm_blk_ack')
+
         def __init__(self, field):
             self.ess = field & 1
             self.ibss = (field >> 1) & 1
@@ -338,12 +455,30 @@ class IEEE80211(dpkt.Packet):
             self.fcs_present = kwargs.pop('fcs')
         else:
             self.fcs_present = False
+        # ies=False skips decoding the information elements of mgmt frames,
+        # a set of IE ids decodes only those
+        self.parse_ies = kwargs.pop('ies', True)
+        # a dpkt.Pool to take the nested headers from
+        self.pool = kwargs.pop('pool', None)
 
         super(IEEE80211, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def unpack_into(cls, instance, buf, fcs=False, ies=True, pool=None):
+        return super(IEEE80211, cls).unpack_into(instance, buf, fcs_present=fcs, parse_ies=ies, pool=pool)
+
+    # with a pool, only the attributes recorded in _dyn are cleared
+    _reset = dpkt.Packet._reset_tracked
+
+    def _decode(self, cls, buf):
+        if self.pool is None:
+            return cls(buf)
+        return self.pool.get(cls, buf)
+
     def unpack(self, buf):
         dpkt.Packet.unpack(self, buf)
         self.data = buf[self.__hdr_len__:]
+        dyn = self._dyn = []
 
         m_decoder = {
             M_BEACON: ('beacon', self.Beacon),
@@ -394,13 +529,16 @@ class IEEE80211(dpkt.Packet):
         # Strip off the FCS field
         if self.fcs_present:
             self.fcs = struct.unpack('I', self.data[-1 * FCS_LENGTH:])[0]
+            dyn.append('fcs')
             self.data = self.data[0: -1 * FCS_LENGTH]
 
         if self.type == MGMT_TYPE:
-            self.mgmt = self.MGMT_Frame(self.data)
+            self.mgmt = self._decode(self.MGMT_Frame, self.data)
+            dyn.append('mgmt')
             self.data = self.mgmt.data
             if self.subtype == M_PROBE_REQ:
-                self.unpack_ies(self.data)
+                if self.parse_ies:
+                    self.unpack_ies(self.data, None if self.parse_ies is True else self.parse_ies)
                 return
             if self.subtype == M_ATIM:
                 return
@@ -409,7 +547,7 @@ class IEEE80211(dpkt.Packet):
             parser = decoder[self.type][self.subtype][1]
             name = decoder[self.type][self.subtype][0]
         except KeyError:
-            print("Key error:", self.type, self.subtype)
+            diagnostics.record(self.type, self.subtype, DIAG_UNKNOWN_SUBTYPE, buf)
             return
 
         if self.type == DATA_TYPE:
@@ -417,20 +555,24 @@ class IEEE80211(dpkt.Packet):
             parser = parser[self.to_ds * 10 + self.from_ds]
 
         if self.type == MGMT_TYPE:
-            field = parser(self.mgmt.data)
+            field = self._decode(parser, self.mgmt.data)
         else:
-            field = parser(self.data)
+            field = self._decode(parser, self.data)
             self.data = field
 
         setattr(self, name, field)
+        dyn.append(name)
 
         if self.type == MGMT_TYPE:
-            self.ies = self.unpack_ies(field.data)
+            if self.parse_ies:
+                self.unpack_ies(field.data, None if self.parse_ies is True else self.parse_ies)
             if self.subtype in FRAMES_WITH_CAPABILITY:
                 self.capability = self.Capability(socket.ntohs(field.capability))
+                dyn.append('capability')
 
         if self.type == DATA_TYPE and self.subtype == D_QOS_DATA:
-            self.qos_data = self.QoS_Data(field.data)
+            self.qos_data = self._decode(self.QoS_Data, field.data)
+            dyn.append('qos_data')
             field.data = self.qos_data.data
 
         self.data = field.data
@@ -442,6 +584,7 @@ class IEEE80211(dpkt.Packet):
             ('ctl', 'H', 0),
             ('seq', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class BlockAck(dpkt.Packet):
         __hdr__ = (
@@ -450,6 +593,7 @@ class IEEE80211(dpkt.Packet):
             ('ctl', 'H', 0),
             ('seq', 'H', 0),
         )
+        __extra_slots__ = ('bmp',)
 
         @property
         def compressed(self):
@@ -526,30 +670,35 @@ class IEEE80211(dpkt.Packet):
             ('dst', '6s', '\x00' * 6),
             ('src', '6s', '\x00' * 6)
         )
+        __extra_slots__ = ()
 
     class CTS(dpkt.Packet):
         __hdr__ = (
             ('dst', '6s', '\x00' * 6),
         )
+        __extra_slots__ = ()
 
     class ACK(dpkt.Packet):
         __hdr__ = (
             ('dst', '6s', '\x00' * 6),
         )
+        __extra_slots__ = ()
 
     class CFEnd(dpkt.Packet):
         __hdr__ = (
             ('dst', '6s', '\x00' * 6),
             ('src', '6s', '\x00' * 6),
         )
+        __extra_slots__ = ()
 
-    class MGMT_Frame(dpkt.Packet):
+    class MGMT_Frame(_SeqCtl, dpkt.Packet):
         __hdr__ = (
             ('dst', '6s', '\x00' * 6),
             ('src', '6s', '\x00' * 6),
             ('bssid', '6s', '\x00' * 6),
             ('frag_seq', 'H', 0)
         )
+        __extra_slots__ = ()
 
     class Beacon(dpkt.Packet):
         __hdr__ = (
@@ -557,17 +706,20 @@ class IEEE80211(dpkt.Packet):
             ('interval', 'H', 0),
             ('capability', 'H', 0)
         )
+        __extra_slots__ = ()
 
     class Disassoc(dpkt.Packet):
         __hdr__ = (
             ('reason', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class Assoc_Req(dpkt.Packet):
         __hdr__ = (
             ('capability', 'H', 0),
             ('interval', 'H', 0)
         )
+        __extra_slots__ = ()
 
     class Assoc_Resp(dpkt.Packet):
         __hdr__ = (
@@ -575,6 +727,7 @@ class IEEE80211(dpkt.Packet):
             ('status', 'H', 0),
             ('aid', 'H', 0)
         )
+        __extra_slots__ = ()
 
     class Reassoc_Req(dpkt.Packet):
         __hdr__ = (
@@ -582,6 +735,7 @@ class IEEE80211(dpkt.Packet):
             ('interval', 'H', 0),
             ('current_ap', '6s', '\x00' * 6)
         )
+        __extra_slots__ = ()
 
     # This obviously doesn't support any of AUTH frames that use encryption
     class Auth(dpkt.Packet):
@@ -589,17 +743,20 @@ class IEEE80211(dpkt.Packet):
             ('algorithm', 'H', 0),
             ('auth_seq', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class Deauth(dpkt.Packet):
         __hdr__ = (
             ('reason', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class Action(dpkt.Packet):
         __hdr__ = (
             ('category', 'B', 0),
             ('code', 'B', 0),
         )
+        __extra_slots__ = ('block_ack_request', 'block_ack_response')
 
         def unpack(self, buf):
             dpkt.Packet.unpack(self, buf)
@@ -616,8 +773,8 @@ class IEEE80211(dpkt.Packet):
                 field = decoder(self.data)
                 setattr(self, field_name, field)
                 self.data = field.data
-            except KeyError as e:
-                print('ActionFrame: cannot decoder category %d code %d' % (self.category, self.code))
+            except KeyError:
+                diagnostics.record(MGMT_TYPE, M_ACTION, DIAG_UNKNOWN_ACTION, buf)
 
     class BlockAckActionRequest(dpkt.Packet):
         __hdr__ = (
@@ -635,31 +792,34 @@ class IEEE80211(dpkt.Packet):
             ('timeout', 'H', 0),
         )
 
-    class Data(dpkt.Packet):
+    class Data(_SeqCtl, dpkt.Packet):
         __hdr__ = (
             ('dst', '6s', '\x00' * 6),
             ('src', '6s', '\x00' * 6),
             ('bssid', '6s', '\x00' * 6),
             ('frag_seq', 'H', 0)
         )
+        __extra_slots__ = ()
 
-    class DataFromDS(dpkt.Packet):
+    class DataFromDS(_SeqCtl, dpkt.Packet):
         __hdr__ = (
             ('dst', '6s', '\x00' * 6),
             ('bssid', '6s', '\x00' * 6),
             ('src', '6s', '\x00' * 6),
             ('frag_seq', 'H', 0)
         )
+        __extra_slots__ = ()
 
-    class DataToDS(dpkt.Packet):
+    class DataToDS(_SeqCtl, dpkt.Packet):
         __hdr__ = (
             ('bssid', '6s', '\x00' * 6),
             ('src', '6s', '\x00' * 6),
             ('dst', '6s', '\x00' * 6),
             ('frag_seq', 'H', 0)
         )
+        __extra_slots__ = ()
 
-    class DataInterDS(dpkt.Packet):
+    class DataInterDS(_SeqCtl, dpkt.Packet):
         __hdr__ = (
             ('dst', '6s', '\x00' * 6),
             ('src', '6s', '\x00' * 6),
@@ -667,22 +827,28 @@ class IEEE80211(dpkt.Packet):
             ('frag_seq', 'H', 0),
             ('sa', '6s', '\x00' * 6)
         )
+        __extra_slots__ = ()
 
     class QoS_Data(dpkt.Packet):
         __hdr__ = (
             ('control', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class IE(dpkt.Packet):
         __hdr__ = (
             ('id', 'B', 0),
             ('len', 'B', 0)
         )
+        __extra_slots__ = ('info',)
 
         def unpack(self, buf):
             dpkt.Packet.unpack(self, buf)
             self.info = buf[2:self.len + 2]
 
+        def _reset(self):
+            pass    # unpack() always sets info
+
     class FH(dpkt.Packet):
         __hdr__ = (
             ('id', 'B', 0),
@@ -692,6 +858,7 @@ class IEEE80211(dpkt.Packet):
             ('hoppattern', 'B', 0),
             ('hopindex', 'B', 0)
         )
+        __extra_slots__ = ()
 
     class DS(dpkt.Packet):
         __hdr__ = (
@@ -699,6 +866,7 @@ class IEEE80211(dpkt.Packet):
             ('len', 'B', 0),
             ('ch', 'B', 0)
         )
+        __extra_slots__ = ()
 
     class CF(dpkt.Packet):
         __hdr__ = (
@@ -709,6 +877,7 @@ class IEEE80211(dpkt.Packet):
             ('max', 'H', 0),
             ('dur', 'H', 0)
         )
+        __extra_slots__ = ()
 
     class TIM(dpkt.Packet):
         __hdr__ = (
@@ -718,17 +887,22 @@ class IEEE80211(dpkt.Packet):
             ('period', 'B', 0),
             ('ctrl', 'H', 0)
         )
+        __extra_slots__ = ('bitmap',)
 
         def unpack(self, buf):
             dpkt.Packet.unpack(self, buf)
             self.bitmap = buf[5:self.len + 2]
 
+        def _reset(self):
+            pass    # unpack() always sets bitmap
+
     class IBSS(dpkt.Packet):
         __hdr__ = (
             ('id', 'B', 0),
             ('len', 'B', 0),
             ('atim', 'H', 0)
         )
+        __extra_slots__ = ()
 
 def test_802211_ack():
     s = b'\xd4\x00\x00\x00\x00\x12\xf0\xb6\x1c\xa4\xff\xff\xff\xff'
@@ -746,8 +920,13 @@ def test_802211_ack():
     fcs = struct.unpack('I', s[-4:])[0]
     assert ieee.fcs == fcs
 
+
+# a beacon with FCS, also used by the radiotap tests
+_TEST_BEACON = b'\x80\x00\x00\x00\xff\xff\xff\xff\xff\xff\x00\x26\xcb\x18\x6a\x30\x00\x26\xcb\x18\x6a\x30\xa0\xd0\x77\x09\x32\x03\x8f\x00\x00\x00\x66\x00\x31\x04\x00\x04\x43\x41\x45\x4e\x01\x08\x82\x84\x8b\x0c\x12\x96\x18\x24\x03\x01\x01\x05\x04\x00\x01\x00\x00\x07\x06\x55\x53\x20\x01\x0b\x1a\x0b\x05\x00\x00\x6e\x00\x00\x2a\x01\x02\x2d\x1a\x6e\x18\x1b\xff\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x30\x14\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x01\x28\x00\x32\x04\x30\x48\x60\x6c\x36\x03\x51\x63\x03\x3d\x16\x01\x00\x05\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x85\x1e\x05\x00\x8f\x00\x0f\x00\xff\x03\x59\x00\x63\x73\x65\x2d\x33\x39\x31\x32\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x36\x96\x06\x00\x40\x96\x00\x14\x00\xdd\x18\x00\x50\xf2\x02\x01\x01\x80\x00\x03\xa4\x00\x00\x27\xa4\x00\x00\x42\x43\x5e\x00\x62\x32\x2f\x00\xdd\x06\x00\x40\x96\x01\x01\x04\xdd\x05\x00\x40\x96\x03\x05\xdd\x05\x00\x40\x96\x0b\x09\xdd\x08\x00\x40\x96\x13\x01\x00\x34\x01\xdd\x05\x00\x40\x96\x14\x05'
+
+
 def test_80211_beacon():
-    s = b'\x80\x00\x00\x00\xff\xff\xff\xff\xff\xff\x00\x26\xcb\x18\x6a\x30\x00\x26\xcb\x18\x6a\x30\xa0\xd0\x77\x09\x32\x03\x8f\x00\x00\x00\x66\x00\x31\x04\x00\x04\x43\x41\x45\x4e\x01\x08\x82\x84\x8b\x0c\x12\x96\x18\x24\x03\x01\x01\x05\x04\x00\x01\x00\x00\x07\x06\x55\x53\x20\x01\x0b\x1a\x0b\x05\x00\x00\x6e\x00\x00\x2a\x01\x02\x2d\x1a\x6e\x18\x1b\xff\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x30\x14\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x01\x28\x00\x32\x04\x30\x48\x60\x6c\x36\x03\x51\x63\x03\x3d\x16\x01\x00\x05\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x85\x1e\x05\x00\x8f\x00\x0f\x00\xff\x03\x59\x00\x63\x73\x65\x2d\x33\x39\x31\x32\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x36\x96\x06\x00\x40\x96\x00\x14\x00\xdd\x18\x00\x50\xf2\x02\x01\x01\x80\x00\x03\xa4\x00\x00\x27\xa4\x00\x00\x42\x43\x5e\x00\x62\x32\x2f\x00\xdd\x06\x00\x40\x96\x01\x01\x04\xdd\x05\x00\x40\x96\x03\x05\xdd\x05\x00\x40\x96\x0b\x09\xdd\x08\x00\x40\x96\x13\x01\x00\x34\x01\xdd\x05\x00\x40\x96\x14\x05'
+    s = _TEST_BEACON
     ieee = IEEE80211(s, fcs=True)
     assert ieee.version == 0
     assert ieee.type == MGMT_TYPE
@@ -766,17 +945,33 @@ def test_80211_beacon():
     assert ieee.rate.data == b'\x82\x84\x8b\x0c\x12\x96\x18\x24'
     assert ieee.ds.data == b'\x01'
     assert ieee.tim.data == b'\x00\x01\x00\x00'
+    assert ieee.ies[0] is ieee.ssid
     fcs = struct.unpack('I', s[-4:])[0]
     assert ieee.fcs == fcs
 
+    ieee = IEEE80211(s, fcs=True, ies=False)
+    assert ieee.beacon.capability == 0x3104
+    assert not hasattr(ieee, 'ies') and not hasattr(ieee, 'ssid')
+    ieee = IEEE80211(s, fcs=True, ies=frozenset([IE_SSID, IE_DS]))
+    assert [ie.id for ie in ieee.ies] == [IE_SSID, IE_DS]
+    assert ieee.ssid.data == b'CAEN' and ieee.ds.ch == 1
+    assert not hasattr(ieee, 'rate') and not hasattr(ieee, 'ie_48')
+
+
+# a data frame to the DS with FCS, also used by the radiotap tests
+_TEST_DATA = b'\x08\x09\x20\x00\x00\x26\xcb\x17\x3d\x91\x00\x16\x44\xb0\xae\xc6\x00\x02\xb3\xd6\x26\x3c\x80\x7e\xaa\xaa\x03\x00\x00\x00\x08\x00\x45\x00\x00\x28\x07\x27\x40\x00\x80\x06\x1d\x39\x8d\xd4\x37\x3d\x3f\xf5\xd1\x69\xc0\x5f\x01\xbb\xb2\xd6\xef\x23\x38\x2b\x4f\x08\x50\x10\x42\x04\xac\x17\x00\x00'
+
+
 def test_80211_data():
-    s = b'\x08\x09\x20\x00\x00\x26\xcb\x17\x3d\x91\x00\x16\x44\xb0\xae\xc6\x00\x02\xb3\xd6\x26\x3c\x80\x7e\xaa\xaa\x03\x00\x00\x00\x08\x00\x45\x00\x00\x28\x07\x27\x40\x00\x80\x06\x1d\x39\x8d\xd4\x37\x3d\x3f\xf5\xd1\x69\xc0\x5f\x01\xbb\xb2\xd6\xef\x23\x38\x2b\x4f\x08\x50\x10\x42\x04\xac\x17\x00\x00'
+    s = _TEST_DATA
     ieee = IEEE80211(s, fcs=True)
     assert ieee.type == DATA_TYPE
     assert ieee.subtype == D_DATA
     assert ieee.data_frame.dst == b'\x00\x02\xb3\xd6\x26\x3c'
     assert ieee.data_frame.src == b'\x00\x16\x44\xb0\xae\xc6'
     assert ieee.data_frame.frag_seq == 0x807e
+    assert ieee.data_frame.seq == 0x7e8
+    assert ieee.data_frame.frag == 0
     assert ieee.data == b'\xaa\xaa\x03\x00\x00\x00\x08\x00\x45\x00\x00\x28\x07\x27\x40\x00\x80\x06\x1d\x39\x8d\xd4\x37\x3d\x3f\xf5\xd1\x69\xc0\x5f\x01\xbb\xb2\xd6\xef\x23\x38\x2b\x4f\x08\x50\x10\x42\x04'
     assert ieee.fcs == struct.unpack('I', b'\xac\x17\x00\x00')[0]
 
@@ -871,6 +1066,26 @@ def test_action_block_ack_response():
     parameters = struct.unpack('H', b'\x10\x02')[0]
     assert ieee.action.block_ack_response.parameters == parameters
 
+def test_diagnostics():
+    diag = DecodeDiagnostics(sample_every=2, max_samples=2)
+    for i in range(5):
+        diag.record(CTL_TYPE, C_PS_POLL, DIAG_UNKNOWN_SUBTYPE, bytes([i]))
+    diag.record(MGMT_TYPE, M_ACTION, DIAG_UNKNOWN_ACTION)
+    d = diag.to_dict()
+    assert d['counts'] == [
+        {'type': MGMT_TYPE, 'subtype': M_ACTION, 'reason': 'unknown_action', 'count': 1},
+        {'type': CTL_TYPE, 'subtype': C_PS_POLL, 'reason': 'unknown_subtype', 'count': 5},
+    ]
+    assert [s['frame'] for s in d['samples']] == ['01', '03']
+    diag.reset()
+    assert diag.total() == 0 and not diag.samples
+
+    # PS-Poll has no decoder, it is counted instead of printed
+    before = diagnostics.total()
+    IEEE80211(b'\xa4\x10\x01\xc0' + b'\x00\x11\x22\x33\x44\x55' * 2)
+    assert diagnostics.total() == before + 1
+
+
 if __name__ == '__main__':
     # Runs all the test associated with this class/file
     test_802211_ack()
@@ -882,4 +1097,5 @@ if __name__ == '__main__':
     test_compressed_block_ack()
     test_action_block_ack_request()
     test_action_block_ack_response()
+    test_diagnostics()
     print('Tests Successful...')
@@ -19,7 +19,7 @@ class IP(dpkt.Packet):
         ('src', '4s', b'\x00' * 4),
         ('dst', '4s', b'\x00' * 4)
     )
-    _protosw = {}
+    _protosw = dpkt.LazyDispatch()
     opts = b''
     
     def __init__(self, *args, **kwargs):
@@ -305,21 +305,12 @@ IP_PROTO_MAX = 255
 
 
 def __load_protos():
-    g = globals()
-    try:
-        gi = g.iteritems()
-    except:
-        gi = g.items()
-    for k, v in gi:
+    for k, v in list(globals().items()):
         if k.startswith('IP_PROTO_'):
             name = k[9:].lower()
-            try:
-                mod = __import__(name, g, level=1)
-                IP.set_proto(v, getattr(mod, name.upper()))
-            except (ImportError, AttributeError):
-                continue
+            IP._protosw.add_lazy(v, name, name.upper())
 
-if not IP._protosw:
+if not IP._protosw.pending:
     __load_protos()
 
 
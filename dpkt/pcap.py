@@ -3,6 +3,7 @@
 """Libpcap file format."""
 
 import sys
+import struct
 import time
 import dpkt
 try:
@@ -127,6 +128,7 @@ class Reader(object):
             self.dloff = 0
         self.snaplen = self.__fh.snaplen
         self.filter = b''
+        self.__match = None
         self.__iter = iter(self)
 
     @property
@@ -140,7 +142,12 @@ class Reader(object):
         return self.__fh.linktype
 
     def setfilter(self, value, optimize=1):
-        return NotImplementedError
+        """Only return packets matching value, see dpkt.pfilter."""
+        from . import pfilter
+        if isinstance(value, bytes):
+            value = value.decode('ascii')
+        self.__match = pfilter.compile_filter(value, self.datalink()) if value else None
+        self.filter = value
 
     def readpkts(self):
         return list(self)
@@ -179,13 +186,17 @@ class Reader(object):
         self.dispatch(0, callback, *args)
 
     def __iter__(self):
+        # headers are unpacked with struct directly, no Packet per record
+        unpack = self.__ph.__hdr_struct__.unpack
         while 1:
             buf = self.__f.read(PktHdr.__hdr_len__)
-            if not buf:
+            if len(buf) < PktHdr.__hdr_len__:
                 break
-            hdr = self.__ph(buf)
-            buf = self.__f.read(hdr.caplen)
-            yield (hdr.tv_sec + (hdr.tv_usec / 1000000.0), buf)
+            tv_sec, tv_usec, caplen, _ = unpack(buf)
+            buf = self.__f.read(caplen)
+            if self.__match is not None and not self.__match(buf):
+                continue
+            yield (tv_sec + (tv_usec / 1000000.0), buf)
 
 
 def test_pcap_endian():
@@ -240,6 +251,18 @@ def test_reader():
     assert reader.dispatch(1, lambda ts, pkt: None) == 1
     assert reader.dispatch(1, lambda ts, pkt: None) == 0
 
+    # --- setfilter() tests ---
+
+    fobj.seek(0)
+    reader = Reader(fobj)
+    reader.setfilter('ip proto udp and ether dst 00:c0:9f:32:41:8c')
+    assert len(reader.readpkts()) == 1
+
+    fobj.seek(0)
+    reader = Reader(fobj)
+    reader.setfilter('ip proto tcp')
+    assert reader.readpkts() == []
+
 
 if __name__ == '__main__':
     test_pcap_endian()
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""Offline capture filters.
+
+A small tcpdump-like language compiled into a Python function that tests
+offsets and masks directly on the raw frame, so rejected frames are never
+decoded into Packet objects. Used by pcap.Reader.setfilter() and
+snoop.Reader.setfilter().
+
+Primitives::
+
+    link <en10mb|ieee802_11|ieee802_11_radio|number>
+    type <mgmt|ctl|data>
+    subtype <beacon|probe_req|...|qos_data|...>
+    wlan <addr1|addr2|addr3|ra|ta|src|dst|host> <mac>
+    bssid <mac>
+    rssi <op> <dBm>                  op: < <= > >= == !=
+    ether <src|dst|host> <mac>
+    ether proto <number|ip|ip6|arp>
+    ip proto <number|icmp|tcp|udp|...>
+    ip6 proto <number|tcp|udp|icmp6|...>
+    ip | ip6 | arp
+
+combined with and/&&, or/||, not/! and parentheses.
+"""
+
+import struct
+from . import ieee80211
+
+DLT_EN10MB = 1
+DLT_IEEE802_11 = 105
+DLT_IEEE802_11_RADIO = 127
+
+_LINKS = {
+    'en10mb': DLT_EN10MB,
+    'ether': DLT_EN10MB,
+    'ieee802_11': DLT_IEEE802_11,
+    'ieee802_11_radio': DLT_IEEE802_11_RADIO,
+    'radiotap': DLT_IEEE802_11_RADIO,
+}
+
+_WLAN_TYPES = {
+    'mgmt': ieee80211.MGMT_TYPE,
+    'ctl': ieee80211.CTL_TYPE,
+    'data': ieee80211.DATA_TYPE,
+}
+
+_WLAN_SUBTYPES = {
+    'assoc_req': (ieee80211.MGMT_TYPE, ieee80211.M_ASSOC_REQ),
+    'assoc_resp': (ieee80211.MGMT_TYPE, ieee80211.M_ASSOC_RESP),
+    'reassoc_req': (ieee80211.MGMT_TYPE, ieee80211.M_REASSOC_REQ),
+    'reassoc_resp': (ieee80211.MGMT_TYPE, ieee80211.M_REASSOC_RESP),
+    'probe_req': (ieee80211.MGMT_TYPE, ieee80211.M_PROBE_REQ),
+    'probe_resp': (ieee80211.MGMT_TYPE, ieee80211.M_PROBE_RESP),
+    'beacon': (ieee80211.MGMT_TYPE, ieee80211.M_BEACON),
+    'atim': (ieee80211.MGMT_TYPE, ieee80211.M_ATIM),
+    'disassoc': (ieee80211.MGMT_TYPE, ieee80211.M_DISASSOC),
+    'auth': (ieee80211.MGMT_TYPE, ieee80211.M_AUTH),
+    'deauth': (ieee80211.MGMT_TYPE, ieee80211.M_DEAUTH),
+    'action': (ieee80211.MGMT_TYPE, ieee80211.M_ACTION),
+    'bar': (ieee80211.CTL_TYPE, ieee80211.C_BLOCK_ACK_REQ),
+    'back': (ieee80211.CTL_TYPE, ieee80211.C_BLOCK_ACK),
+    'ps_poll': (ieee80211.CTL_TYPE, ieee80211.C_PS_POLL),
+    'rts': (ieee80211.CTL_TYPE, ieee80211.C_RTS),
+    'cts': (ieee80211.CTL_TYPE, ieee80211.C_CTS),
+    'ack': (ieee80211.CTL_TYPE, ieee80211.C_ACK),
+    'cf_end': (ieee80211.CTL_TYPE, ieee80211.C_CF_END),
+    'cf_end_ack': (ieee80211.CTL_TYPE, ieee80211.C_CF_END_ACK),
+    'data': (ieee80211.DATA_TYPE, ieee80211.D_DATA),
+    'null': (ieee80211.DATA_TYPE, ieee80211.D_NULL),
+    'qos_data': (ieee80211.DATA_TYPE, ieee80211.D_QOS_DATA),
+    'qos_null': (ieee80211.DATA_TYPE, ieee80211.D_QOS_NULL),
+}
+
+# offsets of the address fields from the start of the 802.11 header
+_WLAN_ADDRS = {
+    'addr1': 4, 'ra': 4, 'dst': 4,
+    'addr2': 10, 'ta': 10, 'src': 10,
+    'addr3': 16,
+}
+
+_ETHER_TYPES = {'ip': 0x0800, 'arp': 0x0806, 'ip6': 0x86dd}
+
+_IP_PROTOS = {'icmp': 1, 'igmp': 2, 'tcp': 6, 'udp': 17, 'gre': 47,
+              'esp': 50, 'ah': 51, 'icmp6': 58, 'sctp': 132}
+
+_OPS = ('<', '<=', '>', '>=', '==', '!=')
+
+_U32 = struct.Struct('<I')
+
+# (size, alignment) of the radiotap fields in front of the antenna signal
+_RT_FIELDS = ((8, 8), (1, 1), (1, 1), (4, 2), (2, 1))
+_RT_ANT_SIG_MASK = 1 << 5
+_RT_EXT_MASK = 1 << 31
+
+
+def radiotap_signal(buf):
+    """Return the radiotap antenna signal in dBm, or None if absent."""
+    present = _U32.unpack_from(buf, 4)[0]
+    if not present & _RT_ANT_SIG_MASK:
+        return None
+    off = 8
+    p = present
+    while p & _RT_EXT_MASK:
+        p = _U32.unpack_from(buf, off)[0]
+        off += 4
+    for bit in range(5):
+        if present & (1 << bit):
+            size, align = _RT_FIELDS[bit]
+            off = (off + align - 1) & ~(align - 1)
+            off += size
+    v = buf[off]
+    return v - 256 if v > 127 else v
+
+
+def ether_type(buf):
+    """Return (ethertype, offset of the payload), looking through 802.1Q."""
+    t = buf[12] << 8 | buf[13]
+    if t == 0x8100:
+        return buf[16] << 8 | buf[17], 18
+    return t, 14
+
+
+def wlan_bssid(buf, off):
+    """Return the BSSID of the 802.11 header at off, or None."""
+    fc = buf[off]
+    if fc & 0x0c == 0x04:   # control frames carry no BSSID
+        return None
+    ds = buf[off + 1] & 0x03
+    if ds == 0:
+        return buf[off + 16:off + 22]
+    elif ds == 1:           # to_ds
+        return buf[off + 4:off + 10]
+    elif ds == 2:           # from_ds
+        return buf[off + 10:off + 16]
+    return None
+
+
+class FilterError(ValueError):
+    pass
+
+
+def _mac(s):
+    try:
+        b = bytes(int(x, 16) for x in s.split(':'))
+    except ValueError:
+        b = b''
+    if len(b) != 6:
+        raise FilterError('invalid MAC address %r' % s)
+    return b
+
+
+def _number(s, names=None):
+    if names and s in names:
+        return names[s]
+    try:
+        return int(s, 0)
+    except ValueError:
+        raise FilterError('expected a number, got %r' % s)
+
+
+def _tokenize(text):
+    for c in '()!':
+        text = text.replace(c, ' %s ' % c)
+    # '!' was split off above, glue '!=' back together
+    text = text.replace(' ! =', ' !=')
+    return text.split()
+
+
+class _Compiler(object):
+
+    def __init__(self, text, linktype):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+        self.linktype = linktype
+        self.consts = {}
+        self.uses_wlan = False
+        self.uses_ether = False
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        tok = self.peek()
+        if tok is None:
+            raise FilterError('unexpected end of filter')
+        self.pos += 1
+        return tok
+
+    def const(self, value):
+        name = '_k%d' % len(self.consts)
+        self.consts[name] = value
+        return name
+
+    def parse(self):
+        if self.peek() is None:
+            return 'True'
+        expr = self.expr()
+        if self.peek() is not None:
+            raise FilterError('unexpected %r' % self.peek())
+        return expr
+
+    def expr(self):
+        terms = [self.term()]
+        while self.peek() in ('or', '||'):
+            self.next()
+            terms.append(self.term())
+        return terms[0] if len(terms) == 1 else '(%s)' % ' or '.join(terms)
+
+    def term(self):
+        factors = [self.factor()]
+        while self.peek() in ('and', '&&'):
+            self.next()
+            factors.append(self.factor())
+        return factors[0] if len(factors) == 1 else '(%s)' % ' and '.join(factors)
+
+    def factor(self):
+        tok = self.next()
+        if tok in ('not', '!'):
+            return '(not %s)' % self.factor()
+        if tok == '(':
+            e = self.expr()
+            if self.next() != ')':
+                raise FilterError('expected )')
+            return e
+        return self.primitive(tok)
+
+    def wlan(self):
+        if self.linktype not in (DLT_IEEE802_11, DLT_IEEE802_11_RADIO):
+            return None
+        self.uses_wlan = True
+        return 'W'
+
+    def ether(self):
+        if self.linktype != DLT_EN10MB:
+            return None
+        self.uses_ether = True
+        return 'E'
+
+    def primitive(self, tok):
+        if tok == 'link':
+            arg = self.next()
+            return 'True' if _number(arg, _LINKS) == self.linktype else 'False'
+
+        if tok == 'type':
+            t = self.next()
+            if t not in _WLAN_TYPES:
+                raise FilterError('unknown frame type %r' % t)
+            if self.wlan() is None:
+                return 'False'
+            return '(b[W] & 0x0c == %d)' % (_WLAN_TYPES[t] << 2)
+
+        if tok == 'subtype':
+            st = self.next()
+            if st not in _WLAN_SUBTYPES:
+                raise FilterError('unknown frame subtype %r' % st)
+            if self.wlan() is None:
+                return 'False'
+            t, st = _WLAN_SUBTYPES[st]
+            return '(b[W] & 0xfc == %d)' % ((st << 4) | (t << 2))
+
+        if tok == 'wlan':
+            which = self.next()
+            mac = self.const(_mac(self.next()))
+            if self.wlan() is None:
+                return 'False'
+            if which == 'host':
+                return '(%s in (b[W+4:W+10], b[W+10:W+16], b[W+16:W+22]))' % mac
+            if which not in _WLAN_ADDRS:
+                raise FilterError('unknown wlan address %r' % which)
+            off = _WLAN_ADDRS[which]
+            return '(b[W+%d:W+%d] == %s)' % (off, off + 6, mac)
+
+        if tok == 'bssid':
+            mac = self.const(_mac(self.next()))
+            if self.wlan() is None:
+                return 'False'
+            return '(wlan_bssid(b, W) == %s)' % mac
+
+        if tok == 'rssi':
+            op = self.next()
+            if op not in _OPS:
+                raise FilterError('unknown operator %r' % op)
+            val = _number(self.next())
+            if self.linktype != DLT_IEEE802_11_RADIO:
+                return 'False'
+            return '((s := radiotap_signal(b)) is not None and s %s %d)' % (op, val)
+
+        if tok == 'ether':
+            which = self.next()
+            if which == 'proto':
+                t = _number(self.next(), _ETHER_TYPES)
+                return 'False' if self.ether() is None else '(E[0] == %d)' % t
+            mac = self.const(_mac(self.next()))
+            if self.ether() is None:
+                return 'False'
+            if which == 'src':
+                return '(b[6:12] == %s)' % mac
+            elif which == 'dst':
+                return '(b[0:6] == %s)' % mac
+            elif which == 'host':
+                return '(%s in (b[0:6], b[6:12]))' % mac
+            raise FilterError('unknown ether qualifier %r' % which)
+
+        if tok in ('ip', 'ip6', 'arp'):
+            is_ether = self.ether() is not None
+            etype = '(E[0] == %d)' % _ETHER_TYPES[tok]
+            if self.peek() == 'proto' and tok != 'arp':
+                self.next()
+                p = _number(self.next(), _IP_PROTOS)
+                if not is_ether:
+                    return 'False'
+                # protocol byte: IPv4 offset 9, IPv6 next header offset 6
+                return '(%s and b[E[1]+%d] == %d)' % (etype, 9 if tok == 'ip' else 6, p)
+            return etype if is_ether else 'False'
+
+        raise FilterError('unknown primitive %r' % tok)
+
+
+def compile_filter(text, linktype):
+    """Compile text for captures of the given DLT_* link type and return a
+    function that takes a raw frame and returns True if it matches."""
+    c = _Compiler(text, linktype)
+    expr = c.parse()
+    lines = ['def match(b):', '    try:']
+    if c.uses_wlan:
+        if linktype == DLT_IEEE802_11_RADIO:
+            lines.append('        W = b[2] | b[3] << 8')
+        else:
+            lines.append('        W = 0')
+    if c.uses_ether:
+        lines.append('        E = ether_type(b)')
+    lines.append('        return %s' % expr)
+    lines.append('    except (IndexError, struct.error):')
+    lines.append('        return False')
+    ns = dict(c.consts)
+    ns.update(struct=struct, radiotap_signal=radiotap_signal,
+              ether_type=ether_type, wlan_bssid=wlan_bssid)
+    exec(compile('\n'.join(lines), '<filter %r>' % text, 'exec'), ns)
+    return ns['match']
+
+
+def test_wlan_filter():
+    # radiotap: flags, rate, channel, antenna signal -70 dBm
+    rt = b'\x00\x00\x10\x00\x2e\x00\x00\x00\x00\x02\x6c\x09\xa0\x00\xba\x00'
+    ap = b'\x00\x26\xcb\x18\x6a\x30'
+    sta = b'\x00\x11\x22\x33\x44\x55'
+    beacon = rt + b'\x80\x00\x00\x00' + b'\xff' * 6 + ap + ap + b'\x00' * 14
+    probe = rt + b'\x40\x00\x00\x00' + b'\xff' * 6 + sta + b'\xff' * 6 + b'\x00' * 4
+    to_ds = rt + b'\x08\x01\x00\x00' + ap + sta + b'\xff' * 6 + b'\x00' * 4
+    ack = rt + b'\xd4\x00\x00\x00' + sta
+
+    def sel(text, *pkts):
+        f = compile_filter(text, DLT_IEEE802_11_RADIO)
+        return [f(p) for p in pkts]
+
+    assert sel('subtype beacon or subtype probe_req', beacon, probe, to_ds, ack) == [True, True, False, False]
+    assert sel('not type ctl', beacon, ack) == [True, False]
+    assert sel('bssid 00:26:cb:18:6a:30', beacon, probe, to_ds, ack) == [True, False, True, False]
+    assert sel('wlan src 00:11:22:33:44:55 and type data', probe, to_ds) == [False, True]
+    assert sel('rssi >= -70 and rssi < -60', beacon) == [True]
+    assert sel('rssi > -70', beacon) == [False]
+    assert sel('link ieee802_11_radio && (type mgmt)', beacon) == [True]
+    assert sel('ip proto tcp', beacon) == [False]
+    assert sel('', beacon) == [True]
+    # truncated frames are rejected rather than raising
+    assert sel('bssid 00:26:cb:18:6a:30', rt + b'\x80') == [False]
+    assert radiotap_signal(rt) == -70
+
+
+def test_ether_filter():
+    tcp = (b'\x00\x01\x02\x03\x04\x05\x00\x0a\x0b\x0c\x0d\x0e\x08\x00'
+           b'\x45\x00\x00\x28\x00\x00\x00\x00\x40\x06' + b'\x00' * 30)
+    vlan_udp = (b'\x00\x01\x02\x03\x04\x05\x00\x0a\x0b\x0c\x0d\x0e\x81\x00\x00\x05\x08\x00'
+                b'\x45\x00\x00\x28\x00\x00\x00\x00\x40\x11' + b'\x00' * 30)
+    f = compile_filter('ether proto ip and (ip proto tcp or ip proto 17)', DLT_EN10MB)
+    assert f(tcp) and f(vlan_udp)
+    f = compile_filter('ether src 00:0a:0b:0c:0d:0e and not ip proto udp', DLT_EN10MB)
+    assert f(tcp) and not f(vlan_udp)
+    assert not compile_filter('type mgmt', DLT_EN10MB)(tcp)
+    try:
+        compile_filter('bogus', DLT_EN10MB)
+    except FilterError:
+        pass
+    else:
+        assert False
+
+
+if __name__ == '__main__':
+    test_wlan_filter()
+    test_ether_filter()
+    print('Tests Successful...')
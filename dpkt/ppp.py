@@ -19,7 +19,7 @@ class PPP(dpkt.Packet):
     __hdr__ = (
         ('p', 'B', PPP_IP),
     )
-    _protosw = {}
+    _protosw = dpkt.LazyDispatch()
 
     @classmethod
     def set_p(cls, p, pktclass):
@@ -50,21 +50,11 @@ class PPP(dpkt.Packet):
 
 
 def __load_protos():
-    g = globals()
-    try:
-        gi = g.iteritems()
-    except:
-        gi = g.items()
-    for k, v in gi:
+    for k, v in list(globals().items()):
         if k.startswith('PPP_'):
             name = k[4:]
-            modname = name.lower()
-            try:
-                mod = __import__(modname, g, level=1)
-                PPP.set_p(v, getattr(mod, name))
-            except (ImportError, AttributeError):
-                continue
+            PPP._protosw.add_lazy(v, name.lower(), name)
 
 
-if not PPP._protosw:
+if not PPP._protosw.pending:
     __load_protos()
@@ -346,6 +346,11 @@ class Radiotap(dpkt.Packet):
         ('present_flags', 'I', 0)
     )
     __byte_order__ = '<'    # little endian
+    __extra_slots__ = (
+        'parse_ies', 'pool', '_dyn', 'fields', 'tsft', 'flags', 'rate', 'channel', 'fhss', 'ant_sig',
+        'ant_noise', 'lock_qual', 'tx_attn', 'db_tx_attn', 'dbm_tx_power', 'ant',
+        'db_ant_sig', 'db_ant_noise', 'rx_flags',
+    )
 
     @property
     def tsft_present(self):
@@ -622,6 +627,19 @@ class Radiotap(dpkt.Packet):
         self.ext_present = val
     # =================================================
 
+    def __init__(self, *args, **kwargs):
+        # passed on to IEEE80211
+        self.parse_ies = kwargs.pop('ies', True)
+        self.pool = kwargs.pop('pool', None)
+        super(Radiotap, self).__init__(*args, **kwargs)
+
+    # with a pool, only the attributes recorded in _dyn are cleared
+    _reset = dpkt.Packet._reset_tracked
+
+    @classmethod
+    def unpack_into(cls, instance, buf, ies=True, pool=None):
+        return super(Radiotap, cls).unpack_into(instance, buf, parse_ies=ies, pool=pool)
+
     def unpack(self, buf):
         dpkt.Packet.unpack(self, buf)
         it_present = self.present_flags
@@ -634,6 +652,7 @@ class Radiotap(dpkt.Packet):
         self.data = buf[self.length:]
 
         self.fields = []
+        dyn = self._dyn = ['fields']
         buf = buf[self.__hdr_len__ + n_it_present*4:]
 
         # decode each field into self.<name> (eg. self.tsft) as well as append it self.fields list
@@ -656,35 +675,40 @@ class Radiotap(dpkt.Packet):
         ]
         for name, present_bit, parser in field_decoder:
             if present_bit:
-                field = parser(buf)
+                field = parser(buf) if self.pool is None else self.pool.get(parser, buf)
                 field.data = ''
                 setattr(self, name, field)
+                dyn.append(name)
                 self.fields.append(field)
                 buf = buf[len(field):]
 
         if len(self.data) > 0:
-            if self.flags_present and self.flags.fcs:
-                self.data = ieee80211.IEEE80211(self.data, fcs=self.flags.fcs)
+            fcs = bool(self.flags_present and self.flags.fcs)
+            if self.pool is None:
+                self.data = ieee80211.IEEE80211(self.data, fcs=fcs, ies=self.parse_ies)
             else:
-                self.data = ieee80211.IEEE80211(self.data)
+                self.data = self.pool.get(ieee80211.IEEE80211, self.data, fcs=fcs, ies=self.parse_ies, pool=self.pool)
 
     class Antenna(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('index', 'B', 0),
         )
+        __extra_slots__ = ()
 
     class AntennaNoise(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
-            ('db', 'B', 0),
+            ('db', 'b', 0),     # dBm, signed
         )
+        __extra_slots__ = ()
 
     class AntennaSignal(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
-            ('db', 'B', 0),
+            ('db', 'b', 0),     # dBm, signed
         )
+        __extra_slots__ = ()
 
     class Channel(dpkt.Packet):
         __byte_order__ = '<'  # little endian
@@ -692,6 +716,7 @@ class Radiotap(dpkt.Packet):
             ('freq', 'H', 0),
             ('flags', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class FHSS(dpkt.Packet):
         __byte_order__ = '<'  # little endian
@@ -699,12 +724,14 @@ class Radiotap(dpkt.Packet):
             ('set', 'B', 0),
             ('pattern', 'B', 0),
         )
+        __extra_slots__ = ()
 
     class Flags(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('val', 'B', 0),
         )
+        __extra_slots__ = ()
 
         @property
         def fcs(self): return (self.val & _FCS_MASK) >> _FCS_SHIFT
@@ -727,54 +754,63 @@ class Radiotap(dpkt.Packet):
         __hdr__ = (
             ('val', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class RxFlags(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('val', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class Rate(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('val', 'B', 0),
         )
+        __extra_slots__ = ()
 
     class TSFT(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('usecs', 'Q', 0),
         )
+        __extra_slots__ = ()
 
     class TxAttenuation(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('val', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class DbTxAttenuation(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('db', 'H', 0),
         )
+        __extra_slots__ = ()
 
     class DbAntennaNoise(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('db', 'B', 0),
         )
+        __extra_slots__ = ()
 
     class DbAntennaSignal(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('db', 'B', 0),
         )
+        __extra_slots__ = ()
 
     class DbmTxPower(dpkt.Packet):
         __byte_order__ = '<'  # little endian
         __hdr__ = (
             ('dbm', 'B', 0),
         )
+        __extra_slots__ = ()
 
 
 def test_Radiotap():
@@ -801,6 +837,13 @@ def test_Radiotap():
     assert(len(rad.fields) == 7)
 
 
+def test_ant_sig():
+    s = b'\x00\x00\x0b\x00\x20\x00\x00\x00\xb5'
+    rt = Radiotap(s)
+    assert(rt.ant_sig_present == 1)
+    assert(rt.ant_sig.db == -75)
+
+
 def test_fcs():
     s = b'\x00\x00\x1a\x00\x2f\x48\x00\x00\x34\x8f\x71\x09\x00\x00\x00\x00\x10\x0c\x85\x09\xc0\x00\xcc\x01\x00\x00'
     rt = Radiotap(s)
@@ -808,7 +851,81 @@ def test_fcs():
     assert(rt.flags.fcs == 1)
 
 
+def _beacon_frame():
+    # radiotap flags, rate, channel, ant_sig + the beacon from the ieee80211 tests
+    rt = b'\x00\x00\x10\x00\x2e\x00\x00\x00\x10\x02\x6c\x09\xa0\x00\xc4\x00'
+    return rt + ieee80211._TEST_BEACON
+
+
+def footprint(pkt):
+    """Bytes held by a decoded frame: every object reachable from pkt
+    through attributes and lists, excluding the raw buffers."""
+    import sys
+    seen = set()
+    todo = [pkt]
+    total = 0
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, (bytes, str, int, float, type(None))):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple)):
+            todo.extend(obj)
+            continue
+        if isinstance(obj, dict):
+            todo.extend(obj.values())
+            continue
+        attrs = getattr(obj, '__dict__', None)
+        if attrs is not None:
+            total += sys.getsizeof(attrs)
+            todo.extend(attrs.values())
+        for k in type(obj).__mro__:
+            for name in k.__dict__.get('__slots__', ()):
+                if name not in ('__dict__', '__weakref__') and hasattr(obj, name):
+                    todo.append(getattr(obj, name))
+    return total
+
+
+def test_slots():
+    rt = Radiotap(_beacon_frame())
+    for obj in (rt, rt.flags, rt.ant_sig, rt.data, rt.data.mgmt, rt.data.beacon, rt.data.ssid,
+                rt.data.capability):
+        assert not hasattr(obj, '__dict__'), obj.__class__.__name__
+    assert rt.data.ie_48.data[:2] == b'\x01\x00'
+    assert 'ssid=' in repr(rt.data)
+    assert not hasattr(rt.data, 'ie_1000')
+
+
+def test_pool():
+    pool = dpkt.Pool()
+    rt = pool.get(Radiotap, _beacon_frame(), pool=pool)
+    assert rt.data.ssid.data == b'CAEN' and rt.data.ie_48
+    n = pool.in_use
+    pool.release()
+
+    # same objects, no attributes left over from the beacon
+    data = ieee80211._TEST_DATA
+    rt2 = pool.get(Radiotap, _beacon_frame()[:16] + data, pool=pool)
+    assert rt2 is rt
+    assert rt2.data.data_frame.src == b'\x00\x16\x44\xb0\xae\xc6'
+    assert not hasattr(rt2.data, 'ssid') and not hasattr(rt2.data, 'ie_48')
+    assert not hasattr(rt2.data, 'mgmt')
+    pool.release()
+    pool.get(Radiotap, _beacon_frame(), pool=pool)
+    assert pool.in_use == n and pool.allocated < 2 * n
+
+
+def bench_footprint():
+    rt = Radiotap(_beacon_frame())
+    print('%d bytes per decoded beacon' % footprint(rt))
+
+
 if __name__ == '__main__':
     test_Radiotap()
     test_fcs()
+    test_ant_sig()
+    test_slots()
+    test_pool()
+    bench_footprint()
     print('Tests Successful...')
\ No newline at end of file
@@ -3,6 +3,7 @@
 """Snoop file format."""
 
 import sys, time
+import struct
 import dpkt
 
 # RFC 1761
@@ -24,6 +25,9 @@ SDL_OTHER = 9
 
 dltoff = {SDL_ETHER: 14}
 
+# snoop datalink types to their pcap DLT_* equivalents, for filters
+sdl_to_dlt = {SDL_ETHER: 1}
+
 
 class PktHdr(dpkt.Packet):
     """snoop packet header."""
@@ -87,6 +91,7 @@ class Reader(object):
             raise ValueError('invalid snoop header')
         self.dloff = dltoff[self.__fh.linktype]
         self.filter = ''
+        self.__match = None
 
     def fileno(self):
         return self.fd
@@ -95,7 +100,11 @@ class Reader(object):
         return self.__fh.linktype
 
     def setfilter(self, value, optimize=1):
-        return NotImplementedError
+        """Only return packets matching value, see dpkt.pfilter."""
+        from . import pfilter
+        dlt = sdl_to_dlt.get(self.__fh.linktype, -1)
+        self.__match = pfilter.compile_filter(value, dlt) if value else None
+        self.filter = value
 
     def readpkts(self):
         return list(self)
@@ -114,9 +123,37 @@ class Reader(object):
 
     def __iter__(self):
         self.__f.seek(FileHdr.__hdr_len__)
+        # headers are unpacked with struct directly, no Packet per record
+        unpack = self.__ph.__hdr_struct__.unpack
         while 1:
             buf = self.__f.read(PktHdr.__hdr_len__)
-            if not buf: break
-            hdr = self.__ph(buf)
-            buf = self.__f.read(hdr.rec_len - PktHdr.__hdr_len__)
-            yield (hdr.ts_sec + (hdr.ts_usec / 1000000.0), buf[:hdr.incl_len])
+            if len(buf) < PktHdr.__hdr_len__: break
+            _, incl_len, rec_len, _, ts_sec, ts_usec = unpack(buf)
+            buf = self.__f.read(rec_len - PktHdr.__hdr_len__)[:incl_len]
+            if self.__match is not None and not self.__match(buf):
+                continue
+            yield (ts_sec + (ts_usec / 1000000.0), buf)
+
+
+def test_reader_filter():
+    import tempfile
+    pkts = [b'\x00\x01\x02\x03\x04\x05\x00\x0a\x0b\x0c\x0d\x0e\x08\x06' + b'\x00' * 28,
+            b'\x00\x01\x02\x03\x04\x05\x00\x0a\x0b\x0c\x0d\x0e\x08\x00' + b'\x45' + b'\x00' * 29]
+    with tempfile.TemporaryFile() as f:
+        f.write(bytes(FileHdr()))
+        for i, p in enumerate(pkts):
+            f.write(bytes(PktHdr(orig_len=len(p), incl_len=len(p),
+                                 rec_len=PktHdr.__hdr_len__ + len(p), ts_sec=i)))
+            f.write(p)
+        f.seek(0)
+        r = Reader(f)
+        assert len(r.readpkts()) == 2
+        r.setfilter('arp')
+        assert r.readpkts() == [(0.0, pkts[0])]
+        r.setfilter('ether proto ip')
+        assert r.readpkts() == [(1.0, pkts[1])]
+
+
+if __name__ == '__main__':
+    test_reader_filter()
+    print('Tests Successful...')
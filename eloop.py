@@ -47,17 +47,56 @@ class EloopTimeout(object):
         return not self.__eq__(other)
 
 
+class VirtualClock(object):
+    """Clock of a simulated EventLoop, time only moves when advanced."""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def advance_to(self, when):
+        if when > self.now:
+            self.now = when
+
+
 class EventLoop(object):
+    """Select loop with timers.
+
+    clock is the function timers are measured with, time.monotonic by
+    default. With a VirtualClock the loop simulates: it never waits, if no
+    I/O is ready it moves the clock to the next timer, and it stops when
+    there is neither I/O nor a timer left.
+    """
 
-    def __init__(self, sel=None):
+    def __init__(self, sel=None, clock=None):
         self._fd_to_key = {}
         self._timeouts = []
         self._sel = sel
+        self._running = False
         if sel is None:
             self._sel = selectors.DefaultSelector()
+        self.set_clock(clock)
+        # how late the last timer fired, and the worst so far
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def set_clock(self, clock):
+        self.clock = clock or time.monotonic
+        self.simulated = isinstance(clock, VirtualClock)
 
     def _time(self):
-        return time.monotonic()
+        return self.clock()
+
+    def wall_time(self):
+        """Seconds since the epoch, the virtual time when simulating."""
+        if self.simulated:
+            return self.clock()
+        return time.time()
 
     def register(self, fileobj, events, callback, data=None):
         self._sel.register(fileobj, events, (callback, data))
@@ -72,11 +111,15 @@ class EventLoop(object):
     def unregister(self, fileobj):
         self._sel.unregister(fileobj)
 
+    def stop(self):
+        self._running = False
+
     def run(self):
         """Perform the actual selection, until some monitored file objects are
         ready or a timeout expires.
         """
-        while True:
+        self._running = True
+        while self._running:
             timeout = None
             timeout_handle = None
 
@@ -84,10 +127,21 @@ class EventLoop(object):
                 timeout_handle = self._timeouts[0]
                 timeout = max(0, timeout_handle.when - self._time())
 
-            event_list = self._sel.select(timeout)
+            if self.simulated:
+                event_list = self._sel.select(0)
+                if not event_list:
+                    if timeout_handle is None:
+                        break
+                    self.clock.advance_to(timeout_handle.when)
+            else:
+                event_list = self._sel.select(timeout)
 
             if timeout_handle:
-                if self._time() >= timeout_handle.when:
+                lag = self._time() - timeout_handle.when
+                if lag >= 0:
+                    self.lag = lag
+                    if lag > self.max_lag:
+                        self.max_lag = lag
                     heapq.heappop(self._timeouts)
                     callback = timeout_handle.callback
                     callback(timeout_handle.arg)
@@ -95,6 +149,26 @@ class EventLoop(object):
             for key, mask in event_list:
                 callback = key.data[0]
                 callback(key.fileobj, mask, key.data[1])
+        self._running = False
+
+
+def test_simulation():
+    fired = []
+
+    def tick(arg):
+        fired.append((arg, loop.wall_time()))
+        if arg == 'hop' and loop.wall_time() < 1002:
+            loop.register_timeout(0.5, tick, 'hop')
+
+    clock = VirtualClock(1000.0)
+    loop = EventLoop(clock=clock)
+    loop.register_timeout(0.5, tick, 'hop')
+    loop.register_timeout(3600, tick, 'hour')
+    t0 = time.monotonic()
+    loop.run()
+    assert time.monotonic() - t0 < 1
+    assert fired == [('hop', 1000.5), ('hop', 1001.0), ('hop', 1001.5), ('hop', 1002.0), ('hour', 4600.0)]
+    assert clock() == 4600.0 and not loop._running
 
 
 if __name__ == '__main__':
@@ -0,0 +1,270 @@
+"""Probe request fingerprinting.
+
+Phones randomize their MAC address while probing, but the set and order of
+information elements they put into probe requests is fixed by the driver
+and firmware. signature() condenses the parts that do not vary between
+probes into a 64-bit integer, FingerprintIndex maps signatures to the MAC
+addresses that were seen using them.
+"""
+
+import bisect
+import hashlib
+from dpkt import ieee80211
+
+SEQ_MODULO = 4096
+
+# IEs whose body is part of the signature, everything else only
+# contributes its id
+_BODY_IES = frozenset([ieee80211.IE_RATES, ieee80211.IE_ESR,
+                       ieee80211.IE_HT_CAPA, ieee80211.IE_VHT_CAPA])
+
+
+def signature(ies):
+    """Return the 64-bit signature of a list of parsed IEs (IEEE80211.ies).
+
+    It covers the ordered IE ids, supported and extended rates, HT and VHT
+    capabilities and the OUI of every vendor specific IE. SSID and DS
+    parameter contents are left out on purpose, they change from probe to
+    probe.
+    """
+    key = bytearray()
+    for ie in ies:
+        ie_id = ie.id
+        key.append(ie_id)
+        if ie_id in _BODY_IES:
+            key += ie.data
+        elif ie_id == ieee80211.IE_VENDOR:
+            key += ie.data[:3]
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class FingerprintIndex(object):
+    """Signature to MAC set index. MACs added with a timestamp are dropped
+    by expire() once they have not been seen for a while, randomized MACs
+    would otherwise pile up forever."""
+
+    def __init__(self):
+        self.macs = {}          # signature -> set of macs
+        self.signatures = {}    # mac -> signature
+        self.seen = {}          # mac -> last timestamp
+
+    def __len__(self):
+        return len(self.macs)
+
+    def add(self, sig, mac, ts=None):
+        if ts is not None:
+            self.seen[mac] = ts
+        old = self.signatures.get(mac)
+        if old == sig:
+            return
+        if old is not None:
+            self._remove(old, mac)
+        self.signatures[mac] = sig
+        macs = self.macs.get(sig)
+        if macs is None:
+            self.macs[sig] = macs = set()
+        macs.add(mac)
+
+    def _remove(self, sig, mac):
+        macs = self.macs[sig]
+        macs.discard(mac)
+        if not macs:
+            del self.macs[sig]
+
+    def discard(self, mac):
+        self.seen.pop(mac, None)
+        sig = self.signatures.pop(mac, None)
+        if sig is not None:
+            self._remove(sig, mac)
+
+    def expire(self, now, max_age):
+        """Forget MACs not seen for longer than max_age seconds."""
+        for mac, ts in list(self.seen.items()):
+            if now - ts > max_age:
+                self.discard(mac)
+
+    def lookup(self, mac):
+        return self.signatures.get(mac)
+
+    def group(self, mac):
+        """Return all MACs sharing a fingerprint with mac."""
+        sig = self.signatures.get(mac)
+        if sig is None:
+            return set([mac])
+        return set(self.macs[sig])
+
+
+class SequenceLinker(object):
+    """Links randomized MACs of one device by sequence number.
+
+    For every fingerprint the last (seq, timestamp, mac) of each active MAC
+    is kept in a list sorted by seq. When a new MAC shows up, the entry
+    whose seq it continues (within max_gap, modulo 4096) is looked up by
+    bisection; if that MAC has been silent for at least min_silence and at
+    most max_silence seconds the new MAC is taken to be the same device and
+    replaces it. A MAC heard more recently belongs to a device that is still
+    talking, most likely another one of the same model.
+    """
+
+    max_gap = 64
+    min_silence = 1.0
+    max_silence = 60.0
+
+    def __init__(self):
+        self._by_fp = {}        # fingerprint -> sorted [(seq, ts, mac)]
+        self._last = {}         # mac -> (fingerprint, seq, ts)
+        self.device_of = {}     # mac -> device id
+        self.devices = 0        # unique devices seen so far
+
+    def __len__(self):
+        return len(self._last)
+
+    def _candidate(self, entries, seq, ts):
+        lo = seq - self.max_gap
+        ranges = [(max(lo, 0), seq)]
+        if lo < 0:
+            ranges.append((SEQ_MODULO + lo, SEQ_MODULO))
+        best = None
+        best_dist = None
+        for start, end in ranges:
+            i = bisect.bisect_left(entries, (start,))
+            j = bisect.bisect_left(entries, (end,))
+            # walk down from the closest seq, skipping stale and active entries
+            for k in range(j - 1, i - 1, -1):
+                entry = entries[k]
+                if self.min_silence <= ts - entry[1] <= self.max_silence:
+                    dist = (seq - entry[0]) % SEQ_MODULO
+                    if best is None or dist < best_dist:
+                        best, best_dist = entry, dist
+                    break
+        return best
+
+    def observe(self, fp, mac, seq, ts):
+        """Record a frame and return the device id mac belongs to."""
+        last = self._last.get(mac)
+        if last is not None:
+            old_fp, old_seq, old_ts = last
+            old = self._by_fp[old_fp]
+            i = bisect.bisect_left(old, (old_seq, old_ts, mac))
+            if i < len(old) and old[i][2] == mac:
+                del old[i]
+            device = self.device_of[mac]
+        else:
+            device = None
+
+        entries = self._by_fp.get(fp)
+        if entries is None:
+            self._by_fp[fp] = entries = []
+
+        if device is None:
+            cand = self._candidate(entries, seq, ts)
+            if cand is not None:
+                device = self.device_of.pop(cand[2])
+                entries.remove(cand)
+                del self._last[cand[2]]
+            else:
+                device = self.devices
+                self.devices += 1
+            self.device_of[mac] = device
+
+        bisect.insort(entries, (seq, ts, mac))
+        self._last[mac] = (fp, seq, ts)
+        return device
+
+    def expire(self, now):
+        """Forget MACs that have been silent for longer than max_silence."""
+        for fp, entries in list(self._by_fp.items()):
+            keep = [e for e in entries if now - e[1] <= self.max_silence]
+            for e in entries:
+                if now - e[1] > self.max_silence:
+                    del self._last[e[2]]
+                    del self.device_of[e[2]]
+            if keep:
+                self._by_fp[fp] = keep
+            else:
+                del self._by_fp[fp]
+
+
+def _probe_req(src, ies):
+    return (b'\x40\x00\x00\x00' + b'\xff' * 6 + src + b'\xff' * 6 + b'\x10\x00' +
+            ies + b'\x00\x00\x00\x00')
+
+
+_IES = (b'\x00\x00'                                 # wildcard ssid
+        b'\x01\x08\x02\x04\x0b\x16\x0c\x12\x18\x24'  # rates
+        b'\x32\x04\x30\x48\x60\x6c'                 # ext rates
+        b'\x2d\x1a' + b'\x6f\x01' + b'\x00' * 24 +  # ht capabilities
+        b'\xdd\x07\x00\x50\xf2\x08\x00\x10\x00')     # vendor
+
+
+def test_signature():
+    a = ieee80211.IEEE80211(_probe_req(b'\x02\x00\x00\x00\x00\x01', _IES), fcs=True)
+    b = ieee80211.IEEE80211(_probe_req(b'\x06\x11\x22\x33\x44\x55',
+                                       _IES.replace(b'\x00\x00', b'\x00\x04test', 1)), fcs=True)
+    c = ieee80211.IEEE80211(_probe_req(b'\x02\x00\x00\x00\x00\x02',
+                                       _IES.replace(b'\x00\x50\xf2', b'\x00\x17\xf2')), fcs=True)
+    assert [ie.id for ie in a.ies] == [0, 1, 50, 45, 221]
+    sig = signature(a.ies)
+    assert 0 <= sig < 1 << 64
+    # the ssid does not matter, the vendor oui does
+    assert signature(b.ies) == sig
+    assert signature(c.ies) != sig
+
+
+def test_index():
+    idx = FingerprintIndex()
+    idx.add(1, b'a')
+    idx.add(1, b'b')
+    idx.add(2, b'c')
+    assert len(idx) == 2
+    assert idx.group(b'a') == set([b'a', b'b'])
+    idx.add(2, b'b')
+    assert idx.group(b'c') == set([b'b', b'c'])
+    idx.discard(b'a')
+    assert len(idx) == 1
+    assert idx.group(b'x') == set([b'x'])
+    # randomized MACs leave the index once they went quiet
+    for i in range(100):
+        idx.add(3, b'rnd%d' % i, float(i))
+    idx.add(3, b'rnd0', 95.0)
+    idx.expire(100.0, 10.0)
+    assert idx.group(b'rnd0') == set([b'rnd0'] + [b'rnd%d' % i for i in range(90, 100)])
+    idx.expire(1000.0, 10.0)
+    assert len(idx) == 1 and not idx.seen and idx.group(b'rnd0') == set([b'rnd0'])
+
+
+def test_linker():
+    link = SequenceLinker()
+    a = link.observe(7, b'mac1', 100, 0.0)
+    assert link.observe(7, b'mac1', 110, 1.0) == a
+    # another device with the same fingerprint is still talking
+    b = link.observe(7, b'mac3', 2000, 1.5)
+    assert b != a
+    # mac1 went quiet, mac2 continues its sequence
+    assert link.observe(7, b'mac2', 113, 5.0) == a
+    assert b'mac1' not in link.device_of
+    # too far from any known sequence
+    assert link.observe(7, b'mac4', 3000, 6.0) not in (a, b)
+    # different fingerprint never links
+    assert link.observe(8, b'mac5', 115, 6.0) not in (a, b)
+    # sequence wraps around
+    c = link.observe(9, b'mac6', 4090, 7.0)
+    assert link.observe(9, b'mac7', 5, 8.0) == c
+    assert link.devices == 5
+    # two devices of the same model talking at once keep their ids
+    d = link.observe(10, b'macA', 100, 10.0)
+    e = link.observe(10, b'macB', 110, 10.05)
+    assert e != d and link.observe(10, b'macA', 101, 10.1) == d
+    assert link.observe(10, b'macB', 111, 10.2) == e
+    assert link.devices == 7
+    # stale entries are not linked
+    assert link.observe(7, b'mac8', 2010, 1000.0) != b
+    link.expire(1000.0)
+    assert len(link) == 1 and len(link.device_of) == 1
+
+
+if __name__ == '__main__':
+    test_signature()
+    test_index()
+    test_linker()
+    print('Tests Successful...')
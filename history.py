@@ -0,0 +1,240 @@
+"""Station observation history in SQLite.
+
+HistorySink is a Sniffer observer: observe() only appends a tuple to a
+deque, a background thread drains it every interval seconds (or sooner
+once batch_size rows are waiting) and writes them with executemany() in
+one transaction. The database is in WAL mode, so readers never block the
+writer and the writer never blocks capture.
+
+Rows go to one table per partition seconds of capture time, named
+obs_<partition start>, each with covering indexes for lookups by station
+(mac, time) and by AP (bssid, time). Retention drops whole partitions,
+which is far cheaper than deleting rows. MACs are stored as integers.
+"""
+
+import collections
+import os
+import sqlite3
+import threading
+
+_COLUMNS = 'mac, time, bssid, freq, signal'
+
+
+def mac_to_int(mac):
+    if isinstance(mac, str):
+        mac = bytes.fromhex(mac.replace(':', ''))
+    return int.from_bytes(mac, 'big')
+
+
+def int_to_mac(value):
+    return ':'.join('%02x' % b for b in value.to_bytes(6, 'big'))
+
+
+def _partitions(db):
+    rows = db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'obs\\_%' ESCAPE '\\'")
+    return sorted(int(name[4:]) for name, in rows)
+
+
+class HistorySink(object):
+
+    interval = 1.0
+    batch_size = 20000
+    # observations kept while the writer is behind, more are dropped
+    max_pending = 500000
+    partition = 86400
+    retention = 30 * 86400
+
+    def __init__(self, path, interval=None, batch_size=None, partition=None, retention=None):
+        self.path = path
+        if interval is not None:
+            self.interval = interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if partition is not None:
+            self.partition = partition
+        if retention is not None:
+            self.retention = retention
+        self.pending = collections.deque()
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self.newest = None
+        self._tables = set()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='history', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Write what is pending and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def observe(self, mac, time, signal, freq, bssid):
+        pending = self.pending
+        if len(pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        pending.append((mac, time, bssid, freq, signal))
+        if len(pending) == self.batch_size:
+            self._wake.set()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        self._tables = set(_partitions(db))
+        return db
+
+    def _run(self):
+        db = self._connect()
+        try:
+            while True:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                stopping = self._stopping
+                while self.pending:
+                    self._flush(db)
+                if stopping:
+                    break
+        finally:
+            db.close()
+
+    def _table(self, db, start):
+        name = 'obs_%d' % start
+        if start not in self._tables:
+            db.execute('CREATE TABLE IF NOT EXISTS %s (mac INTEGER NOT NULL, time REAL NOT NULL, '
+                       'bssid INTEGER, freq INTEGER, signal INTEGER)' % name)
+            db.execute('CREATE INDEX IF NOT EXISTS %s_mac ON %s (mac, time, bssid, freq, signal)' % (name, name))
+            db.execute('CREATE INDEX IF NOT EXISTS %s_bssid ON %s (bssid, time, mac, freq, signal)' % (name, name))
+            self._tables.add(start)
+        return name
+
+    def _flush(self, db):
+        pending = self.pending
+        popleft = pending.popleft
+        partition = self.partition
+        parts = {}
+        newest = self.newest
+        for i in range(min(len(pending), self.batch_size)):
+            mac, t, bssid, freq, signal = popleft()
+            if newest is None or t > newest:
+                newest = t
+            start = int(t // partition * partition)
+            rows = parts.get(start)
+            if rows is None:
+                rows = parts[start] = []
+            rows.append((int.from_bytes(mac, 'big'), t,
+                         int.from_bytes(bssid, 'big') if bssid is not None else None, freq, signal))
+        try:
+            with db:
+                for start, rows in parts.items():
+                    db.executemany('INSERT INTO %s VALUES (?, ?, ?, ?, ?)' % self._table(db, start), rows)
+            self.written += sum(len(rows) for rows in parts.values())
+            self.newest = newest
+            self._prune(db)
+        except sqlite3.Error as e:
+            # the batch is lost, capture goes on
+            self.errors += 1
+            self.last_error = str(e)
+            self._tables = set(_partitions(db))
+
+    def _prune(self, db):
+        """Drop partitions entirely older than retention, counted back from
+        the newest observation: capture time, not the wall clock."""
+        if self.newest is None:
+            return
+        horizon = self.newest - self.retention
+        for start in sorted(self._tables):
+            if start + self.partition > horizon:
+                break
+            db.execute('DROP TABLE IF EXISTS obs_%d' % start)
+            self._tables.discard(start)
+
+
+def query(path, mac=None, bssid=None, since=None, until=None):
+    """Return the (mac, time, bssid, freq, signal) rows of a station or an
+    AP between since and until, in time order. MACs are returned as
+    strings. Opens its own connection: call it off the capture thread."""
+    if (mac is None) == (bssid is None):
+        raise ValueError('query by either mac or bssid')
+    column, value = ('mac', mac) if mac is not None else ('bssid', bssid)
+    lo = float('-inf') if since is None else since
+    hi = float('inf') if until is None else until
+    db = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    try:
+        partition = None
+        starts = _partitions(db)
+        if len(starts) > 1:
+            partition = min(b - a for a, b in zip(starts, starts[1:]))
+        selects = []
+        for start in starts:
+            if start > hi or (partition is not None and start + partition <= lo):
+                continue
+            selects.append('SELECT %s FROM obs_%d WHERE %s = ? AND time >= ? AND time <= ?' % (
+                _COLUMNS, start, column))
+        if not selects:
+            return []
+        sql = ' UNION ALL '.join(selects) + ' ORDER BY time'
+        args = (mac_to_int(value), lo, hi) * len(selects)
+        return [(int_to_mac(m), t, int_to_mac(b) if b is not None else None, f, s)
+                for m, t, b, f, s in db.execute(sql, args)]
+    finally:
+        db.close()
+
+
+def test_history():
+    import shutil
+    import struct
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix='history')
+    path = os.path.join(directory, 'history.db')
+    h = HistorySink(path, interval=0.01, batch_size=1000, partition=3600, retention=2 * 3600)
+    h.start()
+    aps = [struct.pack('>HI', 0x0026, i) for i in range(4)]
+    t0 = 1500000000.0
+    for i in range(10000):
+        mac = struct.pack('>HI', 0x0200, i % 100)
+        h.observe(mac, t0 + i, -40 - i % 30, 2412, aps[i % 4] if i % 5 else None)
+    h.close()
+    assert (h.written, h.dropped, h.errors) == (10000, 0, 0)
+
+    db = sqlite3.connect(path)
+    assert db.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    starts = _partitions(db)
+    # 10000 s of capture over hour partitions, the oldest one pruned
+    assert starts == [1499997600 + 3600 * k for k in range(1, 4)]
+    plan = ' '.join(r[-1] for r in db.execute(
+        'EXPLAIN QUERY PLAN SELECT %s FROM obs_%d WHERE bssid = 1 AND time >= 0' % (_COLUMNS, starts[0])))
+    assert 'COVERING INDEX obs_%d_bssid' % starts[0] in plan
+    db.close()
+
+    rows = query(path, mac='02:00:00:00:00:05', since=t0 + 5000)
+    assert [r[1] for r in rows] == [t0 + i for i in range(5005, 10000, 100)]
+    assert rows[0] == ('02:00:00:00:00:05', t0 + 5005, None, 2412, -40 - 5005 % 30)
+    rows = query(path, bssid=aps[1], since=t0 + 9000, until=t0 + 9100)
+    assert [r[1] for r in rows] == [t0 + i for i in range(9001, 9100, 4) if i % 5]
+    assert all(r[2] == '00:26:00:00:00:01' for r in rows)
+    assert query(path, mac='02:00:00:00:00:05', until=t0) == []
+
+    # rows in the queue when the writer is behind are dropped, not waited for
+    h = HistorySink(path)
+    h.max_pending = 10
+    for i in range(15):
+        h.observe(b'\x02' * 6, t0, -50, 2412, None)
+    assert (len(h.pending), h.dropped) == (10, 5)
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    test_history()
+    print('Tests Successful...')
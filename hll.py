@@ -0,0 +1,368 @@
+"""HyperLogLog sketches of unique stations per AP, channel and sensor.
+
+A HyperLogLog estimates the number of distinct MACs added to it in fixed
+memory: 2**p one-byte registers, 4 kB and about 1.6% standard error at
+the default p=12, whether it saw ten devices or ten million. Sketches of
+the same p merge by taking the register maxima, so a collector combines
+the sketches of several sensors, or of consecutive minutes, into the
+count of devices seen by any of them. MACs are hashed with splitmix64,
+the same on every sensor.
+
+A sketch stays sparse (a dict of the set registers) until it has more
+than SPARSE_MAX of them, most minute windows of a quiet AP never need
+the full 4 kB.
+
+UniqueCounter is a Sniffer observer keeping one sketch per (dimension,
+key) and time window, for minute and hour windows, in rings of the most
+recent windows; older ones are dropped. Windows are handed out through
+closed() once capture time has moved past them.
+"""
+
+import base64
+import collections
+import math
+import struct
+
+_M64 = (1 << 64) - 1
+
+_HEADER = struct.Struct('<4sBBI')
+MAGIC = b'WHLL'
+DENSE = 0
+SPARSE = 1
+
+
+def hash_mac(mac):
+    """64-bit splitmix64 hash of a MAC given as bytes."""
+    z = (int.from_bytes(mac, 'big') + 0x9e3779b97f4a7c15) & _M64
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & _M64
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & _M64
+    return z ^ (z >> 31)
+
+
+class HyperLogLog(object):
+
+    __slots__ = ('p', 'sparse', 'registers')
+
+    def __init__(self, p=12):
+        if not 4 <= p <= 16:
+            raise ValueError('p must be between 4 and 16')
+        self.p = p
+        self.sparse = {}
+        self.registers = None
+
+    @property
+    def m(self):
+        return 1 << self.p
+
+    @property
+    def SPARSE_MAX(self):
+        # a dict entry costs about as much as 64 registers
+        return self.m >> 6
+
+    def position(self, h):
+        """(register, rank) of a 64-bit hash."""
+        bits = 64 - self.p
+        w = h & ((1 << bits) - 1)
+        return h >> bits, bits - w.bit_length() + 1
+
+    def add_position(self, idx, rank):
+        registers = self.registers
+        if registers is None:
+            sparse = self.sparse
+            if rank > sparse.get(idx, 0):
+                sparse[idx] = rank
+                if len(sparse) > self.SPARSE_MAX:
+                    self._densify()
+        elif rank > registers[idx]:
+            registers[idx] = rank
+
+    def add(self, mac):
+        idx, rank = self.position(hash_mac(mac))
+        self.add_position(idx, rank)
+
+    def _densify(self):
+        registers = bytearray(self.m)
+        for idx, rank in self.sparse.items():
+            registers[idx] = rank
+        self.registers = registers
+        self.sparse = None
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError('cannot merge sketches of p=%d and p=%d' % (self.p, other.p))
+        if other.registers is None:
+            for idx, rank in other.sparse.items():
+                self.add_position(idx, rank)
+            return self
+        if self.registers is None:
+            self._densify()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        m = self.m
+        if self.registers is None:
+            ranks = self.sparse.values()
+            zeros = m - len(self.sparse)
+            total = zeros + sum(2.0 ** -r for r in ranks)
+        else:
+            registers = self.registers
+            zeros = registers.count(0)
+            # a histogram of the ranks, counted in C
+            total = sum(registers.count(r) * 2.0 ** -r for r in range(max(registers) + 1))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / total
+        if e <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            e = m * math.log(m / zeros)
+        return e
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+    def to_bytes(self):
+        if self.registers is None:
+            items = sorted(self.sparse.items())
+            return (_HEADER.pack(MAGIC, self.p, SPARSE, len(items)) +
+                    b''.join(struct.pack('<HB', idx, rank) for idx, rank in items))
+        return _HEADER.pack(MAGIC, self.p, DENSE, self.m) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, p, encoding, n = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('not a HyperLogLog sketch')
+        sketch = cls(p)
+        body = data[_HEADER.size:]
+        if encoding == SPARSE:
+            if len(body) != 3 * n:
+                raise ValueError('truncated sketch')
+            sketch.sparse = dict(struct.iter_unpack('<HB', body))
+            if len(sketch.sparse) > sketch.SPARSE_MAX:
+                sketch._densify()
+        elif encoding == DENSE and n == sketch.m and len(body) == n:
+            sketch.sparse = None
+            sketch.registers = bytearray(body)
+        else:
+            raise ValueError('bad sketch encoding')
+        return sketch
+
+
+class _Window(object):
+    __slots__ = ('start', 'sketches', 'closed')
+
+    def __init__(self, start):
+        self.start = start
+        self.sketches = {}
+        self.closed = False
+
+
+class UniqueCounter(object):
+    """Sketches of unique stations per (dimension, key) and window.
+
+    Dimensions are 'bssid' (the AP a station talked to), 'channel'
+    (frequency in MHz) and 'sensor' (all stations this sensor saw).
+    windows maps a window length in seconds to the number kept.
+    """
+
+    WINDOWS = {60: 60, 3600: 24}
+    # a window is closed this long after capture time passed its end,
+    # sightings that arrive later are still counted but not published again
+    GRACE = 10
+
+    def __init__(self, sensor, p=12, windows=None):
+        self.sensor = sensor
+        self.p = p
+        self.rings = dict((length, collections.deque(maxlen=n))
+                          for length, n in sorted((windows or self.WINDOWS).items()))
+        self.newest = None
+        self.late = 0
+
+    def _window(self, ring, length, t):
+        start = t - t % length
+        if ring and ring[-1].start == start:
+            return ring[-1]
+        if not ring or ring[-1].start < start:
+            w = _Window(start)
+            ring.append(w)
+            return w
+        i = len(ring)
+        for w in reversed(ring):
+            if w.start == start:
+                return w
+            if w.start < start:
+                break
+            i -= 1
+        # a gap in the ring: create the window in order if it is one of
+        # the ring's most recent windows, dropping the oldest when full
+        full = len(ring) == ring.maxlen
+        if start <= ring[-1].start - length * ring.maxlen or (full and i == 0):
+            return None
+        if full:
+            ring.popleft()
+            i -= 1
+        w = _Window(start)
+        ring.insert(i, w)
+        return w
+
+    def observe(self, mac, time, signal, freq, bssid):
+        bits = 64 - self.p
+        h = hash_mac(mac)
+        idx, rank = h >> bits, bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if self.newest is None or time > self.newest:
+            self.newest = time
+        keys = [('sensor', self.sensor)]
+        if bssid is not None:
+            keys.append(('bssid', bssid))
+        if freq is not None:
+            keys.append(('channel', freq))
+        for length, ring in self.rings.items():
+            w = self._window(ring, length, int(time))
+            if w is None:
+                # older than any window kept, counted per ring
+                self.late += 1
+                continue
+            sketches = w.sketches
+            for key in keys:
+                sketch = sketches.get(key)
+                if sketch is None:
+                    sketch = sketches[key] = HyperLogLog(self.p)
+                sketch.add_position(idx, rank)
+
+    def current(self, length, dimension=None):
+        """[(dimension, key, window start, estimate)] of the newest window."""
+        ring = self.rings[length]
+        if not ring:
+            return []
+        w = ring[-1]
+        return [(d, _key_string(d, k), w.start, len(s)) for (d, k), s in sorted(w.sketches.items(), key=str)
+                if dimension is None or d == dimension]
+
+    def closed(self, now=None):
+        """Yield a report record for every sketch of windows that ended
+        at least GRACE seconds before now (default: the newest sighting),
+        each window once."""
+        now = self.newest if now is None else now
+        if now is None:
+            return
+        for length, ring in self.rings.items():
+            for w in ring:
+                if w.closed or w.start + length + self.GRACE > now:
+                    continue
+                w.closed = True
+                for (d, k), sketch in w.sketches.items():
+                    yield {
+                        'kind': 'unique',
+                        'sensor': self.sensor,
+                        'dimension': d,
+                        'key': _key_string(d, k),
+                        'start': w.start,
+                        'length': length,
+                        'estimate': len(sketch),
+                        'sketch': base64.b64encode(sketch.to_bytes()).decode('ascii'),
+                    }
+
+    def memory(self):
+        """Bytes held in registers and sparse entries, roughly."""
+        n = 0
+        for ring in self.rings.values():
+            for w in ring:
+                for s in w.sketches.values():
+                    n += len(s.registers) if s.registers is not None else 64 * len(s.sparse)
+        return n
+
+
+def _key_string(dimension, key):
+    if dimension == 'bssid':
+        return ':'.join('%02x' % b for b in key)
+    return key
+
+
+def merge_records(records):
+    """Merge 'unique' report records of the same window, e.g. from several
+    sensors, into one sketch."""
+    sketch = None
+    for r in records:
+        s = HyperLogLog.from_bytes(base64.b64decode(r['sketch']))
+        sketch = s if sketch is None else sketch.merge(s)
+    return sketch
+
+
+def test_hyperloglog():
+    macs = [struct.pack('>HI', 0x0200, i) for i in range(50000)]
+    h = HyperLogLog()
+    for n, mac in enumerate(macs, 1):
+        h.add(mac)
+        h.add(mac)
+        if n in (10, 100, 1000, 50000):
+            assert abs(h.estimate() - n) / n < 0.05, (n, h.estimate())
+    assert h.registers is not None and len(h.registers) == 4096
+    small = HyperLogLog()
+    for mac in macs[:20]:
+        small.add(mac)
+    assert small.registers is None and len(small) == 20
+
+    # merging the halves is the whole
+    a, b = HyperLogLog(), HyperLogLog()
+    for i, mac in enumerate(macs):
+        (a if i % 2 else b).add(mac)
+        if i < 30000:
+            a.add(mac)
+    for x in (a, small):
+        y = HyperLogLog.from_bytes(x.to_bytes())
+        assert (y.registers, y.sparse) == (x.registers, x.sparse)
+    assert a.merge(b).registers == h.registers
+    assert len(HyperLogLog().merge(small)) == 20
+    try:
+        HyperLogLog(10).merge(h)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_unique_counter():
+    c = UniqueCounter('sensor-1', windows={60: 3, 3600: 2})
+    d = UniqueCounter('sensor-2', windows={60: 3, 3600: 2})
+    aps = [b'\x00\x26\xcb\x18\x6a\x30', b'\x00\x26\xcb\x18\x6a\x31']
+    t0 = 1500000000
+    for i in range(6000):
+        # 100 minutes, 100 devices a minute of which 40 are regulars
+        mac = struct.pack('>HI', 0x0200, i % 40 if i % 100 < 40 else 1000 + i)
+        counter = c if i % 3 else d
+        counter.observe(mac, t0 + i, -50, 2412, aps[i % 2])
+    assert len(c.rings[60]) == 3 and len(c.rings[3600]) == 2
+    (_, _, start, n), = c.current(60, 'sensor')
+    assert start == t0 + 5940 and 35 <= n <= 45
+    # the first hour fell out of the ring, the second one is closed: 40
+    # regulars and 60 new devices a minute, merged across both sensors
+    hours = [r for r in list(c.closed()) + list(d.closed()) if r['length'] == 3600 and r['dimension'] == 'sensor']
+    assert [r['start'] for r in hours] == [t0 + 1200] * 2
+    total = len(merge_records(hours))
+    expected = 40 + 36 * 60
+    assert abs(total - expected) / expected < 0.05, total
+    # published once
+    assert not [r for r in c.closed() if r['length'] == 3600]
+    assert set(r['key'] for r in c.closed(t0 + 10 ** 6) if r['dimension'] == 'bssid') <= {
+        '00:26:cb:18:6a:30', '00:26:cb:18:6a:31'}
+    c.observe(b'\x02' * 6, t0, -50, None, None)
+    # too old for both the minute and the hour ring
+    assert c.late == 2
+    # a late sighting in a gap minute gets its window, in order
+    g = UniqueCounter('sensor-1', windows={60: 3})
+    for t in (t0 - 2400, t0 - 2400 + 120, t0 - 2400 + 60):
+        g.observe(b'\x02' * 6, t, -50, None, None)
+    assert [w.start for w in g.rings[60]] == [t0 - 2400, t0 - 2400 + 60, t0 - 2400 + 120]
+    assert all(len(w.sketches[('sensor', 'sensor-1')]) == 1 for w in g.rings[60])
+    g.observe(b'\x02' * 6, t0 - 2400 + 240, -50, None, None)
+    g.observe(b'\x02' * 6, t0 - 2400 + 180, -50, None, None)
+    g.observe(b'\x02' * 6, t0 - 2400 + 30, -50, None, None)
+    assert [w.start for w in g.rings[60]] == [t0 - 2400 + 120, t0 - 2400 + 180, t0 - 2400 + 240]
+    assert g.late == 1
+    assert c.memory() < 5 * 4096 * 6
+
+
+if __name__ == '__main__':
+    test_hyperloglog()
+    test_unique_counter()
+    print('Tests Successful...')
@@ -0,0 +1,298 @@
+"""Pipeline metrics in the Prometheus text format.
+
+Hot paths keep plain integer counters on their own objects (the loop is
+single threaded, so there is nothing to lock); the registry reads them
+through callbacks when scraped. Counter and Gauge are for values that
+have no other home. MetricsServer answers GET /metrics from the
+EventLoop with non-blocking sockets, a scrape never stalls capture.
+"""
+
+import socket
+import eloop
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, n=1):
+        self.value -= n
+
+
+class Metric(object):
+    """A metric family. Children are created per label value tuple by
+    labels(); without label names the family is its own single child.
+    With fn, samples come from fn() at scrape time instead: a number, or
+    (label values, number) pairs if there are label names.
+    """
+
+    def __init__(self, name, help, type, label_names=(), fn=None):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.label_names = tuple(label_names)
+        self.fn = fn
+        self.children = {}
+        if not self.label_names and fn is None:
+            self._single = self.labels()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('%s: expected labels %s' % (self.name, self.label_names))
+            child = self.children[values] = (Counter if self.type == COUNTER else Gauge)()
+        return child
+
+    def inc(self, n=1):
+        self._single.inc(n)
+
+    def set(self, value):
+        self._single.set(value)
+
+    def samples(self):
+        if self.fn is None:
+            return [(values, child.value) for values, child in self.children.items()]
+        if self.label_names:
+            return self.fn()
+        return [((), self.fn())]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value))
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('duplicate metric %s' % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=(), fn=None):
+        return self.register(Metric(name, help, COUNTER, labels, fn))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Metric(name, help, GAUGE, labels, fn))
+
+    def render(self):
+        lines = []
+        for m in self.metrics.values():
+            lines.append('# HELP %s %s' % (m.name, m.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (m.name, m.type))
+            for values, value in m.samples():
+                if values:
+                    labels = ','.join('%s="%s"' % (k, _escape(v)) for k, v in zip(m.label_names, values))
+                    lines.append('%s{%s} %s' % (m.name, labels, _format_value(value)))
+                else:
+                    lines.append('%s %s' % (m.name, _format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def snapshot(self):
+        """Return {name: value} for unlabelled metrics and {name: [{label:
+        value, ..., 'value': value}]} for labelled ones."""
+        out = {}
+        for m in self.metrics.values():
+            if m.label_names:
+                out[m.name] = [dict(zip(m.label_names, values), value=value) for values, value in m.samples()]
+            else:
+                out[m.name] = m.samples()[0][1]
+        return out
+
+
+class MetricsServer(object):
+    """Minimal HTTP/1.0 responder for the registry on the EventLoop."""
+
+    MAX_CLIENTS = 16
+    MAX_REQUEST = 8192
+    CLIENT_TIMEOUT = 5.0
+
+    def __init__(self, loop, registry, address):
+        self.eloop = loop
+        self.registry = registry
+        self.clients = {}
+        self.scrapes = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setblocking(False)
+        self.sock.bind(address)
+        self.sock.listen(8)
+        self.address = self.sock.getsockname()
+        self.eloop.register(self.sock, eloop.EVENT_READ, self._on_accept)
+
+    def close(self):
+        for conn in list(self.clients):
+            self._close(conn)
+        self.eloop.unregister(self.sock)
+        self.sock.close()
+
+    def _on_accept(self, fd, mask, arg):
+        try:
+            conn, addr = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(self.clients) >= self.MAX_CLIENTS:
+            conn.close()
+            return
+        conn.setblocking(False)
+        self.clients[conn] = bytearray()
+        self.eloop.register(conn, eloop.EVENT_READ, self._on_client)
+        self.eloop.register_timeout(self.CLIENT_TIMEOUT, self._expire, conn)
+
+    def _expire(self, conn):
+        if conn in self.clients:
+            self._close(conn)
+
+    def _close(self, conn):
+        del self.clients[conn]
+        self.eloop.unregister(conn)
+        conn.close()
+
+    def _on_client(self, conn, mask, arg):
+        if mask & eloop.EVENT_WRITE:
+            self._send(conn)
+            return
+        try:
+            data = conn.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        buf = self.clients[conn]
+        buf += data
+        if b'\r\n\r\n' not in buf and b'\n\n' not in buf:
+            if not data or len(buf) > self.MAX_REQUEST:
+                self._close(conn)
+            return
+        self.clients[conn] = self._respond(bytes(buf))
+        self.eloop.modify(conn, eloop.EVENT_WRITE, self._on_client)
+        self._send(conn)
+
+    def _respond(self, request):
+        try:
+            method, path = request.split(None, 2)[:2]
+        except ValueError:
+            return self._response(400, 'Bad Request', b'')
+        if method not in (b'GET', b'HEAD'):
+            return self._response(405, 'Method Not Allowed', b'')
+        if path.split(b'?')[0] != b'/metrics':
+            return self._response(404, 'Not Found', b'')
+        self.scrapes += 1
+        body = self.registry.render().encode('utf8')
+        return self._response(200, 'OK', body, method == b'HEAD')
+
+    @staticmethod
+    def _response(code, reason, body, head=False):
+        hdr = ('HTTP/1.0 %d %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+               'Content-Length: %d\r\nConnection: close\r\n\r\n' % (code, reason, len(body)))
+        return bytearray(hdr.encode('ascii') + (b'' if head else body))
+
+    def _send(self, conn):
+        buf = self.clients[conn]
+        try:
+            n = conn.send(buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(conn)
+            return
+        del buf[:n]
+        if not buf:
+            self._close(conn)
+
+
+def test_render():
+    r = Registry()
+    c = r.counter('frames_total', 'Frames seen.', ('type',))
+    c.labels('mgmt').inc(3)
+    c.labels('data').inc()
+    g = r.gauge('queue_depth', 'Queued records.')
+    g.set(7)
+    r.gauge('stations', 'Known "stations".', fn=lambda: 2)
+    r.counter('drops_total', 'Drops per sink.', ('sink',), fn=lambda: [(('udp\\1',), 5)])
+    text = r.render()
+    assert 'frames_total{type="mgmt"} 3\n' in text and 'frames_total{type="data"} 1\n' in text
+    assert '# TYPE queue_depth gauge\nqueue_depth 7\n' in text
+    assert 'stations 2\n' in text
+    assert 'drops_total{sink="udp\\\\1"} 5\n' in text
+    snap = r.snapshot()
+    assert snap['queue_depth'] == 7 and snap['stations'] == 2
+    assert snap['drops_total'] == [{'sink': 'udp\\1', 'value': 5}]
+    try:
+        r.counter('stations', 'again')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_server():
+    loop = eloop.EventLoop()
+    r = Registry()
+    r.counter('scrapes_total', 'Scrapes.', fn=lambda: server.scrapes)
+    server = MetricsServer(loop, r, ('127.0.0.1', 0))
+    replies = []
+
+    def scrape(path):
+        c = socket.create_connection(server.address)
+        c.sendall(b'GET ' + path + b' HTTP/1.1\r\nHost: x\r\n\r\n')
+        c.setblocking(False)
+        reply = b''
+
+        def on_reply(fd, mask, arg):
+            nonlocal reply
+            data = c.recv(65536)
+            reply += data
+            if not data:
+                loop.unregister(c)
+                c.close()
+                replies.append(reply)
+                if len(replies) == 2:
+                    loop.stop()
+        loop.register(c, eloop.EVENT_READ, on_reply)
+
+    scrape(b'/metrics')
+    scrape(b'/')
+    loop.register_timeout(5, lambda arg: loop.stop())
+    loop.run()
+    server.close()
+    ok, missing = sorted(replies, key=lambda r: b'404' in r.split(b'\r\n')[0])
+    assert ok.startswith(b'HTTP/1.0 200 OK\r\n') and ok.endswith(b'scrapes_total 1\n')
+    assert missing.startswith(b'HTTP/1.0 404')
+    assert not server.clients
+
+
+if __name__ == '__main__':
+    test_render()
+    test_server()
+    print('Tests Successful...')
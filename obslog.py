@@ -0,0 +1,450 @@
+"""Append-only log of station sightings in time-rotated segment files.
+
+ObservationLog is a Sniffer observer, like history.HistorySink, for rates
+SQLite cannot keep up with. Every sighting becomes a fixed-width record
+
+    mac (int), time, signal, freq (MHz), bssid index
+
+appended to the segment file covering its capture time, <start>.<n>.seg.
+Writes go through a 64 kB buffer, there is no per-record I/O. When a
+segment ends it is sealed with <start>.<n>.idx:
+
+    header | BSSIDs | (min, max) time per BLOCK records | MAC Bloom filter
+
+The Bloom filter is filled as new MACs show up, the block ranges as
+records are appended, so sealing only writes them out. A lookup of one MAC
+skips segments outside the time range or whose filter rules the MAC out,
+and reads only the blocks of the rest that overlap the range, through
+mmap. Retention deletes whole segments.
+
+The BSSIDs of the active segment are appended to <start>.<n>.bss before
+any record referring to them is written, so unsealed segments (the active
+one, or one left by a crash) resolve them too; sealing folds them into the
+index and removes the file.
+"""
+
+import array
+import bisect
+import glob
+import mmap
+import os
+import struct
+
+MAGIC = b'WOLX'
+VERSION = 1
+
+# mac, time, signal, freq, bssid index (0: none)
+_RECORD = struct.Struct('<QdbxHI')
+# magic, version, bloom hashes, start, end, records, block size, BSSIDs, bloom bytes
+_IDX = struct.Struct('<4sHBxddIIII')
+
+BLOCK = 1024
+BLOOM_BITS = 1 << 20
+BLOOM_HASHES = 7
+
+# replaced segments are truncated by this much per step before unlinking,
+# freeing a big file in one go takes long
+TRUNCATE_BYTES = 16 << 20
+
+_M64 = (1 << 64) - 1
+
+
+def _bloom_positions(mac, bits, k):
+    h = (mac * 0x9e3779b97f4a7c15) & _M64
+    h1, h2 = h & 0xffffffff, (h >> 32) | 1
+    return [(h1 + i * h2) % bits for i in range(k)]
+
+
+def _mac_string(value):
+    return ':'.join('%02x' % b for b in value.to_bytes(6, 'big'))
+
+
+class _Segment(object):
+    """What is known about a segment without reading its records."""
+
+    def __init__(self, path, start, end, count, bssids, blocks, bloom, k):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.count = count
+        self.bssids = bssids
+        self.blocks = blocks
+        self.bloom = bloom
+        self.k = k
+
+    def may_contain(self, mac):
+        bloom = self.bloom
+        if bloom is None:
+            return True
+        for p in _bloom_positions(mac, len(bloom) * 8, self.k):
+            if not bloom[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def search(self, mac, since, until):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return []
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            count = min(self.count, size // _RECORD.size) if self.count is not None else size // _RECORD.size
+            if not count:
+                return []
+            out = []
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                blocks = self.blocks
+                nblocks = (count + BLOCK - 1) // BLOCK
+                for b in range(nblocks):
+                    if blocks is not None and b < len(blocks) // 2:
+                        lo, hi = blocks[2 * b], blocks[2 * b + 1]
+                        if hi < since or lo > until:
+                            continue
+                    first = b * BLOCK * _RECORD.size
+                    last = min(count, (b + 1) * BLOCK) * _RECORD.size
+                    for r_mac, t, signal, freq, bssid in _RECORD.iter_unpack(m[first:last]):
+                        if r_mac == mac and since <= t <= until:
+                            # a crash may lose the end of the .bss file
+                            ap = self.bssids[bssid - 1] if 0 < bssid <= len(self.bssids) else None
+                            out.append((t, signal, freq, ap))
+            finally:
+                m.close()
+            return out
+
+
+def _read_index(idx_path, seg_path):
+    with open(idx_path, 'rb') as f:
+        data = f.read()
+    magic, version, k, start, end, count, block, nbssids, nbloom = _IDX.unpack_from(data)
+    if magic != MAGIC or version != VERSION or block != BLOCK:
+        raise ValueError('%s: not a version %d index' % (idx_path, VERSION))
+    pos = _IDX.size
+    bssids = [_mac_string(int.from_bytes(data[pos + 6 * i:pos + 6 * i + 6], 'big')) for i in range(nbssids)]
+    pos += 6 * nbssids
+    nblocks = (count + BLOCK - 1) // BLOCK
+    blocks = array.array('d', data[pos:pos + 16 * nblocks])
+    pos += 16 * nblocks
+    bloom = data[pos:pos + nbloom]
+    return _Segment(seg_path, start, end, count, bssids, blocks, bloom, k)
+
+
+def _read_bssids(bss_path):
+    try:
+        with open(bss_path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    return [_mac_string(int.from_bytes(data[i:i + 6], 'big')) for i in range(0, len(data) - 5, 6)]
+
+
+def _segment_files(directory):
+    """(start, part, path) of the segment files in directory, by name."""
+    out = []
+    for name in os.listdir(directory):
+        parts = name.split('.')
+        if len(parts) == 3 and parts[2] == 'seg':
+            out.append((int(parts[0]), int(parts[1]), os.path.join(directory, name)))
+    out.sort()
+    return out
+
+
+def segments(directory):
+    """Sealed and unsealed segments in directory, oldest first. Unsealed
+    ones (the active segment, or one left by a crash) have no index and
+    are read whole; they may hold late records from before the start in
+    their name, so their start is unknown (-inf)."""
+    out = []
+    for seg_path in glob.glob(os.path.join(directory, '*.seg')):
+        idx_path = seg_path[:-4] + '.idx'
+        if os.path.exists(idx_path):
+            out.append(_read_index(idx_path, seg_path))
+        else:
+            bssids = _read_bssids(seg_path[:-4] + '.bss')
+            out.append(_Segment(seg_path, float('-inf'), float('inf'), None, bssids, None, None, 0))
+    out.sort(key=lambda s: (s.start, s.path))
+    return out
+
+
+def _key(mac):
+    if isinstance(mac, str):
+        mac = bytes.fromhex(mac.replace(':', ''))
+    return int.from_bytes(mac, 'big')
+
+
+def query(directory, mac, since=None, until=None, segs=None):
+    """Return the (time, signal, freq, bssid) sightings of mac between since
+    and until, in time order."""
+    key = _key(mac)
+    lo = float('-inf') if since is None else since
+    hi = float('inf') if until is None else until
+    out = []
+    for seg in segs if segs is not None else segments(directory):
+        if seg.start > hi or seg.end <= lo or not seg.may_contain(key):
+            continue
+        out += seg.search(key, lo, hi)
+    out.sort()
+    return out
+
+
+class ObservationLog(object):
+
+    segment_seconds = 3600
+    retention = 7 * 86400
+
+    def __init__(self, directory, segment_seconds=None, retention=None, bloom_bits=BLOOM_BITS):
+        self.directory = directory
+        if segment_seconds is not None:
+            self.segment_seconds = segment_seconds
+        if retention is not None:
+            self.retention = retention
+        self.bloom_bits = bloom_bits
+        os.makedirs(directory, exist_ok=True)
+        self.records = 0
+        self.segments_sealed = 0
+        self.newest = None
+        self._f = None
+        self._buf = bytearray()
+        self._start = None
+        self._end = None
+        self._expiring = None
+        # (start, part, path) of the segments by name, read on first expire()
+        self._files = None
+
+    # the active segment
+
+    def _open(self, t):
+        start = int(t // self.segment_seconds * self.segment_seconds)
+        n = 0
+        while True:
+            path = os.path.join(self.directory, '%d.%d.seg' % (start, n))
+            if not os.path.exists(path):
+                break
+            n += 1
+        self._path = path
+        self._f = open(path, 'ab')
+        self._bss = open(path[:-4] + '.bss', 'ab')
+        self._bss_written = 0
+        if self._files is not None:
+            bisect.insort(self._files, (start, n, path))
+        self._start = start
+        self._end = start + self.segment_seconds
+        self._count = 0
+        self._macs = set()
+        self._bloom = bytearray(self.bloom_bits // 8)
+        self._bssids = {}
+        self._bssid_list = []
+        self._blocks = array.array('d')
+        self._bmin = float('inf')
+        self._bmax = float('-inf')
+        # earliest record, late ones stay in the active segment
+        self._tmin = start
+
+    def observe(self, mac, time, signal, freq, bssid):
+        if self._f is None or time >= self._end:
+            if self._f is not None:
+                self.seal()
+            self._open(time)
+        key = int.from_bytes(mac, 'big')
+        if key not in self._macs:
+            self._macs.add(key)
+            bloom = self._bloom
+            for p in _bloom_positions(key, self.bloom_bits, BLOOM_HASHES):
+                bloom[p >> 3] |= 1 << (p & 7)
+        b = 0
+        if bssid is not None:
+            b = self._bssids.get(bssid)
+            if b is None:
+                self._bssid_list.append(bssid)
+                b = self._bssids[bssid] = len(self._bssid_list)
+        self._buf += _RECORD.pack(key, time, signal or 0, freq or 0, b)
+        if time < self._bmin:
+            self._bmin = time
+            if time < self._tmin:
+                self._tmin = time
+        if time > self._bmax:
+            self._bmax = time
+        self._count += 1
+        if not self._count % BLOCK:
+            self._blocks.append(self._bmin)
+            self._blocks.append(self._bmax)
+            self._bmin = float('inf')
+            self._bmax = float('-inf')
+        if self.newest is None or time > self.newest:
+            self.newest = time
+        self.records += 1
+        if len(self._buf) >= 65536:
+            self.flush()
+
+    def flush(self):
+        if self._bss_written < len(self._bssid_list):
+            # before the records that refer to them
+            self._bss.write(b''.join(self._bssid_list[self._bss_written:]))
+            self._bss.flush()
+            self._bss_written = len(self._bssid_list)
+        if self._buf:
+            self._f.write(self._buf)
+            self._f.flush()
+            self._buf = bytearray()
+
+    def _blocks_so_far(self):
+        blocks = array.array('d', self._blocks)
+        if self._count % BLOCK:
+            blocks.append(self._bmin)
+            blocks.append(self._bmax)
+        return blocks
+
+    def seal(self):
+        """Close the active segment and write its index."""
+        self.flush()
+        self._f.close()
+        self._f = None
+        blocks = self._blocks_so_far()
+        tmp = self._path[:-4] + '.idx.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_IDX.pack(MAGIC, VERSION, BLOOM_HASHES, self._tmin, self._end, self._count, BLOCK,
+                              len(self._bssid_list), len(self._bloom)))
+            f.write(b''.join(self._bssid_list))
+            f.write(blocks.tobytes())
+            f.write(self._bloom)
+        os.replace(tmp, self._path[:-4] + '.idx')
+        self._bss.close()
+        os.unlink(self._path[:-4] + '.bss')
+        self.segments_sealed += 1
+
+    def close(self):
+        if self._f is not None:
+            self.seal()
+
+    def active(self):
+        """The active segment as a _Segment, with its in-memory index."""
+        if self._f is None:
+            return None
+        self.flush()
+        return _Segment(self._path, self._tmin, self._end, self._count,
+                        [_mac_string(int.from_bytes(b, 'big')) for b in self._bssid_list],
+                        self._blocks_so_far(), bytes(self._bloom), BLOOM_HASHES)
+
+    def query(self, mac, since=None, until=None):
+        segs = [s for s in segments(self.directory) if self._f is None or s.path != self._path]
+        active = self.active()
+        if active is not None:
+            segs.append(active)
+        return query(self.directory, mac, since, until, segs)
+
+    # retention
+
+    def expire(self):
+        """Delete a step of the segments that fell out of retention, counted
+        back from the newest sighting. Call it periodically; returns True
+        while there is more to delete."""
+        if self._expiring is None:
+            if self.newest is None:
+                return False
+            if self._files is None:
+                self._files = _segment_files(self.directory)
+            horizon = self.newest - self.retention
+            # decided from the names, the indexes are not read
+            for i, (start, n, path) in enumerate(self._files):
+                if start + self.segment_seconds > horizon:
+                    return False
+                if self._f is None or path != self._path:
+                    break
+            else:
+                return False
+            del self._files[i]
+            # the index goes first, the records are then invisible
+            for suffix in ('.idx', '.bss'):
+                try:
+                    os.unlink(path[:-4] + suffix)
+                except FileNotFoundError:
+                    pass
+            try:
+                self._expiring = open(path, 'r+b')
+            except FileNotFoundError:
+                return True
+            os.unlink(path)
+        f = self._expiring
+        size = max(0, os.fstat(f.fileno()).st_size - TRUNCATE_BYTES)
+        f.truncate(size)
+        if not size:
+            f.close()
+            self._expiring = None
+        return True
+
+
+def test_obslog():
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix='obslog')
+    log = ObservationLog(directory, segment_seconds=600, retention=1200, bloom_bits=1 << 14)
+    aps = [struct.pack('>HI', 0x0026, i) for i in range(3)]
+    macs = [struct.pack('>HI', 0x0200, i) for i in range(50)]
+    t0 = 1500000000.0
+    for i in range(30000):
+        # 3000 s of capture, some records arriving slightly out of order
+        t = t0 + i / 10.0 - (0.05 if i % 7 == 0 else 0)
+        log.observe(macs[i % 50], t, -40 - i % 30, 2412 + i % 3 * 25, aps[i % 3] if i % 4 else None)
+    assert log.records == 30000 and log.segments_sealed == 5
+
+    def expected(mac, since, until):
+        out = []
+        for i in range(30000):
+            t = t0 + i / 10.0 - (0.05 if i % 7 == 0 else 0)
+            if i % 50 == mac and since <= t <= until:
+                bssid = _mac_string(int.from_bytes(aps[i % 3], 'big')) if i % 4 else None
+                out.append((t, -40 - i % 30, 2412 + i % 3 * 25, bssid))
+        return out
+
+    # sealed segments and the active one, with its index in memory
+    assert log.query(macs[7], t0 + 500, t0 + 2500) == expected(7, t0 + 500, t0 + 2500)
+    assert log.query(macs[7], t0 + 2950) == expected(7, t0 + 2950, float('inf'))
+    assert log.query(b'\x02\x00\x00\x00\x01\x00') == []
+    # the active segment read from disk, unsealed, with the BSSIDs flushed so far
+    assert query(directory, macs[7], t0 + 2950) == expected(7, t0 + 2950, float('inf'))
+    log.close()
+    assert not glob.glob(os.path.join(directory, '*.bss'))
+    assert len(glob.glob(os.path.join(directory, '*.idx'))) == 6
+    assert query(directory, '02:00:00:00:00:07', t0 + 1000, t0 + 1100) == expected(7, t0 + 1000, t0 + 1100)
+
+    # a lookup reads only the blocks in range of segments that may hold the MAC
+    segs = segments(directory)
+    assert [s.start for s in segs] == [1499999400 + 600 * n for n in range(6)]
+    # the first segment only holds the late first record
+    assert all(s.may_contain(_key(macs[3])) for s in segs[1:])
+    assert sum(not s.may_contain(_key(struct.pack('>HI', 0x0300, i))) for s in segs for i in range(100)) > 500
+    searched = []
+    orig = _Segment.search
+
+    def search(self, mac, since, until):
+        searched.append(self.start)
+        return orig(self, mac, since, until)
+    _Segment.search = search
+    try:
+        query(directory, macs[3], t0 + 700, t0 + 800)
+    finally:
+        _Segment.search = orig
+    assert searched == [1500000600]
+
+    # a restart within a segment opens a new part, retention drops whole segments
+    log = ObservationLog(directory, segment_seconds=600, retention=1200, bloom_bits=1 << 14)
+    log.observe(macs[0], t0 + 2999.5, -50, 2412, None)
+    assert log._path.endswith('1500002400.1.seg')
+    while log.expire():
+        pass
+    # a late record stays in the active segment, which then starts earlier
+    log.observe(macs[1], t0 + 2300.0, -50, 2412, None)
+    assert log.active().start == t0 + 2300.0
+    assert log.query(macs[1], t0 + 2300.0, t0 + 2300.0) == [(t0 + 2300.0, -50, 2412, None)]
+    assert [s.start for s in segments(directory)] == [float('-inf'), 1500001200, 1500001800, 1500002400]
+    # found after a crash too, without the start the segment had in memory
+    log.flush()
+    assert query(directory, macs[1], t0 + 2300.0, t0 + 2300.0) == [(t0 + 2300.0, -50, 2412, None)]
+    log.close()
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    test_obslog()
+    print('Tests Successful...')
@@ -0,0 +1,261 @@
+"""Analytics plugin API.
+
+A plugin declares the (type, subtype) pairs of 802.11 frames it wants to
+see, optionally restricted to some to_ds/from_ds states, and what it needs
+decoded from them. SnifferWorker builds a dispatch table from all
+declarations: frames nobody subscribed to are dropped after looking at two
+bytes of the raw buffer, of the IEs only the union of what the subscribers
+of a subtype asked for is decoded, and a plugin only gets the to_ds/from_ds
+states it subscribed to, whatever the kernel filter let through.
+"""
+
+import time
+import bpf
+from dpkt import ieee80211
+
+ANY = None          # subtype wildcard
+
+# (to_ds, from_ds) states a subscription may be restricted to
+TO_DS = ((True, False),)
+FROM_DS = ((False, True),)
+WDS = ((True, True),)
+# dispatch masks have bit to_ds | from_ds << 1 set for every state wanted,
+# the same as the low two bits of the frame control flags
+ANY_DS = 0xf
+
+NEED_IES = 'ies'    # all information elements (IEEE80211.ies, .ssid, ...)
+# an IE id (ieee80211.IE_SSID, ...) in needs asks for that IE alone
+
+
+class FrameInfo(object):
+    """Per frame metadata handed to plugins next to the decoded frame.
+
+    timestamp is the kernel receive time (seconds since the epoch), tsft the
+    radiotap TSF timer in microseconds if the driver reports it. The worker
+    reuses a single instance, plugins must copy what they keep.
+    """
+
+    __slots__ = ('timestamp', 'tsft', 'channel', 'signal')
+
+    def __init__(self):
+        self.timestamp = None
+        self.tsft = None
+        self.channel = None
+        self.signal = None
+
+
+class Plugin(object):
+    """Base class for analytics plugins.
+
+    subscriptions is a sequence of (type, subtype) pairs, subtype may be
+    ANY, or (type, subtype, ds) with ds the (to_ds, from_ds) states wanted,
+    e.g. TO_DS + FROM_DS; handle() never sees the other states. needs
+    lists what has to be decoded: NEED_IES or the ids of the IEs wanted;
+    override needs_for() if that differs per subtype. handle() gets the
+    IEEE80211 frame and the FrameInfo. The frame objects come from the
+    worker's dpkt.Pool and are reused for the next frame once all plugins
+    returned: copy the values to keep, never the headers. The CPU time
+    spent in handle() is accounted in cpu_time, exceptions it raises are
+    counted in errors and do not stop the capture.
+    """
+
+    name = None
+    subscriptions = ()
+    needs = ()
+
+    def __init__(self, sniffer):
+        self.sniffer = sniffer
+        self.calls = 0
+        self.cpu_time = 0.0
+        self.errors = 0
+        if self.name is None:
+            self.name = self.__class__.__name__
+
+    def needs_for(self, type, subtype):
+        return self.needs
+
+    def handle(self, pkt, info):
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'cpu_time': self.cpu_time,
+            'errors': self.errors,
+            'us_per_call': self.cpu_time / self.calls * 1e6 if self.calls else 0.0,
+        }
+
+
+def _subscriptions(plugins):
+    """Yield (plugin, type, subtype, ds) with the subtype wildcard expanded,
+    ds None for any state."""
+    for p in plugins:
+        for sub in p.subscriptions:
+            type, subtype = sub[:2]
+            ds = sub[2] if len(sub) > 2 else None
+            for st in range(16) if subtype is ANY else (subtype,):
+                yield p, type, st, ds
+
+
+def _ds_mask(ds):
+    if ds is None:
+        return ANY_DS
+    mask = 0
+    for to_ds, from_ds in ds:
+        mask |= 1 << (bool(to_ds) | bool(from_ds) << 1)
+    return mask
+
+
+def _ies_needed(subscribers, type, subtype):
+    """True for all IEs, a frozenset of IE ids or False for none."""
+    ids = set()
+    for p in subscribers:
+        for need in p.needs_for(type, subtype):
+            if need == NEED_IES:
+                return True
+            if isinstance(need, int):
+                ids.add(need)
+    return frozenset(ids) if ids else False
+
+
+def build_dispatch(plugins):
+    """Return {(type, subtype): (subscribers, parse_ies)}, subscribers a
+    tuple of (plugin, ds mask) and parse_ies as taken by IEEE80211(ies=...)."""
+    table = {}
+    for p, type, st, ds in _subscriptions(plugins):
+        masks = table.setdefault((type, st), {})
+        masks[p] = masks.get(p, 0) | _ds_mask(ds)
+    dispatch = {}
+    for (type, st), masks in table.items():
+        dispatch[(type, st)] = (tuple(masks.items()), _ies_needed(masks, type, st))
+    return dispatch
+
+
+def selection(plugins):
+    """Return the bpf rules accepting exactly the subscribed frames."""
+    # type -> subtype -> (to_ds, from_ds) states, None for any
+    wanted = {}
+    for p, type, st, ds in _subscriptions(plugins):
+        states = wanted.setdefault(type, {})
+        if ds is None or states.get(st, ()) is None:
+            states[st] = None
+        else:
+            states[st] = states.get(st, frozenset()) | frozenset(ds)
+    rules = []
+    for type in sorted(wanted):
+        # subtypes grouped by the states they are wanted in
+        groups = {}
+        for st, states in wanted[type].items():
+            for state in [None] if states is None else sorted(states):
+                groups.setdefault(state, []).append(st)
+        for state in sorted(groups, key=lambda s: (s is not None, s)):
+            subtypes = sorted(groups[state])
+            to_ds, from_ds = state if state is not None else (None, None)
+            rules.append(bpf.Rule(type, None if len(subtypes) == 16 else subtypes, to_ds, from_ds))
+    return rules
+
+
+def run(subscribers, pkt, info, ds=0):
+    """Hand the frame to the subscribers that want its ds state, the low two
+    bits of the frame control flags."""
+    perf_counter = time.perf_counter
+    for p, mask in subscribers:
+        if not mask >> ds & 1:
+            continue
+        t0 = perf_counter()
+        try:
+            p.handle(pkt, info)
+        except Exception:
+            p.errors += 1
+        p.cpu_time += perf_counter() - t0
+        p.calls += 1
+
+
+def test_dispatch():
+    class Beacons(Plugin):
+        subscriptions = ((ieee80211.MGMT_TYPE, ieee80211.M_BEACON),)
+        needs = (NEED_IES,)
+
+        def handle(self, pkt, info):
+            self.seen = pkt
+
+    class Mgmt(Plugin):
+        subscriptions = ((ieee80211.MGMT_TYPE, ANY),)
+
+        def handle(self, pkt, info):
+            pass
+
+    class Ssids(Plugin):
+        subscriptions = ((ieee80211.MGMT_TYPE, ieee80211.M_PROBE_REQ), (ieee80211.MGMT_TYPE, ieee80211.M_BEACON))
+        needs = (ieee80211.IE_SSID,)
+
+    class Rates(Plugin):
+        subscriptions = ((ieee80211.MGMT_TYPE, ieee80211.M_PROBE_REQ),)
+        needs = (ieee80211.IE_RATES, ieee80211.IE_ESR)
+
+    class Data(Plugin):
+        subscriptions = ((ieee80211.DATA_TYPE, ieee80211.D_DATA, TO_DS + FROM_DS),
+                         (ieee80211.DATA_TYPE, ieee80211.D_QOS_DATA, TO_DS))
+
+    b, m, data = Beacons(None), Mgmt(None), Data(None)
+    d = build_dispatch([b, m, data])
+    assert d[(ieee80211.MGMT_TYPE, ieee80211.M_BEACON)] == (((b, ANY_DS), (m, ANY_DS)), True)
+    assert d[(ieee80211.MGMT_TYPE, ieee80211.M_PROBE_REQ)] == (((m, ANY_DS),), False)
+    assert d[(ieee80211.DATA_TYPE, ieee80211.D_QOS_DATA)] == (((data, 0x2),), False)
+    assert d[(ieee80211.DATA_TYPE, ieee80211.D_DATA)] == (((data, 0x6),), False)
+    assert (ieee80211.CTL_TYPE, ieee80211.C_ACK) not in d
+    # the union of the IEs asked for, all of them if anyone needs all
+    ies = build_dispatch([b, Ssids(None), Rates(None)])
+    assert ies[(ieee80211.MGMT_TYPE, ieee80211.M_PROBE_REQ)][1] == frozenset(
+        [ieee80211.IE_SSID, ieee80211.IE_RATES, ieee80211.IE_ESR])
+    assert ies[(ieee80211.MGMT_TYPE, ieee80211.M_BEACON)][1] is True
+    rules = selection([b, m])
+    assert len(rules) == 1 and rules[0].type == ieee80211.MGMT_TYPE and not rules[0].subtypes
+
+    # the kernel filter keeps the DS constraints, WDS frames are dropped
+    prog = bpf.compile_selection(selection([b, m, data]))
+
+    def frame(fc0, fc1):
+        return b'\x00\x00\x08\x00\x00\x00\x00\x00' + bytes([fc0, fc1]) + b'\x00' * 22
+
+    assert [bool(bpf.run(prog, frame(fc0, fc1))) for fc0, fc1 in (
+        (0x80, 0x00), (0x08, 0x01), (0x08, 0x02), (0x08, 0x03), (0x88, 0x01), (0x88, 0x02), (0xd4, 0x00))] == \
+        [True, True, True, False, True, False, False]
+
+    run(d[(ieee80211.MGMT_TYPE, ieee80211.M_BEACON)][0], 'frame', FrameInfo())
+    assert b.seen == 'frame' and b.calls == 1 and m.calls == 1
+    assert b.stats()['cpu_time'] >= 0
+
+    # the same subtype in different states: each plugin gets its own, even
+    # when the kernel filter passes the union or is not attached
+    class Uplink(Plugin):
+        subscriptions = ((ieee80211.DATA_TYPE, ieee80211.D_DATA, TO_DS),)
+
+        def handle(self, pkt, info):
+            self.seen.append(pkt)
+
+    class Downlink(Uplink):
+        subscriptions = ((ieee80211.DATA_TYPE, ieee80211.D_DATA, FROM_DS),)
+
+    up, down = Uplink(None), Downlink(None)
+    up.seen, down.seen = [], []
+    subscribers = build_dispatch([up, down])[(ieee80211.DATA_TYPE, ieee80211.D_DATA)][0]
+    for ds in range(4):
+        run(subscribers, ds, FrameInfo(), ds)
+    assert (up.seen, down.seen) == ([1], [2])
+
+    # a failing plugin is counted, the others still get the frame
+    class Broken(Plugin):
+        subscriptions = ((ieee80211.DATA_TYPE, ieee80211.D_DATA),)
+
+        def handle(self, pkt, info):
+            raise ValueError(pkt)
+
+    broken = Broken(None)
+    run(build_dispatch([broken, up])[(ieee80211.DATA_TYPE, ieee80211.D_DATA)][0], 'frame', FrameInfo(), 1)
+    assert broken.stats()['errors'] == 1 and broken.calls == 1 and up.seen == [1, 'frame']
+
+
+if __name__ == '__main__':
+    test_dispatch()
+    print('Tests Successful...')
@@ -0,0 +1,243 @@
+"""Replay a radiotap pcap through a SnifferWorker.
+
+PcapReplay stands in for the raw socket: frames read from the capture are
+written to a datagram socketpair on the schedule of their pcap timestamps,
+and the worker reads them from the event loop with the same handler as
+live traffic. The pcap timestamp is handed over as the kernel receive time,
+so everything downstream sees capture time.
+"""
+
+import collections
+import socket
+import time
+import eloop
+from dpkt import pcap
+
+
+class PcapReplay(object):
+    """speed is the playback rate relative to the capture, 0 plays as fast
+    as possible. A frame delivered more than max_lag seconds after it was
+    due counts as late: the loop did not keep up with the offered rate.
+    on_done(replay) is called after the last frame was handled.
+
+    On a simulated EventLoop (eloop.VirtualClock) the clock starts at the
+    first capture timestamp; at speed 1 frames and timers then run in
+    capture time without waiting between them.
+    """
+
+    # frames written per feed, the worker reads one per loop iteration
+    BATCH = 64
+
+    def __init__(self, worker, fileobj, speed=1.0, max_lag=0.1, on_done=None):
+        self.reader = pcap.Reader(fileobj)
+        if self.reader.datalink() != pcap.DLT_IEEE802_11_RADIO:
+            raise ValueError('%s: not a radiotap capture (linktype %d)' % (self.reader.name, self.reader.datalink()))
+        self.worker = worker
+        self.eloop = worker.eloop
+        self.speed = speed
+        self.max_lag = max_lag
+        self.on_done = on_done
+        self._packets = iter(self.reader)
+        self._next = None
+        self._pending = collections.deque()
+        self._rsock = None
+        self._wsock = None
+        self.done = False
+        # statistics
+        self.frames = 0
+        self.bytes = 0
+        self.late = 0
+        self.max_delay = 0.0
+        self.busy_time = 0.0
+        self.first_ts = None
+        self.last_ts = None
+        self.started = None
+        self.finished = None
+
+    def fileno(self):
+        return self._rsock.fileno()
+
+    def start(self):
+        self._rsock, self._wsock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+        self._advance()
+        if self._next is not None:
+            self.first_ts = self._next[0]
+            if self.eloop.simulated:
+                # simulated time is capture time
+                self.eloop.clock.advance_to(self.first_ts)
+        self.started = self.eloop._time()
+        self.eloop.register(self, eloop.EVENT_READ, self.on_readable)
+        if self._next is None:
+            # an empty capture, nothing will ever be readable
+            self.eloop.register_timeout(0, self.finish)
+        else:
+            self.eloop.register_timeout(0, self.feed)
+
+    def _advance(self):
+        self._next = next(self._packets, None)
+
+    def _due(self, ts):
+        return self.started + (ts - self.first_ts) / self.speed
+
+    def feed(self, arg):
+        t0 = time.perf_counter()
+        now = self.eloop._time()
+        delay = 0
+        for i in range(self.BATCH):
+            if self._next is None:
+                break
+            ts, buf = self._next
+            due = self._due(ts) if self.speed else now
+            if due > now:
+                delay = due - now
+                break
+            try:
+                self._wsock.send(buf)
+            except BlockingIOError:
+                # the worker drains the socket before the next feed
+                break
+            self._pending.append((ts, due))
+            self.bytes += len(buf)
+            self._advance()
+        if self._next is not None:
+            self.eloop.register_timeout(delay, self.feed)
+        self.busy_time += time.perf_counter() - t0
+
+    def recvmsg(self, bufsize, ancbufsize=0, flags=0):
+        buf, ancdata, flags, addr = self._rsock.recvmsg(bufsize, 0, flags)
+        ts, due = self._pending.popleft()
+        delay = self.eloop._time() - due
+        if delay > self.max_delay:
+            self.max_delay = delay
+        if delay > self.max_lag:
+            self.late += 1
+        self.frames += 1
+        self.last_ts = ts
+        return buf, self.worker.timestamp_ancdata(ts), flags, addr
+
+    def on_readable(self, fd, mask, arg):
+        t0 = time.perf_counter()
+        self.worker.on_raw_packet_received(self, mask, arg)
+        self.busy_time += time.perf_counter() - t0
+        if self._next is None and not self._pending:
+            self.finish()
+
+    def finish(self, arg=None):
+        self.finished = self.eloop._time()
+        self.done = True
+        self.eloop.unregister(self)
+        self._rsock.close()
+        self._wsock.close()
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def stats(self):
+        elapsed = (self.finished or self.eloop._time()) - self.started
+        duration = (self.last_ts - self.first_ts) if self.frames else 0.0
+        return {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'capture_duration': duration,
+            'elapsed': elapsed,
+            'speed': self.speed,
+            'offered_fps': self.frames / duration * self.speed if duration and self.speed else None,
+            'achieved_fps': self.frames / elapsed if elapsed else 0.0,
+            # the rate the loop could sustain if it never waited for frames
+            'sustainable_fps': self.frames / self.busy_time if self.busy_time else 0.0,
+            'late': self.late,
+            'max_delay': self.max_delay,
+        }
+
+    def report(self):
+        s = self.stats()
+        lines = ['%s: %d frames, %d bytes, %.1f s of capture in %.1f%s s' % (
+            self.reader.name, s['frames'], s['bytes'], s['capture_duration'], s['elapsed'],
+            ' simulated' if self.eloop.simulated else '')]
+        if s['offered_fps'] is not None:
+            lines.append('  offered %.0f frames/s at %gx' % (s['offered_fps'], s['speed']))
+        lines.append('  achieved %.0f frames/s, sustainable %.0f frames/s' % (s['achieved_fps'], s['sustainable_fps']))
+        lines.append('  %d frames more than %g s late, max delay %.3f s' % (s['late'], self.max_lag, s['max_delay']))
+        return '\n'.join(lines)
+
+
+def _capture(frames, linktype=pcap.DLT_IEEE802_11_RADIO):
+    import io
+    f = io.BytesIO()
+    w = pcap.Writer(f, snaplen=65535, linktype=linktype)
+    for ts, buf in frames:
+        w.writepkt(buf, ts)
+    f.seek(0)
+    return f
+
+
+def test_replay():
+    import struct
+    import sniffer
+
+    def beacon(ssid):
+        rt = b'\x00\x00\x10\x00\x2e\x00\x00\x00\x10\x02\x6c\x09\xa0\x00\xc4\x00'
+        hdr = b'\x80\x00\x00\x00' + b'\xff' * 6 + b'\x00\x26\xcb\x18\x6a\x30' * 2 + b'\x00\x00'
+        fixed = struct.pack('<QHH', 0, 100, 0x0411)
+        return rt + hdr + fixed + b'\x00' + bytes([len(ssid)]) + ssid + b'\x03\x01\x06'
+
+    frames = [(1500000000.0 + i / 64.0, beacon(b'home')) for i in range(20)]
+    for speed in (0, 10.0):
+        s = sniffer.Sniffer()
+        s.disable_transport = True
+        w = sniffer.SnifferWorker(s)
+        r = PcapReplay(w, _capture(frames), speed=speed, on_done=lambda r: s.eloop.stop())
+        w.replay = r
+        w.init()
+        s.eloop.run()
+        st = r.stats()
+        assert r.done and st['frames'] == 20 and st['sustainable_fps'] > 0
+        ap, = [ap for aps in s.ap_database.ap_macs.values() for ap in aps]
+        # receive times are the pcap timestamps
+        assert (ap.first_seen, ap.time) == (frames[0][0], frames[-1][0])
+    # 0.3 s of capture at 10x
+    assert st['elapsed'] >= 0.029 and st['offered_fps'] > 0
+
+    # an hour of capture on a virtual clock, with a timer every minute
+    frames = [(1500000000.0 + i * 180, beacon(b'home')) for i in range(21)]
+    s = sniffer.Sniffer()
+    s.eloop.set_clock(eloop.VirtualClock())
+    s.disable_transport = True
+    w = sniffer.SnifferWorker(s)
+    w.replay = r = PcapReplay(w, _capture(frames), on_done=lambda r: s.eloop.stop())
+    ticks = []
+
+    def minute(arg):
+        ticks.append((s.eloop.wall_time(), r.frames))
+        s.eloop.register_timeout(60, minute)
+
+    w.init()
+    s.eloop.register_timeout(60, minute)
+    t0 = time.monotonic()
+    s.eloop.run()
+    assert time.monotonic() - t0 < 5
+    assert r.stats()['elapsed'] == 3600
+    assert ticks[0] == (frames[0][0] + 60, 1) and ticks[3] == (frames[1][0] + 60, 2)
+
+    # a header-only capture finishes too
+    s = sniffer.Sniffer()
+    s.disable_transport = True
+    w = sniffer.SnifferWorker(s)
+    w.replay = r = PcapReplay(w, _capture([]), on_done=lambda r: s.eloop.stop())
+    w.init()
+    s.eloop.register_timeout(5, lambda arg: s.eloop.stop())
+    s.eloop.run()
+    assert r.done and r.stats()['frames'] == 0
+
+    try:
+        PcapReplay(w, _capture([], pcap.DLT_EN10MB))
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+if __name__ == '__main__':
+    test_replay()
+    print('Tests Successful...')
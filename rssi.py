@@ -0,0 +1,105 @@
+"""Streaming RSSI statistics."""
+
+import array
+
+HIST_MIN = -100     # dBm, lower edge of the second bucket
+HIST_STEP = 10      # dB per bucket
+HIST_BUCKETS = 8    # <-100, -100..-91, ..., -50..-41, >=-40
+
+
+class RssiStats(object):
+    """Per station signal statistics in constant memory.
+
+    update() keeps an exponentially weighted moving average, min/max, the
+    running mean and variance (Welford) and a fixed-bucket histogram. It
+    does not create any containers, the histogram is preallocated.
+    """
+
+    __slots__ = ('count', 'ewma', 'min', 'max', 'mean', '_m2', 'hist')
+
+    alpha = 0.25
+
+    def __init__(self):
+        self.count = 0
+        self.ewma = 0.0
+        self.min = 0
+        self.max = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.hist = array.array('I', bytes(4 * HIST_BUCKETS))
+
+    def update(self, dbm):
+        n = self.count + 1
+        self.count = n
+        if n == 1:
+            self.ewma = self.mean = float(dbm)
+            self.min = self.max = dbm
+        else:
+            self.ewma += self.alpha * (dbm - self.ewma)
+            if dbm < self.min:
+                self.min = dbm
+            elif dbm > self.max:
+                self.max = dbm
+            delta = dbm - self.mean
+            self.mean += delta / n
+            self._m2 += delta * (dbm - self.mean)
+        i = (dbm - HIST_MIN) // HIST_STEP + 1
+        if i < 0:
+            i = 0
+        elif i >= HIST_BUCKETS:
+            i = HIST_BUCKETS - 1
+        self.hist[i] += 1
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def stddev(self):
+        return self.variance ** 0.5
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'ewma': round(self.ewma, 2),
+            'min': self.min,
+            'max': self.max,
+            'mean': round(self.mean, 2),
+            'stddev': round(self.stddev, 2),
+            'hist': list(self.hist),
+        }
+
+    def __repr__(self):
+        return 'RssiStats(%r)' % self.to_dict()
+
+
+def test_rssi_stats():
+    import statistics
+
+    samples = [-40, -45, -90, -101, -20, -61, -62, -60]
+    st = RssiStats()
+    for s in samples:
+        st.update(s)
+    assert st.count == len(samples)
+    assert st.min == -101 and st.max == -20
+    assert abs(st.mean - statistics.mean(samples)) < 1e-9
+    assert abs(st.variance - statistics.variance(samples)) < 1e-9
+    assert list(st.hist) == [1, 0, 1, 0, 2, 1, 1, 2]
+    assert st.min <= st.ewma <= st.max
+
+
+def bench_update(n=200000):
+    """Time n updates; the capture path needs well over 200k/s."""
+    import timeit
+    st = RssiStats()
+    t = timeit.timeit('u(-55); u(-72); u(-38); u(-90)', globals={'u': st.update}, number=n // 4)
+    print('RssiStats.update: %.0f ns/frame, %.0f frames/s' % (t / n * 1e9, n / t))
+    return n / t
+
+
+if __name__ == '__main__':
+    test_rssi_stats()
+    print('Tests Successful...')
+    bench_update()
@@ -0,0 +1,395 @@
+"""Station/AP table snapshots for warm restarts.
+
+The file holds fixed-width records, stations then APs, each table sorted
+by (hash bucket, MAC) and preceded by a bucket offset table:
+
+    header | sta offsets | ap offsets | sta records | ap records
+
+offsets[h]..offsets[h + 1] are the records of bucket h. Restoring only
+maps the file and reads the offset tables; the records of a bucket become
+StationCache objects the first time the bucket is needed, and a loop timer
+works through the rest in small steps. A sensor is back in business
+immediately, however big the tables were.
+
+Saving is a generator that packs one bucket per step into a temporary
+file, renamed over the old snapshot when complete, so a crash never
+leaves a torn file and a periodic save never stalls capture. Attributes
+other than the ones the plugins set (see _STA and _AP) are not kept. The
+header also keeps the SequenceLinker's device counter, so that devices
+seen after a restart do not get the ids of restored stations.
+"""
+
+import array
+import mmap
+import os
+import struct
+import time
+import rssi
+
+MAGIC = b'WSNP'
+VERSION = 2
+
+# magic, version, saved, sta buckets, ap buckets, sta records, ap records,
+# device ids handed out
+_HEADER = struct.Struct('<4sH2xdIIIIQ')
+# mac, flags, signal, first_seen, time, fingerprint, device,
+# rssi count, ewma, mean, m2, min, max, histogram
+_STA = struct.Struct('<6sBbddQIIdddbb%dI' % rssi.HIST_BUCKETS)
+# station fields, then channel, privacy, ssid, rsn
+_AP = struct.Struct(_STA.format + 'BB33s41s')
+
+F_SIGNAL = 0x01
+F_RSSI = 0x02
+F_FINGERPRINT = 0x04
+F_DEVICE = 0x08
+F_HT = 0x10
+F_SSID = 0x20
+F_RSN = 0x40
+
+# written data is synced in pieces of this size, so the final fsync does
+# not have to flush the whole file at once
+SYNC_BYTES = 1 << 20
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+# the replaced snapshot is truncated by this much per step: freeing a big
+# file in one go takes tens of milliseconds
+TRUNCATE_BYTES = 8 << 20
+
+_NONE = 0xff
+_SSID_MAX = 32
+_RSN_MAX = 40
+
+
+def _pack_sta(e):
+    flags = 0
+    signal = e.signal
+    if signal is None:
+        signal = 0
+    else:
+        flags |= F_SIGNAL
+    r = e.rssi
+    if r is not None:
+        flags |= F_RSSI
+        stats = (r.count, r.ewma, r.mean, r._m2, r.min, r.max) + tuple(r.hist)
+    else:
+        stats = (0, 0.0, 0.0, 0.0, 0, 0) + (0,) * rssi.HIST_BUCKETS
+    d = e.__dict__
+    fp = d.get('fingerprint')
+    if fp is not None:
+        flags |= F_FINGERPRINT
+    device = d.get('device')
+    if device is not None:
+        flags |= F_DEVICE
+    return flags, (e.mac, signal, e.first_seen, e.time, fp or 0, device or 0) + stats
+
+
+def _pack_ap(e):
+    flags, fields = _pack_sta(e)
+    d = e.__dict__
+    if d.get('ht'):
+        flags |= F_HT
+    ssid = d.get('ssid')
+    if ssid is not None:
+        flags |= F_SSID
+        ssid = ssid.encode('utf8')[:_SSID_MAX]
+        ssid = bytes([len(ssid)]) + ssid
+    rsn = d.get('rsn')
+    if rsn is not None and len(rsn) <= 2 * _RSN_MAX:
+        flags |= F_RSN
+        rsn = bytes.fromhex(rsn)
+        rsn = bytes([len(rsn)]) + rsn
+    channel = d.get('channel')
+    privacy = d.get('privacy')
+    return flags, fields + (_NONE if channel is None else channel, _NONE if privacy is None else privacy,
+                            ssid or b'', rsn or b'')
+
+
+def _unpack_sta(cls, fields):
+    (mac, flags, signal, first_seen, t, fp, device,
+     count, ewma, mean, m2, lo, hi) = fields[:13]
+    e = cls.__new__(cls)
+    d = {'mac': mac, 'first_seen': first_seen, 'time': t,
+         'signal': signal if flags & F_SIGNAL else None, 'rssi': None}
+    if flags & F_RSSI:
+        r = d['rssi'] = rssi.RssiStats.__new__(rssi.RssiStats)
+        r.count = count
+        r.ewma = ewma
+        r.mean = mean
+        r._m2 = m2
+        r.min = lo
+        r.max = hi
+        r.hist = array.array('I', fields[13:13 + rssi.HIST_BUCKETS])
+    if flags & F_FINGERPRINT:
+        d['fingerprint'] = fp
+    if flags & F_DEVICE:
+        d['device'] = device
+    e.__dict__ = d
+    return e
+
+
+def _unpack_ap(cls, fields):
+    e = _unpack_sta(cls, fields)
+    flags = fields[1]
+    channel, privacy, ssid, rsn = fields[-4:]
+    d = e.__dict__
+    d['ssid'] = ssid[1:1 + ssid[0]].decode('utf8', 'replace') if flags & F_SSID else None
+    d['channel'] = None if channel == _NONE else channel
+    d['privacy'] = None if privacy == _NONE else privacy
+    d['rsn'] = rsn[1:1 + rsn[0]].hex() if flags & F_RSN else None
+    d['ht'] = bool(flags & F_HT)
+    return e
+
+
+def _mac(e):
+    return e.mac
+
+
+def writer(path, tables, saved, devices=None):
+    """Generator writing a snapshot of tables, [(bucket, size)] for the
+    station and the AP table where bucket(h) returns the entries of bucket
+    h or None. devices() returns the number of device ids handed out, it is
+    called once all records are written. It yields after every bucket, and
+    while it frees the file it replaced. Closing it before the new file was
+    renamed into place removes the partial file.
+    """
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    complete = False
+    try:
+        sizes = [size for bucket, size in tables]
+        header = _HEADER.size + sum(4 * (size + 1) for size in sizes)
+        f.write(bytes(header))
+        all_offsets = []
+        unsynced = 0
+        for (bucket, size), (record, pack) in zip(tables, ((_STA, _pack_sta), (_AP, _pack_ap))):
+            offsets = array.array('I', bytes(4 * (size + 1)))
+            buf = bytearray()
+            n = 0
+            for h in range(size):
+                entries = bucket(h)
+                if entries:
+                    for e in sorted(entries, key=_mac):
+                        flags, fields = pack(e)
+                        buf += record.pack(fields[0], flags, *fields[1:])
+                    n += len(entries)
+                    if len(buf) >= 65536:
+                        f.write(buf)
+                        unsynced += len(buf)
+                        buf = bytearray()
+                        if unsynced >= SYNC_BYTES:
+                            f.flush()
+                            _fdatasync(f.fileno())
+                            unsynced = 0
+                offsets[h + 1] = n
+                yield
+            f.write(buf)
+            all_offsets.append(offsets)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, saved, sizes[0], sizes[1],
+                             all_offsets[0][-1], all_offsets[1][-1], devices() if devices else 0))
+        for offsets in all_offsets:
+            f.write(offsets.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        try:
+            old = open(path, 'r+b')
+        except FileNotFoundError:
+            old = None
+        os.replace(tmp, path)
+        complete = True
+        if old is not None:
+            with old:
+                size = os.fstat(old.fileno()).st_size
+                while size > 0:
+                    size = max(0, size - TRUNCATE_BYTES)
+                    old.truncate(size)
+                    yield
+    finally:
+        if not complete:
+            f.close()
+            os.unlink(tmp)
+
+
+def save(path, tables, saved, devices=None):
+    for step in writer(path, tables, saved, devices):
+        pass
+
+
+class Table(object):
+    """The records of one table in a mapped snapshot, handed out a bucket
+    at a time."""
+
+    def __init__(self, snapshot, offsets, base, record, unpack):
+        self.snapshot = snapshot
+        self.offsets = offsets
+        self.base = base
+        self.record = record
+        self.unpack = unpack
+        self.size = len(offsets) - 1
+        self.taken = bytearray(self.size)
+        self.remaining = offsets[-1]
+        self._next = 0
+
+    def take(self, h):
+        """Return the entries of bucket h, once; later calls return []."""
+        if self.taken[h]:
+            return []
+        self.taken[h] = 1
+        lo, hi = self.offsets[h], self.offsets[h + 1]
+        if lo == hi:
+            return []
+        self.remaining -= hi - lo
+        cls = self.snapshot.cls
+        unpack = self.unpack
+        size = self.record.size
+        start = self.base + lo * size
+        return [unpack(cls, fields)
+                for fields in self.record.iter_unpack(self.snapshot.map[start:start + (hi - lo) * size])]
+
+    def merge(self, buckets, h):
+        """Move bucket h into buckets. Entries already there win, but keep
+        the earliest first_seen."""
+        entries = self.take(h)
+        if not entries:
+            return
+        existing = buckets.get(h)
+        if existing is None:
+            buckets[h] = entries
+            return
+        known = dict((e.mac, e) for e in existing)
+        for e in entries:
+            live = known.get(e.mac)
+            if live is None:
+                existing.append(e)
+            elif e.first_seen < live.first_seen:
+                live.first_seen = e.first_seen
+
+    def step(self, buckets, deadline):
+        """Merge buckets until perf_counter() passes deadline, return True
+        once the whole table is in."""
+        h = self._next
+        size = self.size
+        while h < size:
+            self.merge(buckets, h)
+            h += 1
+            if time.perf_counter() > deadline:
+                break
+        self._next = h
+        return h >= size
+
+
+class Snapshot(object):
+    """A snapshot file mapped for restoring. Raises ValueError if the file
+    is not a snapshot or does not match the table sizes."""
+
+    def __init__(self, path, cls, sta_size, ap_size):
+        self.path = path
+        self.cls = cls
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self.map) < _HEADER.size:
+                raise ValueError('%s: truncated' % path)
+            (magic, version, self.saved, sta_buckets, ap_buckets,
+             sta_count, ap_count, self.devices) = _HEADER.unpack_from(self.map)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s: not a version %d snapshot' % (path, VERSION))
+            if (sta_buckets, ap_buckets) != (sta_size, ap_size):
+                raise ValueError('%s: saved with %d/%d buckets, %d/%d expected' % (
+                    path, sta_buckets, ap_buckets, sta_size, ap_size))
+            pos = _HEADER.size
+            sta_offsets = array.array('I', self.map[pos:pos + 4 * (sta_buckets + 1)])
+            pos += 4 * (sta_buckets + 1)
+            ap_offsets = array.array('I', self.map[pos:pos + 4 * (ap_buckets + 1)])
+            pos += 4 * (ap_buckets + 1)
+            end = pos + sta_count * _STA.size + ap_count * _AP.size
+            if len(self.map) != end or sta_offsets[-1] != sta_count or ap_offsets[-1] != ap_count:
+                raise ValueError('%s: size does not match its header' % path)
+        except Exception:
+            self.map.close()
+            raise
+        self.stations = Table(self, sta_offsets, pos, _STA, _unpack_sta)
+        self.aps = Table(self, ap_offsets, pos + sta_count * _STA.size, _AP, _unpack_ap)
+
+    def close(self):
+        self.map.close()
+
+
+def test_snapshot():
+    import shutil
+    import tempfile
+    import sniffer
+
+    def tables(s):
+        return [(s.sta_database.bucket, s.sta_database.STATION_HASH_ID_NUM),
+                (s.ap_database.bucket, s.ap_database.AP_HASH_ID_NUM)]
+
+    s = sniffer.Sniffer()
+    for i in range(5000):
+        mac = struct.pack('>HI', 0x0200, i * 7919)
+        s.insert_sta_to_database(sniffer.StationCache(mac, 1000.0 + i, -40 - i % 50))
+        s.insert_sta_to_database(sniffer.StationCache(mac, 2000.0 + i, -41, fingerprint=2 ** 63 + i, device=i))
+    s.linker.devices = 5000
+    s.insert_sta_to_database(sniffer.StationCache(b'\x02\x00\x00\x00\x00\x01', 5.0))
+    s.insert_ap_to_database(sniffer.StationCache(b'\x00\x26\xcb\x18\x6a\x30', 7.0, -60, ssid='h\xf6me', channel=6,
+                                                 privacy=1, rsn='0100000fac04', ht=True))
+    s.insert_ap_to_database(sniffer.StationCache(b'\x00\x26\xcb\x18\x6a\x31', 8.0, None, ssid=None, channel=None,
+                                                 privacy=0, rsn=None, ht=False))
+    before = [(e.report('sta'), e.__dict__.keys()) for e in s.sta_database.scan()]
+    aps = [(e.report('ap'), e.__dict__.keys()) for e in s.ap_database.scan()]
+
+    directory = tempfile.mkdtemp(prefix='snap')
+    path = os.path.join(directory, 'tables.snap')
+    w = writer(path, tables(s), 1234.5)
+    next(w)
+    w.close()
+    assert not os.path.exists(path) and not os.path.exists(path + '.tmp')
+    save(path, tables(s), 0.0)
+    save(path, tables(s), 1234.5, s._linker_devices)
+
+    r = sniffer.Sniffer()
+    # a station seen before its bucket was restored keeps its first_seen
+    seen = before[1][0]['mac']
+    r.snapshot_path = path
+    r.restore_snapshot()
+    assert r.snapshot.saved == 1234.5 and len(r.sta_database) == 5001
+    # a new device does not get the id of a restored one
+    assert r.linker.observe(1, b'\x02\x00\x00\x00\x00\x02', 0, 9000.0) == 5000
+    r.insert_sta_to_database(sniffer.StationCache(bytes.fromhex(seen.replace(':', '')), 9000.0, -30))
+    while not r._restore_step(None):
+        pass
+    assert r.snapshot is None
+    after = [(e.report('sta'), e.__dict__.keys()) for e in r.sta_database.scan()]
+    assert len(after) == len(before) == 5001
+    for (a, ak), (b, bk) in zip(after, before):
+        if a['mac'] == seen:
+            assert (a['first_seen'], a['time'], a['rssi']['count']) == (b['first_seen'], 9000.0, b['rssi']['count'] + 1)
+        else:
+            assert a == b and ak == bk
+    assert [(e.report('ap'), e.__dict__.keys()) for e in r.ap_database.scan()] == aps
+
+    # a table restored bucket by bucket, merged into buckets that exist
+    snap = Snapshot(path, sniffer.StationCache, 10240, 10240)
+    buckets = {0: []}
+    assert not snap.stations.step(buckets, 0) and snap.stations._next == 1
+    while not snap.stations.step(buckets, time.perf_counter() + 1):
+        pass
+    assert sum(len(v) for v in buckets.values()) == 5001 and snap.stations.remaining == 0
+    snap.close()
+
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+    try:
+        Snapshot(path, sniffer.StationCache, 10240, 10240)
+    except ValueError:
+        pass
+    else:
+        assert False
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    test_snapshot()
+    print('Tests Successful...')
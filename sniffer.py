@@ -2,6 +2,8 @@
 
 import sys
 import getopt
+import signal
+import gc
 import socket
 # import struct
 # import fcntl
@@ -11,9 +13,49 @@ import struct
 import time
 import os
 import transport
+import fingerprint
+import rssi
+import bpf
+import plugins
+import replay
+import metrics
+import control
+import snapshot
+import history
+import obslog
+import hll
 
 ETH_P_ALL = 0x0003
 SIOCGIFINDEX = 0x8933
+SOL_PACKET = getattr(socket, 'SOL_PACKET', 263)
+PACKET_STATISTICS = 6
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+
+_timespec = struct.Struct('@qq')
+_tpacket_stats = struct.Struct('@II')
+
+_FRAME_TYPES = ('mgmt', 'ctl', 'data', 'ext')
+
+
+def _scan(bucket, size, hash, after=None):
+    """Yield entries in (bucket, mac) order, starting after the MAC after.
+
+    Each bucket is copied before it is yielded from, so the tables may
+    change between steps: entries inserted behind the scan position are
+    missed, the others are returned exactly once.
+    """
+    start = 0
+    if after is not None:
+        start = hash(after)
+    for h in range(start, size):
+        entries = bucket(h)
+        if not entries:
+            continue
+        for e in sorted(entries, key=lambda e: e.mac):
+            if after is not None and h == start and e.mac <= after:
+                continue
+            yield e
 
 
 class StationDatabase(object):
@@ -22,6 +64,8 @@ class StationDatabase(object):
 
     def __init__(self):
         self.sta_macs = {}
+        # snapshot.Table still being restored
+        self.pending = None
 
     def hash(self, mac):
         val1, val2, val3 = struct.unpack('HHH', mac)
@@ -30,16 +74,43 @@ class StationDatabase(object):
     def insert_sta_to_database(self, sta):
         hash = self.hash(sta.mac)
         if hash not in self.sta_macs:
-            self.sta_macs[hash] = []
-            self.sta_macs[hash].append(sta)
-        else:
-            found = False
-            for e in self.sta_macs[hash]:
-                if e == sta: # update members
-                    found = True
-                    e.time = sta.time
-            if not found:
-                self.sta_macs[hash].append(sta)
+            self.sta_macs[hash] = self.pending.take(hash) if self.pending is not None else []
+        for e in self.sta_macs[hash]:
+            if e == sta: # update members
+                e.update(sta)
+                return e
+        sta.observe(sta.signal)
+        self.sta_macs[hash].append(sta)
+        return sta
+
+    def group_by_fingerprint(self):
+        """Return {fingerprint: [stations]}, stations without a fingerprint
+        are keyed by their MAC."""
+        groups = {}
+        for sta in self.scan():
+            key = getattr(sta, 'fingerprint', sta.mac)
+            groups.setdefault(key, []).append(sta)
+        return groups
+
+    def bucket(self, h):
+        if self.pending is not None:
+            self.pending.merge(self.sta_macs, h)
+        return self.sta_macs.get(h)
+
+    def restore_step(self, deadline):
+        if self.pending is None or self.pending.step(self.sta_macs, deadline):
+            self.pending = None
+            return True
+        return False
+
+    def scan(self, after=None):
+        return _scan(self.bucket, self.STATION_HASH_ID_NUM, self.hash, after)
+
+    def __len__(self):
+        n = sum(len(v) for v in self.sta_macs.values())
+        if self.pending is not None:
+            n += self.pending.remaining
+        return n
 
     def __str__(self):
         ret = ''
@@ -54,6 +125,8 @@ class APDatabase(object):
 
     def __init__(self):
         self.ap_macs = {}
+        # snapshot.Table still being restored
+        self.pending = None
 
     def hash(self, mac):
         val1, val2, val3 = struct.unpack('HHH', mac)
@@ -62,16 +135,34 @@ class APDatabase(object):
     def insert_sta_to_database(self, ap):
         hash = self.hash(ap.mac)
         if hash not in self.ap_macs:
-            self.ap_macs[hash] = []
-            self.ap_macs[hash].append(ap)
-        else:
-            found = False
-            for e in self.ap_macs[hash]:
-                if e == ap: # update members
-                    found = True
-                    e.time = ap.time
-            if not found:
-                self.ap_macs[hash].append(ap)
+            self.ap_macs[hash] = self.pending.take(hash) if self.pending is not None else []
+        for e in self.ap_macs[hash]:
+            if e == ap: # update members
+                e.update(ap)
+                return e
+        ap.observe(ap.signal)
+        self.ap_macs[hash].append(ap)
+        return ap
+
+    def bucket(self, h):
+        if self.pending is not None:
+            self.pending.merge(self.ap_macs, h)
+        return self.ap_macs.get(h)
+
+    def restore_step(self, deadline):
+        if self.pending is None or self.pending.step(self.ap_macs, deadline):
+            self.pending = None
+            return True
+        return False
+
+    def scan(self, after=None):
+        return _scan(self.bucket, self.AP_HASH_ID_NUM, self.hash, after)
+
+    def __len__(self):
+        n = sum(len(v) for v in self.ap_macs.values())
+        if self.pending is not None:
+            n += self.pending.remaining
+        return n
 
     def __str__(self):
         ret = ''
@@ -85,9 +176,12 @@ class APDatabase(object):
 
 class StationCache(object):
 
-    def __init__(self, mac, time, **kwargs):
+    def __init__(self, mac, time, signal=None, **kwargs):
         self.mac = mac
+        self.first_seen = time
         self.time = time
+        self.signal = signal
+        self.rssi = None
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -99,6 +193,34 @@ class StationCache(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def observe(self, signal):
+        if signal is None:
+            return
+        if self.rssi is None:
+            self.rssi = rssi.RssiStats()
+        self.rssi.update(signal)
+
+    def touch(self, time, signal):
+        self.time = time
+        self.signal = signal
+        self.observe(signal)
+
+    def update(self, other):
+        for k, v in other.__dict__.items():
+            if k != 'mac' and k != 'rssi' and k != 'first_seen':
+                setattr(self, k, v)
+        self.observe(other.signal)
+
+    def report(self, kind):
+        record = {'kind': kind}
+        for k, v in self.__dict__.items():
+            if k == 'mac':
+                v = SnifferWorker._to_mac_string(v)
+            elif k == 'rssi' and v is not None:
+                v = v.to_dict()
+            record[k] = v
+        return record
+
     def __str__(self):
         if getattr(self, 'ssid'):
             return '<ap %s %s>' % (SnifferWorker._to_mac_string(self.mac), self.ssid)
@@ -112,11 +234,38 @@ class Sniffer(object):
         self.workers = []
         self.sta_database = StationDatabase()
         self.ap_database = APDatabase()
+        # groups randomized station MACs by probe request fingerprint
+        self.fingerprints = fingerprint.FingerprintIndex()
+        # links a device's successive random MACs by sequence number
+        self.linker = fingerprint.SequenceLinker()
         self.eloop = eloop.EventLoop()
         self.ctrl_path = ctrl_path
-        self.ctrl_sock = None
+        self.ctrl_server = None
+        self.started = None
         self.transport = transport.DefaultTransport(self.eloop)
+        self.dispatcher = transport.Dispatcher(self.eloop)
         self._disable_transport = False
+        self.plugins = [BeaconPlugin(self), StationPlugin(self)]
+        self.metrics = metrics.Registry()
+        # (host, port) to serve /metrics on, None for no endpoint
+        self.metrics_address = None
+        self.metrics_server = None
+        # station/AP tables are saved here every snapshot_interval seconds
+        # and on exit, and restored on start
+        self.snapshot_path = None
+        self.snapshot_interval = 300
+        self.snapshot = None
+        self._snapshot_writer = None
+        self.observers = []
+        # history.HistorySink recording every sighting, None for none
+        self.history = None
+        # obslog.ObservationLog, the same for high sighting rates
+        self.obslog = None
+        # hll.UniqueCounter of unique stations per AP, channel and sensor,
+        # closed windows go to the sinks every unique_interval seconds
+        self.unique = None
+        self.unique_interval = 10
+        self._register_metrics()
 
     @property
     def disable_transport(self):
@@ -126,48 +275,575 @@ class Sniffer(object):
     def disable_transport(self, enable):
         self._disable_transport = enable
 
-    def insert_sta_to_database(self, sta):
-        self.sta_database.insert_sta_to_database(sta)
+    def insert_sta_to_database(self, sta, bssid=None, freq=None):
+        """freq is the radiotap channel frequency in MHz."""
+        for o in self.observers:
+            o.observe(sta.mac, sta.time, sta.signal, freq, bssid)
+        sta = self.sta_database.insert_sta_to_database(sta)
+        self.dispatcher.mark('sta', sta)
 
     def insert_ap_to_database(self, ap):
-        self.ap_database.insert_sta_to_database(ap)
+        ap = self.ap_database.insert_sta_to_database(ap)
+        self.dispatcher.mark('ap', ap)
+        return ap
+
+    def touch_ap(self, ap, time, signal):
+        """Update time and RSSI of a known AP, reported at the next interval."""
+        ap.touch(time, signal)
+        self.dispatcher.mark('ap', ap)
+
+    def add_sink(self, sink):
+        return self.dispatcher.add_sink(sink)
+
+    def add_plugin(self, plugin):
+        self.plugins.append(plugin)
 
     def add_worker(self, worker):
         self.workers.append(worker)
 
-    def on_ctrl_iface_data(self, fd, mask, arg):
-        if mask != eloop.EVENT_READ:
-            return
+    def add_observer(self, observer):
+        """observer.observe(mac, time, signal, freq, bssid) is called for
+        every station sighting, before the station table is updated."""
+        self.observers.append(observer)
+
+    CTRL_USAGE = {
+        'STATUS': 'STATUS                        workers, tables and sinks',
+        'STATS': 'STATS                         the metrics as JSON',
+        'DUMP': 'DUMP STA|AP [<key>=<value>]... stream table records; filters mac=<prefix>,\n'
+                '                              since=<time>, min_signal=<dBm> or any report field,\n'
+                '                              limit=<n> and cursor=<mac> page through the table',
+        'SET': 'SET interval <seconds> [<sink>] flush interval of all sinks or sink index\n'
+               'SET channels <ch,...> [<ifname>] channels the workers hop through',
+        'DIAG': 'DIAG [RESET | SAMPLE <every> [<size>]] decode diagnostics',
+        'UNIQUE': 'UNIQUE MINUTE|HOUR [BSSID|CHANNEL|SENSOR] unique stations in the current window',
+    }
+
+    def ctrl_command(self, argv):
+        """Handle a control request. Return the reply as a dict with an "ok"
+        member, or for DUMP an iterator of records ending with one."""
+        cmd = argv[0].upper()
+        handler = getattr(self, '_ctrl_' + cmd.lower(), None)
+        if cmd not in self.CTRL_USAGE or handler is None:
+            return {'ok': False, 'error': 'unknown command %s' % argv[0],
+                    'commands': sorted(self.CTRL_USAGE)}
+        try:
+            return handler(argv[1:])
+        except (ValueError, IndexError, KeyError):
+            return {'ok': False, 'error': 'usage: ' + self.CTRL_USAGE[cmd]}
+
+    def _ctrl_status(self, args):
+        now = self.eloop.wall_time()
+        return {
+            'ok': True,
+            'time': now,
+            'uptime': now - self.started if self.started is not None else None,
+            'simulated': self.eloop.simulated,
+            'stations': len(self.sta_database),
+            'aps': len(self.ap_database),
+            'workers': [{'ifname': w.ifname,
+                         'source': 'replay' if w.replay is not None else 'live',
+                         'channel': w.current_channel,
+                         'channels': list(w.channels)} for w in self.workers],
+            'sinks': [{'index': i, 'type': type(s).__name__, 'interval': s.interval,
+                       'queue': len(s.queue), 'sent': s.sent, 'dropped': s.dropped}
+                      for i, s in enumerate(self.dispatcher.sinks)],
+            'collector': {'connected': bool(self.transport.conn.connected),
+                          'endpoint': self.transport.conn.endpoint,
+                          'reconnects': self.transport.conn.reconnects},
+        }
+
+    def _ctrl_stats(self, args):
+        return {'ok': True, 'metrics': self.metrics.snapshot()}
+
+    def _ctrl_diag(self, args):
+        diag = dpkt.ieee80211.diagnostics
+        if not args:
+            return {'ok': True, 'diagnostics': diag.to_dict()}
+        if args == ['RESET']:
+            diag.reset()
+            return {'ok': True}
+        if args[0] == 'SAMPLE' and 2 <= len(args) <= 3:
+            diag.set_sampling(*[int(v) for v in args[1:]])
+            return {'ok': True}
+        raise ValueError(args)
+
+    def _ctrl_set(self, args):
+        what = args[0].lower()
+        if what == 'interval' and len(args) <= 3:
+            interval = float(args[1])
+            if interval <= 0:
+                raise ValueError(interval)
+            sinks = self.dispatcher.sinks if len(args) == 2 else [self.dispatcher.sinks[int(args[2])]]
+            for s in sinks:
+                # picked up when the running timer next fires
+                s.interval = interval
+            return {'ok': True, 'sinks': len(sinks)}
+        if what == 'channels' and len(args) <= 3:
+            channels = [int(c) for c in args[1].split(',')]
+            if not all(1 <= c <= 14 for c in channels):
+                raise ValueError(channels)
+            workers = [w for w in self.workers if len(args) == 2 or w.ifname == args[2]]
+            if not workers:
+                return {'ok': False, 'error': 'no worker on %s' % args[2]}
+            for w in workers:
+                w.channels = channels
+            return {'ok': True, 'workers': len(workers)}
+        raise ValueError(args)
+
+    def _ctrl_unique(self, args):
+        if self.unique is None:
+            return {'ok': False, 'error': 'unique station counting is off'}
+        length = {'MINUTE': 60, 'HOUR': 3600}[args[0].upper()]
+        if len(args) > 2:
+            raise ValueError(args)
+        dimension = args[1].lower() if len(args) == 2 else None
+        if dimension not in (None, 'bssid', 'channel', 'sensor'):
+            raise ValueError(dimension)
+        counts = self.unique.current(length, dimension)
+        return {'ok': True, 'start': counts[0][2] if counts else None, 'length': length,
+                'counts': [{'dimension': d, 'key': k, 'estimate': n} for d, k, start, n in counts]}
+
+    def _ctrl_dump(self, args):
+        kind = args[0].lower()
+        database = {'sta': self.sta_database, 'ap': self.ap_database}[kind]
+        filters = control.parse_filters(args[1:])
+        limit = int(filters.pop('limit', 0))
+        cursor = filters.pop('cursor', None)
+        after = bytes.fromhex(cursor.replace(':', '')) if cursor else None
+        if after is not None and len(after) != 6:
+            raise ValueError(cursor)
+        match = self._dump_filter(filters)
+        return self._dump(database.scan(after), kind, match, limit, filters)
+
+    # entries looked at between handing control back to the control server
+    SCAN_CHUNK = 256
+
+    @staticmethod
+    def _dump_filter(filters):
+        """Return match(entry) for the cheap filters on the table entry and
+        the report field filters left over in filters."""
+        mac = filters.pop('mac', '').lower().replace(':', '')
+        since = float(filters.pop('since', '-inf'))
+        min_signal = float(filters.pop('min_signal', '-inf'))
+
+        def match(e):
+            if e.time < since or (e.signal if e.signal is not None else float('-inf')) < min_signal:
+                return False
+            return e.mac.hex().startswith(mac)
+        return match
+
+    @classmethod
+    def _dump(cls, entries, kind, match, limit, fields=None):
+        """Yield the matching records, None every SCAN_CHUNK entries scanned
+        so a filter matching nothing does not hold up the loop."""
+        count = 0
+        scanned = 0
+        for e in entries:
+            scanned += 1
+            if scanned == cls.SCAN_CHUNK:
+                scanned = 0
+                yield None
+            if not match(e):
+                continue
+            record = e.report(kind)
+            if fields and any(str(record.get(k)) != v for k, v in fields.items()):
+                continue
+            yield record
+            count += 1
+            if count == limit:
+                # more may follow; resume after the last record returned
+                yield {'ok': True, 'count': count, 'cursor': record['mac']}
+                return
+        yield {'ok': True, 'count': count, 'cursor': None}
 
-        msg = fd.recv(2048)
-        print(msg)
+    def _register_metrics(self):
+        m = self.metrics
+        m.counter('sniffer_frames_received_total', 'Frames read from the capture socket.', ('ifname',),
+                  lambda: [((w.ifname or '',), w.frames_received) for w in self.workers])
+        m.counter('sniffer_frames_parsed_total', 'Frames decoded for a subscribed plugin.',
+                  ('ifname', 'type', 'subtype'), self._frames_parsed)
+        m.counter('sniffer_kernel_packets_total', 'Packets the kernel passed the capture socket.', ('ifname',),
+                  lambda: [((w.ifname or '',), w.kernel_stats()[0]) for w in self.workers])
+        m.counter('sniffer_kernel_drops_total', 'Packets the kernel dropped for a full socket buffer.', ('ifname',),
+                  lambda: [((w.ifname or '',), w.kernel_stats()[1]) for w in self.workers])
+        m.counter('sniffer_decode_errors_total', 'Frames the 802.11 decoder could not handle.', ('reason',),
+                  self._decode_errors)
+        m.gauge('sniffer_stations', 'Stations in the station table.',
+                fn=lambda: len(self.sta_database))
+        m.gauge('sniffer_aps', 'Access points in the AP table.',
+                fn=lambda: len(self.ap_database))
+        m.counter('sniffer_plugin_calls_total', 'Frames handled per plugin.', ('plugin',),
+                  lambda: [((p.name,), p.calls) for p in self.plugins])
+        m.counter('sniffer_plugin_cpu_seconds_total', 'Time spent in plugin handlers.', ('plugin',),
+                  lambda: [((p.name,), p.cpu_time) for p in self.plugins])
+        m.counter('sniffer_plugin_errors_total', 'Frames a plugin handler raised an exception on.', ('plugin',),
+                  lambda: [((p.name,), p.errors) for p in self.plugins])
+        m.gauge('sniffer_transport_queue_depth', 'Records waiting in the sink queue.', ('sink', 'index'),
+                lambda: self._per_sink(lambda s: len(s.queue)))
+        m.counter('sniffer_transport_sent_total', 'Records passed to the sink.', ('sink', 'index'),
+                  lambda: self._per_sink(lambda s: s.sent))
+        m.counter('sniffer_transport_dropped_total', 'Records dropped from a full sink queue.', ('sink', 'index'),
+                  lambda: self._per_sink(lambda s: s.dropped))
+        m.gauge('sniffer_collector_connected', 'Whether the collector connection is up.',
+                fn=lambda: int(self.transport.conn.connected))
+        m.counter('sniffer_collector_reconnects_total', 'Connections to the collector after the first one.',
+                  fn=lambda: self.transport.conn.reconnects)
+        m.gauge('sniffer_collector_sendbuf_bytes', 'Bytes waiting in the collector send buffer.',
+                fn=lambda: len(self.transport.sendbuf))
+        m.gauge('sniffer_collector_spool_bytes', 'Bytes spooled to disk for the collector.',
+                fn=lambda: len(self.transport.spool) if self.transport.spool is not None else 0)
+        m.gauge('sniffer_history_queue_depth', 'Sightings waiting for the history writer.',
+                fn=lambda: len(self.history.pending) if self.history else 0)
+        m.counter('sniffer_history_written_total', 'Sightings written to the history database.',
+                  fn=lambda: self.history.written if self.history else 0)
+        m.counter('sniffer_history_dropped_total', 'Sightings dropped while the history writer was behind.',
+                  fn=lambda: self.history.dropped if self.history else 0)
+        m.counter('sniffer_history_errors_total', 'History batches lost to database errors.',
+                  fn=lambda: self.history.errors if self.history else 0)
+        m.counter('sniffer_obslog_records_total', 'Sightings appended to the observation log.',
+                  fn=lambda: self.obslog.records if self.obslog else 0)
+        m.counter('sniffer_obslog_segments_sealed_total', 'Observation log segments completed.',
+                  fn=lambda: self.obslog.segments_sealed if self.obslog else 0)
+        m.gauge('sniffer_unique_stations', 'Unique stations seen by this sensor in the current hour.',
+                fn=self._unique_stations)
+        m.gauge('sniffer_eloop_lag_seconds', 'How late the last event loop timer fired.',
+                fn=lambda: self.eloop.lag)
+        m.gauge('sniffer_eloop_max_lag_seconds', 'Latest an event loop timer fired since start.',
+                fn=lambda: self.eloop.max_lag)
 
-    def _init_ctrl_iface(self):
-        if os.path.exists(self.ctrl_path):
-            os.unlink(self.ctrl_path)
-        self.ctrl_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.ctrl_sock.setblocking(False)
-        self.ctrl_sock.bind(self.ctrl_path)
-        self.eloop.register(self.ctrl_sock, eloop.EVENT_READ, self.on_ctrl_iface_data)
+    def _unique_stations(self):
+        if self.unique is None:
+            return 0
+        counts = self.unique.current(3600, 'sensor')
+        return counts[0][3] if counts else 0
+
+    def _per_sink(self, value):
+        return [((type(s).__name__, str(i)), value(s)) for i, s in enumerate(self.dispatcher.sinks)]
+
+    def _frames_parsed(self):
+        for w in self.workers:
+            for fc, n in enumerate(w.frames_parsed):
+                if n:
+                    type, subtype = (fc >> 2) & 0x3, fc >> 4
+                    yield (w.ifname or '', _FRAME_TYPES[type], str(subtype)), n
+
+    @staticmethod
+    def _decode_errors():
+        diag = dpkt.ieee80211.diagnostics
+        reasons = dpkt.ieee80211._DIAG_REASONS
+        totals = [0] * len(reasons)
+        for i, n in enumerate(diag.counts):
+            totals[i % len(reasons)] += n
+        return [((reason,), totals[i]) for i, reason in enumerate(reasons)]
+
+    RESTORE_STEP_TIME = 0.002
+    SAVE_STEP_TIME = 0.002
+
+    def restore_snapshot(self):
+        """Map the snapshot and restore it from the loop in steps. Return
+        False if there was none, or it could not be used."""
+        try:
+            self.snapshot = snapshot.Snapshot(self.snapshot_path, StationCache,
+                                              StationDatabase.STATION_HASH_ID_NUM, APDatabase.AP_HASH_ID_NUM)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            print('snapshot not restored: %s' % e)
+            return False
+        self.sta_database.pending = self.snapshot.stations
+        self.ap_database.pending = self.snapshot.aps
+        # restored stations keep their device ids, new devices count on
+        self.linker.devices = max(self.linker.devices, self.snapshot.devices)
+        # the heap is still small, what is garbage in it goes before the
+        # steps below start freezing
+        gc.collect()
+        self.eloop.register_timeout(0, self._restore_step)
+        return True
+
+    def _restore_step(self, arg):
+        if self.snapshot is None:
+            return True
+        deadline = time.perf_counter() + self.RESTORE_STEP_TIME
+        done = self.sta_database.restore_step(deadline) and self.ap_database.restore_step(deadline)
+        # table entries live until exit: keep full collections from
+        # walking a million of them again and again. The older generations
+        # are frozen already, collecting the young ones first leaves only
+        # live objects to freeze, not the garbage of capture and control.
+        gc.collect(1)
+        gc.freeze()
+        if done:
+            self.snapshot.close()
+            self.snapshot = None
+            return True
+        self.eloop.register_timeout(0, self._restore_step)
+        return False
+
+    def _snapshot_tables(self):
+        return [(self.sta_database.bucket, StationDatabase.STATION_HASH_ID_NUM),
+                (self.ap_database.bucket, APDatabase.AP_HASH_ID_NUM)]
+
+    def _linker_devices(self):
+        return self.linker.devices
+
+    def save_snapshot(self, arg=None):
+        if self._snapshot_writer is None:
+            self._snapshot_writer = snapshot.writer(self.snapshot_path, self._snapshot_tables(),
+                                                    self.eloop.wall_time(), self._linker_devices)
+            self.eloop.register_timeout(0, self._save_step)
+        self.eloop.register_timeout(self.snapshot_interval, self.save_snapshot)
+
+    def _save_step(self, arg):
+        deadline = time.perf_counter() + self.SAVE_STEP_TIME
+        for step in self._snapshot_writer:
+            if time.perf_counter() > deadline:
+                self.eloop.register_timeout(0, self._save_step)
+                return
+        self._snapshot_writer = None
+
+    def save_snapshot_now(self):
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.close()
+            self._snapshot_writer = None
+        snapshot.save(self.snapshot_path, self._snapshot_tables(), self.eloop.wall_time(), self._linker_devices)
+
+    def _obslog_tick(self, arg):
+        self.obslog.flush()
+        # deleting a segment takes a few steps
+        more = self.obslog.expire()
+        self.eloop.register_timeout(0.1 if more else 1.0, self._obslog_tick)
+
+    def _publish_unique(self, arg):
+        for record in self.unique.closed():
+            self.dispatcher.publish(record)
+        self.eloop.register_timeout(self.unique_interval, self._publish_unique)
+
+    def expire_linker(self, arg):
+        now = self.eloop.wall_time()
+        self.linker.expire(now)
+        self.fingerprints.expire(now, self.linker.max_silence)
+        self.eloop.register_timeout(self.linker.max_silence, self.expire_linker)
 
     def start(self):
+        if self.snapshot_path is not None:
+            self.restore_snapshot()
+            self.eloop.register_timeout(self.snapshot_interval, self.save_snapshot)
+        if self.history is not None:
+            self.add_observer(self.history)
+            self.history.start()
+        if self.obslog is not None:
+            self.add_observer(self.obslog)
+            self.eloop.register_timeout(1.0, self._obslog_tick)
+        if self.unique is not None:
+            self.add_observer(self.unique)
+            self.eloop.register_timeout(self.unique_interval, self._publish_unique)
         for w in self.workers:
             w.init()
-        self._init_ctrl_iface()
+        self.started = self.eloop.wall_time()
+        self.ctrl_server = control.ControlServer(self.eloop, self.ctrl_path, self.ctrl_command)
+        if self.metrics_address is not None:
+            self.metrics_server = metrics.MetricsServer(self.eloop, self.metrics, self.metrics_address)
+        self.eloop.register_timeout(self.linker.max_silence, self.expire_linker)
         if not self._disable_transport:
-            self.transport.run()
-        self.eloop.run()
+            self.dispatcher.add_sink(self.transport)
+        self.dispatcher.run()
+        try:
+            self.eloop.run()
+        finally:
+            # the last changes of the tables
+            self.dispatcher.flush_dirty()
+            for s in self.dispatcher.sinks:
+                s.flush()
+            if self.snapshot_path is not None:
+                self.save_snapshot_now()
+            if self.history is not None:
+                self.history.close()
+            if self.obslog is not None:
+                self.obslog.close()
+
+
+def _beacon_digest(ies):
+    """Hash of a beacon IE region without the TIM, which changes with
+    every DTIM count. IEs up to the TIM have a fixed order, so the walk
+    stops after a few elements."""
+    pos = 0
+    end = len(ies)
+    while pos + 2 <= end:
+        ie_id = ies[pos]
+        if ie_id > dpkt.ieee80211.IE_TIM:
+            break
+        nxt = pos + 2 + ies[pos + 1]
+        if ie_id == dpkt.ieee80211.IE_TIM:
+            return hash((ies[:pos], ies[nxt:]))
+        pos = nxt
+    return hash(ies)
+
+
+class BeaconPlugin(plugins.Plugin):
+    """Keeps the AP database from beacons.
+
+    APs repeat the same beacon body about 10 times a second, so the decoded
+    record is cached per BSSID together with a digest of the body. While the
+    digest matches, IEs are not parsed and only time and RSSI are updated.
+    """
+
+    subscriptions = ((dpkt.ieee80211.MGMT_TYPE, dpkt.ieee80211.M_BEACON),)
+
+    MAX_CACHED = 4096
+
+    def __init__(self, sniffer):
+        super(BeaconPlugin, self).__init__(sniffer)
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def handle(self, data, info):
+        bssid = data.mgmt.bssid
+        beacon = data.beacon
+        key = (beacon.capability, _beacon_digest(beacon.data))
+        now = info.timestamp
+        cached = self.cache.get(bssid)
+        if cached is not None and cached[0] == key:
+            self.hits += 1
+            self.sniffer.touch_ap(cached[1], now, info.signal)
+            return
+
+        self.misses += 1
+        if data.parse_ies is not True:
+            # not decoded, or only the IEs other plugins asked for
+            data.unpack_ies(beacon.data)
+        # print("BEACON: bssid: %s" % SnifferWorker._to_mac_string(bssid))
+        ap = self.sniffer.insert_ap_to_database(StationCache(bssid, now, info.signal, **self.decode(data)))
+        if cached is None and len(self.cache) >= self.MAX_CACHED:
+            self.cache.clear()
+        self.cache[bssid] = (key, ap)
+
+    @staticmethod
+    def decode(data):
+        ssid = channel = rsn = None
+        if hasattr(data, 'ssid'):
+            ssid = data.ssid.data.decode('utf8', 'replace')
+        if hasattr(data, 'ds'):
+            channel = data.ds.ch
+        if hasattr(data, 'ie_%d' % dpkt.ieee80211.IE_RSN):
+            rsn = getattr(data, 'ie_%d' % dpkt.ieee80211.IE_RSN).data.hex()
+        return {
+            'ssid': ssid,
+            'channel': channel,
+            'privacy': data.capability.privacy,
+            'rsn': rsn,
+            'ht': hasattr(data, 'ht_info'),
+        }
+
+    def stats(self):
+        stats = super(BeaconPlugin, self).stats()
+        stats['cache_hits'] = self.hits
+        stats['cache_misses'] = self.misses
+        return stats
+
+
+class StationPlugin(plugins.Plugin):
+    """Keeps the station database from mgmt frames and station data traffic,
+    fingerprints probe requests."""
+
+    subscriptions = tuple((dpkt.ieee80211.MGMT_TYPE, st) for st in (
+        dpkt.ieee80211.M_ASSOC_REQ, dpkt.ieee80211.M_ASSOC_RESP,
+        dpkt.ieee80211.M_REASSOC_REQ, dpkt.ieee80211.M_REASSOC_RESP,
+        dpkt.ieee80211.M_PROBE_REQ, dpkt.ieee80211.M_PROBE_RESP,
+        dpkt.ieee80211.M_AUTH, dpkt.ieee80211.M_DEAUTH, dpkt.ieee80211.M_ACTION,
+    )) + tuple((dpkt.ieee80211.DATA_TYPE, st, plugins.TO_DS + plugins.FROM_DS) for st in (
+        dpkt.ieee80211.D_DATA, dpkt.ieee80211.D_NULL,
+        dpkt.ieee80211.D_QOS_DATA, dpkt.ieee80211.D_QOS_NULL,
+    ))
+
+    def needs_for(self, type, subtype):
+        # only probe requests are fingerprinted
+        if type == dpkt.ieee80211.MGMT_TYPE and subtype == dpkt.ieee80211.M_PROBE_REQ:
+            return (plugins.NEED_IES,)
+        return ()
+
+    def handle(self, data, info):
+        if data.type == dpkt.ieee80211.MGMT_TYPE:
+            self._handle_mgmt(data, info)
+        else:
+            self._handle_data(data, info)
+
+    def _handle_mgmt(self, data, info):
+        stype = data.subtype
+        bssid = data.mgmt.bssid
+        sta_addr = None
+        sig = None
+        if stype == dpkt.ieee80211.M_ASSOC_REQ:
+            sta_addr = data.mgmt.src
+        elif stype == dpkt.ieee80211.M_ASSOC_RESP:
+            sta_addr = data.mgmt.dst
+        elif stype == dpkt.ieee80211.M_PROBE_REQ:
+            sta_addr = data.mgmt.src
+            sig = fingerprint.signature(data.ies)
+            self.sniffer.fingerprints.add(sig, sta_addr, info.timestamp)
+            device = self.sniffer.linker.observe(sig, sta_addr, data.mgmt.seq, info.timestamp)
+        elif stype == dpkt.ieee80211.M_PROBE_RESP:
+            sta_addr = data.mgmt.dst
+        elif stype == dpkt.ieee80211.M_REASSOC_REQ:
+            sta_addr = data.mgmt.src
+        elif stype == dpkt.ieee80211.M_REASSOC_RESP:
+            sta_addr = data.mgmt.dst
+        elif stype == dpkt.ieee80211.M_AUTH or stype == dpkt.ieee80211.M_DEAUTH or stype == dpkt.ieee80211.M_ACTION:
+            sta_addr = data.mgmt.dst
+            if sta_addr == data.mgmt.src:
+                sta_addr = data.mgmt.src
+        if sta_addr is not None and not SnifferWorker.is_broadcast_ether_addr(bssid):
+            # print("MGMT: bssid: %s, sta_addr: %s" % (SnifferWorker._to_mac_string(bssid), SnifferWorker._to_mac_string(sta_addr)))
+            if sig is None:
+                self.sniffer.insert_sta_to_database(StationCache(sta_addr, info.timestamp, info.signal),
+                                                    bssid, info.channel)
+            else:
+                self.sniffer.insert_sta_to_database(StationCache(sta_addr, info.timestamp, info.signal,
+                                                                 fingerprint=sig, device=device),
+                                                    bssid, info.channel)
+
+    def _handle_data(self, data, info):
+        if not hasattr(data, 'data_frame'):
+            return
+        sta_addr = None
+        if data.to_ds and data.from_ds: # WDS or mesh
+            return
+        if data.to_ds:
+            sta_addr = data.data_frame.src
+        elif data.from_ds:
+            sta_addr = data.data_frame.dst
+        if sta_addr is None or SnifferWorker.is_multicast_ether_addr(sta_addr):
+            return
+        # print("DATA: bssid: %s, sta_addr: %s" % (SnifferWorker._to_mac_string(data.data_frame.bssid), SnifferWorker._to_mac_string(sta_addr)))
+        self.sniffer.insert_sta_to_database(StationCache(sta_addr, info.timestamp, info.signal),
+                                            data.data_frame.bssid, info.channel)
 
 
 class SnifferWorker(object):
 
+    ANCBUF_SIZE = socket.CMSG_SPACE(_timespec.size)
+
     def __init__(self, sniffer, ifname = None):
         self.ifname = ifname
+        # None: capture what the plugins subscribed to
+        self.selection = None
+        self.dispatch = {}
+        self.info = plugins.FrameInfo()
+        # parse objects recycled after every frame, plugins copy what they keep
+        self.pool = dpkt.Pool()
         self.sock = None
+        # replay.PcapReplay feeding recorded frames instead of the interface
+        self.replay = None
+        # counters, read by Sniffer.metrics when scraped
+        self.frames_received = 0
+        self.frames_parsed = [0] * 256     # by frame control byte
+        self.kernel_packets = 0
+        self.kernel_drops = 0
         self.sniffer = sniffer
         sniffer.add_worker(self)
         self.eloop = sniffer.eloop
         self.current_channel = 1
+        # hopped through in order, changed by SET channels
+        self.channels = list(range(1, 15))
 
     def __str__(self):
         return 'SnifferWorker: <ifname %s>' % self.ifname
@@ -180,27 +856,84 @@ class SnifferWorker(object):
         # tmp, ifindex = struct.unpack('=6sI', ret)
         # print("ifname %s: ifindex %d" % (self.ifname, ifindex))
         self.sock.bind((self.ifname, ETH_P_ALL))
+        # receive timestamps taken by the kernel when the frame arrived
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        selection = self.selection
+        if selection is None:
+            selection = plugins.selection(self.sniffer.plugins)
+        if selection:
+            bpf.attach_filter(self.sock, bpf.compile_selection(selection))
 
     def on_raw_packet_received(self, fd, mask, arg):
         if mask != eloop.EVENT_READ:
             return
 
         # receive complete one pkt
-        buf = fd.recv(4096, socket.MSG_TRUNC)
-        if buf:
-            # print(dpkt.hexdump(buf))
-            radiotap_hdr = dpkt.radiotap.Radiotap(buf)
-            if radiotap_hdr.rate_present and radiotap_hdr.rate.val and radiotap_hdr.ant_sig_present:
-                ieee80211_pkt = radiotap_hdr.data
-                if not ieee80211_pkt:
-                    return
-                channel = radiotap_hdr.channel.freq
-                signal = radiotap_hdr.ant_sig.db
-                type = ieee80211_pkt.type
-                if type == dpkt.ieee80211.MGMT_TYPE:
-                    self._handle_mgmt(ieee80211_pkt, channel=channel, signal=signal)
-                elif type == dpkt.ieee80211.DATA_TYPE:
-                    self._handle_data(ieee80211_pkt, channel=channel, signal=signal)
+        buf, ancdata, flags, addr = fd.recvmsg(4096, self.ANCBUF_SIZE, socket.MSG_TRUNC)
+        self.frames_received += 1
+        if len(buf) < 4:
+            return
+        # look up the subscribers by the frame control byte before decoding
+        it_len = buf[2] | buf[3] << 8
+        if len(buf) <= it_len + 1:
+            return
+        fc = buf[it_len]
+        entry = self.dispatch.get(((fc >> 2) & 0x3, fc >> 4))
+        if entry is None:
+            return
+        subscribers, parse_ies = entry
+        # print(dpkt.hexdump(buf))
+        try:
+            radiotap_hdr = self.pool.get(dpkt.radiotap.Radiotap, buf, ies=parse_ies, pool=self.pool)
+        except (dpkt.UnpackError, struct.error):
+            self.pool.release()
+            dpkt.ieee80211.diagnostics.record((fc >> 2) & 0x3, fc >> 4, dpkt.ieee80211.DIAG_MALFORMED, buf)
+            return
+        self.frames_parsed[fc & 0xfc] += 1
+        try:
+            self._dispatch(radiotap_hdr, subscribers, ancdata, buf[it_len + 1] & 0x3)
+        finally:
+            self.pool.release()
+
+    def _dispatch(self, radiotap_hdr, subscribers, ancdata, ds):
+        if radiotap_hdr.rate_present and radiotap_hdr.rate.val and radiotap_hdr.ant_sig_present:
+            ieee80211_pkt = radiotap_hdr.data
+            if not ieee80211_pkt:
+                return
+            info = self.info
+            info.timestamp = self.timestamp(ancdata)
+            info.tsft = radiotap_hdr.tsft.usecs if radiotap_hdr.tsft_present else None
+            info.channel = radiotap_hdr.channel.freq
+            info.signal = radiotap_hdr.ant_sig.db
+            plugins.run(subscribers, ieee80211_pkt, info, ds)
+
+    @staticmethod
+    def timestamp(ancdata):
+        for level, type, data in ancdata:
+            if level == socket.SOL_SOCKET and type == SCM_TIMESTAMPNS:
+                sec, nsec = _timespec.unpack_from(data)
+                return sec + nsec * 1e-9
+        # no kernel timestamp, e.g. SO_TIMESTAMPNS not supported
+        return time.time()
+
+    def kernel_stats(self):
+        """Return (packets, drops) since the socket was opened. The kernel
+        resets its counters on every read, they are summed here."""
+        if self.sock is not None:
+            try:
+                packets, drops = _tpacket_stats.unpack(
+                    self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, _tpacket_stats.size))
+            except OSError:
+                pass
+            else:
+                self.kernel_packets += packets
+                self.kernel_drops += drops
+        return self.kernel_packets, self.kernel_drops
+
+    @staticmethod
+    def timestamp_ancdata(ts):
+        sec = int(ts)
+        return [(socket.SOL_SOCKET, SCM_TIMESTAMPNS, _timespec.pack(sec, int((ts - sec) * 1e9)))]
 
     def _ieee80211_get_bssid(self, hdr):
         if len(hdr) < 16:
@@ -212,48 +945,6 @@ class SnifferWorker(object):
             return None
         return None
 
-    def _ieee80211_rx_mgmt_beacon(self, data):
-        ssid = None
-        if hasattr(data, "ssid"):
-            ssid = data.ssid.data
-        if hasattr(data, "ds"):
-            channel = data.ds.ch
-        bssid = data.mgmt.bssid
-        # print("BEACON: bssid: %s, channel: %d, ssid: %s" % (self._to_mac_string(bssid), channel, ssid.decode('utf8')))
-        self.sniffer.insert_ap_to_database(StationCache(bssid, time.monotonic(), ssid=ssid.decode('utf8')))
-        # print(self.sniffer.ap_database)
-
-    def _handle_mgmt(self, data, **kwarg):
-        stype = data.subtype
-        if stype == dpkt.ieee80211.M_BEACON:
-            self._ieee80211_rx_mgmt_beacon(data)
-            return
-
-        parsed = True
-        bssid = data.mgmt.bssid
-        sta_addr = None
-        if stype == dpkt.ieee80211.M_ASSOC_REQ:
-            sta_addr = data.mgmt.src
-        elif stype == dpkt.ieee80211.M_ASSOC_RESP:
-            sta_addr = data.mgmt.dst
-        elif stype == dpkt.ieee80211.M_PROBE_REQ:
-            sta_addr = data.mgmt.src
-        elif stype == dpkt.ieee80211.M_PROBE_RESP:
-            parsed = False
-            sta_addr = data.mgmt.dst
-        elif stype == dpkt.ieee80211.M_REASSOC_REQ:
-            sta_addr = data.mgmt.src
-        elif stype == dpkt.ieee80211.M_REASSOC_RESP:
-            sta_addr = data.mgmt.dst
-        elif stype == dpkt.ieee80211.M_AUTH or stype == dpkt.ieee80211.M_DEAUTH or stype == dpkt.ieee80211.M_ACTION:
-            parsed = False
-            sta_addr = data.mgmt.dst
-            if sta_addr == data.mgmt.src:
-                sta_addr = data.mgmt.src
-        if not self.is_broadcast_ether_addr(bssid):
-            # print("MGMT: bssid: %s, sta_addr: %s" % (self._to_mac_string(bssid), self._to_mac_string(sta_addr)))
-            self.sniffer.insert_sta_to_database(StationCache(sta_addr, time.monotonic()))
-
     @staticmethod
     def _to_mac_string(mac):
         return ':'.join('{:02x}'.format(c) for c in mac)
@@ -274,30 +965,25 @@ class SnifferWorker(object):
     def is_broadcast_ether_addr(mac):
         return mac == b'\xff' * 6
 
-    def _handle_data(self, data, **kwargs):
-        # print("_handle_data")
-        if data.data_frame:
-            bssid = data.data_frame.bssid
-            sta_addr = None
-            if data.to_ds and data.from_ds: # WDS or mesh
-                return
-            if data.to_ds:
-                sta_addr = data.data_frame.src
-            elif data.from_ds:
-                sta_addr = data.data_frame.dst
-            if sta_addr is None:
-                return
-            # print("DATA: bssid: %s, sta_addr: %s" % (self._to_mac_string(bssid), self._to_mac_string(sta_addr)))
+    def next_channel(self):
+        channels = self.channels
+        if self.current_channel in channels:
+            return channels[(channels.index(self.current_channel) + 1) % len(channels)]
+        return channels[0]
 
     def channel_switch(self, arg):
-        self.current_channel += 1
-        if self.current_channel > 14:
-            self.current_channel = 1
-        # print('switching channel to %d' % self.current_channel)
-        os.system('iwconfig %s channel %d' % (self.ifname, self.current_channel))
+        channel = self.next_channel()
+        if channel != self.current_channel:
+            self.current_channel = channel
+            # print('switching channel to %d' % self.current_channel)
+            os.system('iwconfig %s channel %d' % (self.ifname, self.current_channel))
         self.eloop.register_timeout(0.5, self.channel_switch)
 
     def init(self):
+        self.dispatch = plugins.build_dispatch(self.sniffer.plugins)
+        if self.replay is not None:
+            self.replay.start()
+            return
         self.create_raw_socket()
         self.eloop.register_timeout(0.5, self.channel_switch)
         self.eloop.register(self.sock, eloop.EVENT_READ, self.on_raw_packet_received)
@@ -305,27 +991,246 @@ class SnifferWorker(object):
         os.system('iwconfig %s channel %d' % (self.ifname, self.current_channel))
 
 
+def test_beacon_cache():
+    def beacon(ssid, dtim_count):
+        hdr = b'\x80\x00\x00\x00' + b'\xff' * 6 + b'\x00\x26\xcb\x18\x6a\x30' * 2 + b'\x00\x00'
+        fixed = struct.pack('<QHH', dtim_count * 102400, 100, 0x0411)
+        ies = (b'\x00' + bytes([len(ssid)]) + ssid + b'\x01\x02\x82\x84' + b'\x03\x01\x06' +
+               b'\x05\x04' + bytes([dtim_count, 3, 0, 0]) + b'\x30\x06\x01\x00\x00\x0f\xac\x04')
+        return dpkt.ieee80211.IEEE80211(hdr + fixed + ies, ies=False)
+
+    sniffer = Sniffer()
+    sink = sniffer.add_sink(transport.FileSink(sniffer.eloop, os.devnull))
+    plugin = sniffer.plugins[0]
+    info = plugins.FrameInfo()
+    for i, signal in enumerate((-50, -60, -70)):
+        info.timestamp = 1000.0 + i
+        info.signal = signal
+        plugin.handle(beacon(b'home', i), info)
+    assert (plugin.hits, plugin.misses) == (2, 1)
+    # reported once, at the interval
+    assert len(sink.queue) == 0 and len(sniffer.dispatcher.dirty) == 1
+    sniffer.dispatcher.flush_dirty()
+    assert len(sink.queue) == 1
+    ap, = [ap for aps in sniffer.ap_database.ap_macs.values() for ap in aps]
+    assert (ap.ssid, ap.channel, ap.privacy, ap.rsn) == ('home', 6, 1, '0100000fac04')
+    assert ap.signal == -70 and ap.rssi.count == 3
+    assert (ap.first_seen, ap.time) == (1000.0, 1002.0)
+
+    plugin.handle(beacon(b'guest', 3), info)
+    assert plugin.misses == 2 and ap.ssid == 'guest'
+
+
+def test_kernel_timestamp():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        b.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        before = time.time()
+        a.send(b'frame')
+        buf, ancdata, flags, addr = b.recvmsg(4096, SnifferWorker.ANCBUF_SIZE)
+        assert ancdata
+        assert before - 1 < SnifferWorker.timestamp(ancdata) <= time.time()
+        assert SnifferWorker.timestamp(SnifferWorker.timestamp_ancdata(1500000000.25)) == 1500000000.25
+    finally:
+        a.close()
+        b.close()
+
+
+def test_metrics():
+    rt = b'\x00\x00\x10\x00\x2e\x00\x00\x00\x10\x02\x6c\x09\xa0\x00\xc4\x00'
+    beacon = (b'\x80\x00\x00\x00' + b'\xff' * 6 + b'\x00\x26\xcb\x18\x6a\x30' * 2 + b'\x00\x00' +
+              struct.pack('<QHH', 0, 100, 0x0411) + b'\x00\x04home\x03\x01\x06')
+    sniffer = Sniffer()
+    worker = SnifferWorker(sniffer)
+    worker.ifname = 'wlan0'
+    worker.dispatch = plugins.build_dispatch(sniffer.plugins)
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        for frame in (beacon, beacon, b'\xd4\x00' + b'\x00' * 8):
+            a.send(rt + frame)
+            worker.on_raw_packet_received(b, eloop.EVENT_READ, None)
+    finally:
+        a.close()
+        b.close()
+    text = sniffer.metrics.render()
+    assert 'sniffer_frames_received_total{ifname="wlan0"} 3\n' in text
+    assert 'sniffer_frames_parsed_total{ifname="wlan0",type="mgmt",subtype="8"} 2\n' in text
+    assert 'sniffer_aps 1\n' in text and 'sniffer_stations 0\n' in text
+    assert 'sniffer_plugin_calls_total{plugin="BeaconPlugin"} 2\n' in text
+
+
+def test_station_sightings():
+    class Observer(object):
+        def __init__(self):
+            self.seen = []
+
+        def observe(self, mac, time, signal, freq, bssid):
+            self.seen.append((mac, time, signal, freq, bssid))
+
+    sniffer = Sniffer()
+    observer = Observer()
+    sniffer.add_observer(observer)
+    plugin = sniffer.plugins[1]
+    info = plugins.FrameInfo()
+    info.timestamp, info.signal, info.channel = 1000.0, -55, 2437
+    bssid, sta = b'\x00\x26\xcb\x18\x6a\x30', b'\x02\x00\x00\x00\x00\x07'
+    # QoS data to the DS: bssid, src, dst
+    frame = b'\x88\x01\x00\x00' + bssid + sta + b'\x00\x0c\x29\x00\x00\x01' + b'\x10\x00' + b'\x00\x00' + b'\xaa' * 8
+    plugin.handle(dpkt.ieee80211.IEEE80211(frame), info)
+    assert observer.seen == [(sta, 1000.0, -55, 2437, bssid)]
+    assert len(sniffer.sta_database) == 1
+
+    assert sniffer.ctrl_command(['UNIQUE', 'HOUR'])['ok'] is False
+    sniffer.unique = hll.UniqueCounter('sensor-1')
+    sniffer.add_observer(sniffer.unique)
+    for i in range(3):
+        plugin.handle(dpkt.ieee80211.IEEE80211(frame[:10] + struct.pack('>HI', 0x0200, i) + frame[16:]), info)
+    reply = sniffer.ctrl_command(['UNIQUE', 'minute', 'bssid'])
+    assert reply == {'ok': True, 'start': 960, 'length': 60,
+                     'counts': [{'dimension': 'bssid', 'key': '00:26:cb:18:6a:30', 'estimate': 3}]}
+    assert len(sniffer.ctrl_command(['UNIQUE', 'HOUR'])['counts']) == 3
+    assert sniffer.metrics.snapshot()['sniffer_unique_stations'] == 3
+    assert sniffer.ctrl_command(['UNIQUE', 'DAY'])['ok'] is False
+
+
+def test_ctrl_command():
+    sniffer = Sniffer()
+    worker = SnifferWorker(sniffer)
+    worker.ifname = 'wlan0'
+    for i in range(1000):
+        mac = struct.pack('>HI', 0x0200, i * 7919)
+        sniffer.insert_sta_to_database(StationCache(mac, 1000.0 + i, -40 - i % 50))
+
+    def dump(*args):
+        records = [r for r in sniffer.ctrl_command(['DUMP', 'STA'] + list(args)) if r is not None]
+        return records[:-1], records[-1]
+
+    seen = []
+    cursor = None
+    while True:
+        args = ['limit=300'] + (['cursor=' + cursor] if cursor else [])
+        records, last = dump(*args)
+        seen += [r['mac'] for r in records]
+        # stations arriving mid-dump do not upset the cursor
+        sniffer.insert_sta_to_database(StationCache(b'\x02\x00\x00\x00\x00\x01', 0.0))
+        cursor = last['cursor']
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) and len(set(seen) - {'02:00:00:00:00:01'}) == 1000
+
+    records, last = dump('since=1950', 'min_signal=-45')
+    assert last == {'ok': True, 'count': len(records), 'cursor': None}
+    assert records and all(r['time'] >= 1950 and r['signal'] >= -45 for r in records)
+    records, last = dump('mac=02:00:00:00:1E', 'signal=-41')
+    assert [r['mac'] for r in records] == ['02:00:00:00:1e:ef']
+    # a filter matching nothing still hands back control while it scans
+    stream = list(sniffer.ctrl_command(['DUMP', 'STA', 'mac=ff:ff']))
+    assert stream[-1]['count'] == 0 and stream.count(None) == 1001 // Sniffer.SCAN_CHUNK
+    assert sniffer.ctrl_command(['DUMP', 'STA', 'oops'])['ok'] is False
+
+    assert sniffer.ctrl_command(['SET', 'channels', '1,6,11'])['ok']
+    worker.current_channel = 6
+    assert worker.next_channel() == 11
+    worker.current_channel = 11
+    assert worker.next_channel() == 1
+    assert sniffer.ctrl_command(['SET', 'channels', '1,15'])['ok'] is False
+    assert sniffer.ctrl_command(['SET', 'channels', '6', 'wlan9'])['ok'] is False
+
+    sink = transport.FileSink(sniffer.eloop, os.devnull)
+    sniffer.add_sink(sink)
+    assert sniffer.ctrl_command(['SET', 'interval', '5', '0']) == {'ok': True, 'sinks': 1}
+    assert sink.interval == 5.0
+
+    status = sniffer.ctrl_command(['STATUS'])
+    assert status['stations'] == 1001 and status['aps'] == 0
+    assert status['workers'] == [{'ifname': 'wlan0', 'source': 'live', 'channel': 11, 'channels': [1, 6, 11]}]
+    assert status['sinks'][0]['type'] == 'FileSink' and status['sinks'][0]['interval'] == 5.0
+    assert sniffer.ctrl_command(['STATS'])['metrics']['sniffer_stations'] == 1001
+    assert sniffer.ctrl_command(['diag'])['ok']
+    assert sniffer.ctrl_command(['REBOOT'])['ok'] is False
+
+
 def usage(program):
-    print("Usage: %s [-i <ifname>]", program)
+    print("Usage: %s [-i <ifname> | -r <pcap> [-x <speed>] [-S]] [-m [<host>:]<port>] [-s <snapshot>] [-H <history.db>] [-O <dir>] [-U <sensor>] [-f <selection>] [-c <host:port>]... [-o <sink>]..." % program)
+    print("  pcap: replay a radiotap capture instead of capturing, at speed times the")
+    print("        original rate (default 1, 0 for as fast as possible), then exit")
+    print("  -m: serve Prometheus metrics on [host:]port at /metrics")
+    print("  -s: restore the station and AP tables from snapshot on start, save them")
+    print("        there every 5 minutes and on exit")
+    print("  -H: record every station sighting in a SQLite database, kept for 30 days")
+    print("  -O: append every station sighting to hourly segment files in dir, kept")
+    print("        for 7 days")
+    print("  -U: count unique stations per AP, channel and sensor in minute and hour")
+    print("        windows and report the sketches of closed windows to the sinks")
+    print("  -S: simulate, run the replay and all timers on a virtual clock in capture")
+    print("        time without waiting in between")
+    print("  selection: frames to capture, e.g. \"mgmt beacon probe_req; data to_ds\",")
+    print("        empty to capture everything (default: what the plugins subscribed to)")
+    print("  sink: tcp:host:port, udp:host:port, unix:path or file:path,")
+    print("        optionally followed by ,interval=N,batch=N,queue=N,drop=oldest|newest")
 
 
 def main():
     sniffer = Sniffer()
     worker = SnifferWorker(sniffer)
-    opts, args = getopt.getopt(sys.argv[1:], "dDhi:Nt")
+    opts, args = getopt.getopt(sys.argv[1:], "c:dDf:hH:i:m:No:O:r:s:StU:x:")
+    endpoints = []
+    replays = []
+    speed = 1.0
     for o, a in opts:
         if o == '-h':
             usage(sys.argv[0])
             return
         elif o == '-i':
             worker.ifname = a
+        elif o == '-r':
+            replays.append((worker, a))
+        elif o == '-x':
+            speed = float(a)
+        elif o == '-m':
+            host, _, port = a.rpartition(':')
+            sniffer.metrics_address = (host or '0.0.0.0', int(port))
+        elif o == '-O':
+            sniffer.obslog = obslog.ObservationLog(a)
+        elif o == '-U':
+            sniffer.unique = hll.UniqueCounter(a)
+        elif o == '-H':
+            sniffer.history = history.HistorySink(a)
+        elif o == '-s':
+            sniffer.snapshot_path = a
+        elif o == '-S':
+            sniffer.eloop.set_clock(eloop.VirtualClock())
+        elif o == '-f':
+            bpf.parse_selection(a)
+            worker.selection = a
         elif o == '-N':
             worker = SnifferWorker(sniffer)
         elif o == '-t':
             sniffer.disable_transport = True
+        elif o == '-c':
+            host, port = a.rsplit(':', 1)
+            endpoints.append((host, int(port)))
+        elif o == '-o':
+            sniffer.add_sink(transport.sink_from_spec(sniffer.eloop, a))
+
+    if endpoints:
+        sniffer.transport.conn.endpoints = endpoints
+
+    def replay_done(r):
+        print(r.report())
+        if all(w.replay is None or w.replay.done for w in sniffer.workers):
+            sniffer.eloop.stop()
+
+    if sniffer.eloop.simulated:
+        # timers only keep their meaning in capture time
+        speed = 1.0
+    for w, path in replays:
+        w.replay = replay.PcapReplay(w, open(path, 'rb'), speed, on_done=replay_done)
 
     for w in sniffer.workers:
         print(w)
+    # leave through Sniffer.start so the snapshot is saved
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     sniffer.start()
 
 
@@ -3,28 +3,51 @@
 import socket
 import os
 import sys
-import eloop
+import json
+import control
 
 CTRL_IFACE = '/tmp/sniffer.sock'
 
 
+def run(f, sock, line, out):
+    """Send one command and print its reply, one JSON object per line.
+    Return False if the sniffer reported an error."""
+    sock.sendall(line.encode('utf8') + b'\n')
+    for obj in control.read_reply(f):
+        out.write(json.dumps(obj) + '\n')
+    out.flush()
+    return obj.get('ok', False)
+
+
 def main():
     if not os.path.exists(CTRL_IFACE):
         print("CTRL_IFACE not exist")
-        return
+        return 1
 
-    client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     client.connect(CTRL_IFACE)
-    print("Ready")
-    while True:
-        try:
-            x = input(">")
-            if x:
-                client.send(x.encode('utf8'))
-        except KeyboardInterrupt as e:
-            print("shutdown...")
-    client.close()
+    f = client.makefile('rb')
+    try:
+        if len(sys.argv) > 1:
+            # one shot: sniffer_cli.py DUMP STA since=1500000000 > stations.json
+            return 0 if run(f, client, ' '.join(sys.argv[1:]), sys.stdout) else 1
+        print("Ready")
+        while True:
+            try:
+                x = input(">")
+                if x.strip():
+                    run(f, client, x, sys.stdout)
+            except (KeyboardInterrupt, EOFError) as e:
+                print("shutdown...")
+                break
+            except (OSError, ValueError) as e:
+                print("connection lost: %s" % e)
+                break
+    finally:
+        f.close()
+        client.close()
+    return 0
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -1,49 +1,557 @@
+import collections
+import errno
+import json
+import os
+import random
+import shutil
 import socket
+import struct
+import time
 import eloop
 import dpkt
 
 
+class Spool(object):
+    """Bounded on-disk append log.
+
+    Records are stored length-prefixed so that they can be read back in
+    bulk without holding the whole log in memory. Once max_bytes are
+    waiting to be replayed, new records are dropped (and counted). Replayed
+    records are cut off the file once they are more than half of it and
+    at least compact_bytes.
+    """
+
+    _LEN = struct.Struct('!I')
+    compact_bytes = 1024 * 1024
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self.offset = 0     # bytes already replayed
+        self._f = open(path, 'a+b')
+        self._f.seek(0, os.SEEK_END)
+        self.size = self._f.tell()
+
+    def __len__(self):
+        return self.size - self.offset
+
+    def append(self, record):
+        n = self._LEN.size + len(record)
+        if len(self) + n > self.max_bytes:
+            self.dropped += 1
+            return False
+        self._f.seek(0, os.SEEK_END)
+        self._f.write(self._LEN.pack(len(record)))
+        self._f.write(record)
+        self._f.flush()
+        self.size += n
+        return True
+
+    def read(self, max_bytes):
+        """Return (data, consumed) with as many whole records as fit into
+        max_bytes, starting at the current offset. The offset is only moved
+        by commit(), so an interrupted replay is retried from the start.
+        """
+        self._f.seek(self.offset)
+        raw = self._f.read(min(max_bytes, len(self)))
+        out = bytearray()
+        pos = 0
+        while pos + self._LEN.size <= len(raw):
+            n = self._LEN.unpack_from(raw, pos)[0]
+            end = pos + self._LEN.size + n
+            if end > len(raw):
+                if pos == 0:
+                    # single record larger than max_bytes
+                    self._f.seek(self.offset + self._LEN.size)
+                    return self._f.read(n), self._LEN.size + n
+                break
+            out += raw[pos + self._LEN.size:end]
+            pos = end
+        return bytes(out), pos
+
+    def commit(self, consumed):
+        self.offset += consumed
+        if self.offset >= self.size:
+            self.clear()
+        elif self.offset >= self.compact_bytes and self.offset * 2 >= self.size:
+            self._compact()
+
+    def _compact(self):
+        # the file is opened for appending, the rest goes to a fresh one
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            self._f.seek(self.offset)
+            shutil.copyfileobj(self._f, f)
+        os.replace(tmp, self.path)
+        self._f.close()
+        self._f = open(self.path, 'a+b')
+        self.size -= self.offset
+        self.offset = 0
+
+    def clear(self):
+        self._f.seek(0)
+        self._f.truncate()
+        self.offset = 0
+        self.size = 0
+
+    def close(self):
+        self._f.close()
+
+
+class ConnectionManager(object):
+    """Non-blocking TCP client that keeps a connection to one of several
+    endpoints, reconnecting with jittered exponential backoff.
+
+    Endpoints are numeric (address, port) pairs, host names are resolved
+    beforehand (see sink_from_spec) so that connecting never blocks the
+    loop. on_connect() is called once the asynchronous connect has completed,
+    on_disconnect() whenever an established or pending connection is lost,
+    on_read(buf) for received data and on_writable() when the socket can
+    accept more data (only while want_write is set).
+    """
+
+    DISCONNECTED = 0
+    CONNECTING = 1
+    CONNECTED = 2
+
+    min_backoff = 1
+    max_backoff = 60
+    connect_timeout = 10
+
+    def __init__(self, loop, endpoints, on_connect=None, on_disconnect=None,
+                 on_read=None, on_writable=None):
+        if not endpoints:
+            raise ValueError('no endpoints')
+        self.eloop = loop
+        self.endpoints = list(endpoints)
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.on_read = on_read
+        self.on_writable = on_writable
+        self.sock = None
+        self.state = self.DISCONNECTED
+        self.endpoint = None
+        self.attempts = 0
+        self.reconnects = 0
+        self._next = 0
+        # timeouts cannot be cancelled, stale ones are recognized by this
+        self._generation = 0
+        self._want_write = False
+
+    @property
+    def connected(self):
+        return self.state == self.CONNECTED
+
+    def backoff(self):
+        delay = min(self.max_backoff, self.min_backoff * (1 << min(self.attempts, 16)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def start(self):
+        self.connect()
+
+    def connect(self, arg=None):
+        if arg is not None and arg != self._generation:
+            return
+        if self.state != self.DISCONNECTED:
+            return
+        self._generation += 1
+        self.endpoint = self.endpoints[self._next % len(self.endpoints)]
+        self._next += 1
+        try:
+            # numeric only: a DNS lookup would stall the loop
+            family, type_, proto, _, address = socket.getaddrinfo(
+                self.endpoint[0], self.endpoint[1], type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST)[0]
+            self.sock = socket.socket(family, type_, proto)
+        except (OSError, UnicodeError):
+            # not an address, or out of descriptors
+            self._fail()
+            return
+        self.sock.setblocking(False)
+        self.state = self.CONNECTING
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._fail()
+            return
+        self.eloop.register(self.sock, eloop.EVENT_WRITE, self._on_socket_event)
+        self.eloop.register_timeout(self.connect_timeout, self._on_connect_timeout, self._generation)
+
+    def _on_connect_timeout(self, generation):
+        if generation == self._generation and self.state == self.CONNECTING:
+            self._fail()
+
+    def _fail(self):
+        was = self.state
+        self.close()
+        if was != self.DISCONNECTED and self.on_disconnect:
+            self.on_disconnect()
+        delay = self.backoff()
+        self.attempts += 1
+        self.eloop.register_timeout(delay, self.connect, self._generation)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.eloop.unregister(self.sock)
+            except (KeyError, ValueError):
+                pass
+            self.sock.close()
+            self.sock = None
+        self.state = self.DISCONNECTED
+        self._generation += 1
+
+    def want_write(self, enable):
+        if enable == self._want_write:
+            return
+        self._want_write = enable
+        if self.state == self.CONNECTED:
+            self._update_events()
+
+    def _update_events(self):
+        events = eloop.EVENT_READ
+        if self._want_write:
+            events |= eloop.EVENT_WRITE
+        self.eloop.modify(self.sock, events, self._on_socket_event)
+
+    def send(self, buf):
+        try:
+            return self.sock.send(buf)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError:
+            self._fail()
+            return -1
+
+    def _on_socket_event(self, fd, mask, arg):
+        if self.state == self.CONNECTING:
+            if mask & eloop.EVENT_WRITE:
+                err = fd.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    self._fail()
+                    return
+                self.state = self.CONNECTED
+                if self.attempts:
+                    self.reconnects += 1
+                self.attempts = 0
+                self._update_events()
+                if self.on_connect:
+                    self.on_connect()
+            return
+
+        if mask & eloop.EVENT_READ:
+            try:
+                buf = fd.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                buf = None
+            except OSError:
+                buf = b''
+            if buf == b'':
+                self._fail()
+                return
+            if buf and self.on_read:
+                self.on_read(buf)
+
+        if mask & eloop.EVENT_WRITE and self.state == self.CONNECTED:
+            if self.on_writable:
+                self.on_writable()
+
+
+DROP_OLDEST = 0
+DROP_NEWEST = 1
+
+
 class Transport(object):
-    mac_interval = 30
-    sta_mac_interval = 30
-    ap_mac_interval = 30
-    vid_interval = 60
-    heartbeat_interval = 60
-    period_interval = 1
+    """Report sink.
+
+    Records handed to put() are already encoded (see Dispatcher.encode) and
+    wait in a per-sink queue; every interval seconds they are passed to
+    send_batch() in groups of at most batch_size. When the queue is full the
+    drop policy decides whether the oldest queued or the incoming record is
+    discarded, so a sink that cannot keep up never stalls capture or the
+    other sinks.
+    """
+
+    interval = 30
+    batch_size = 256
+    queue_size = 4096
+    drop_policy = DROP_OLDEST
+
+    def __init__(self, loop, interval=None, batch_size=None, queue_size=None, drop_policy=None):
+        self.eloop = loop
+        if interval is not None:
+            self.interval = interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if drop_policy is not None:
+            self.drop_policy = drop_policy
+        self.queue = collections.deque()
+        self.sent = 0
+        self.dropped = 0
+
+    def put(self, record):
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            if self.drop_policy == DROP_NEWEST:
+                return
+            self.queue.popleft()
+        self.queue.append(record)
+
+    def writable(self):
+        """Return False while the sink cannot take another batch."""
+        return True
+
+    def flush(self):
+        while self.queue and self.writable():
+            n = min(self.batch_size, len(self.queue))
+            batch = [self.queue.popleft() for _ in range(n)]
+            self.send_batch(batch)
+            self.sent += n
+
+    def send_batch(self, records):
+        raise NotImplementedError
+
+    def _on_interval(self, arg):
+        self.flush()
+        self.eloop.register_timeout(self.interval, self._on_interval)
+
+    def run(self):
+        self.eloop.register_timeout(self.interval, self._on_interval)
+
+
+class Dispatcher(object):
+    """Fans report records out to any number of sinks.
+
+    Every record is serialized once, as a JSON line, and the same bytes
+    object is queued on each sink.
+
+    Table entries that change with every frame are not published right
+    away but marked dirty; their reports are built once per interval of the
+    most frequent sink, in steps of at most STEP_TIME seconds.
+    """
+
+    STEP_TIME = 0.002
 
     def __init__(self, loop):
         self.eloop = loop
+        self.sinks = []
+        # id(entry) -> (kind, entry)
+        self.dirty = {}
+        self._pending = None
 
-    def send_mac(self, arg):
-        self.eloop.register_timeout(self.mac_interval, self.send_mac)
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
 
-    def send_sta_mac(self, arg):
-        self.eloop.register_timeout(self.sta_mac_interval, self.send_sta_mac)
+    @staticmethod
+    def encode(record):
+        return json.dumps(record, separators=(',', ':')).encode('utf8') + b'\n'
 
-    def send_ap_mac(self, arg):
-        self.eloop.register_timeout(self.ap_mac_interval, self.send_ap_mac)
+    def publish(self, record):
+        if not self.sinks:
+            return
+        buf = self.encode(record)
+        for sink in self.sinks:
+            sink.put(buf)
 
-    def heartbeat(self, arg):
-        self.eloop.register_timeout(self.heartbeat_interval, self.heartbeat)
+    def mark(self, kind, entry):
+        """Publish entry.report(kind) at the next interval."""
+        if self.sinks:
+            self.dirty[id(entry)] = (kind, entry)
+
+    @property
+    def interval(self):
+        return min(s.interval for s in self.sinks) if self.sinks else 1
+
+    def _on_interval(self, arg):
+        if self._pending is None and self.dirty:
+            self._pending = iter(self.dirty.values())
+            # entries marked while the reports are built go to the next round
+            self.dirty = {}
+            self._publish_step()
+        self.eloop.register_timeout(self.interval, self._on_interval)
 
-    def send_vid(self, arg):
-        self.eloop.register_timeout(self.vid_interval, self.send_vid)
+    def _publish_step(self, arg=None):
+        deadline = time.perf_counter() + self.STEP_TIME
+        for kind, entry in self._pending:
+            self.publish(entry.report(kind))
+            if time.perf_counter() > deadline:
+                self.eloop.register_timeout(0, self._publish_step)
+                return
+        self._pending = None
 
-    def period_check(self, arg):
-        self.eloop.register_timeout(self.period_interval, self.period_check)
+    def flush_dirty(self):
+        """Publish everything marked, at once."""
+        pending, self._pending = self._pending, None
+        for kind, entry in pending or ():
+            self.publish(entry.report(kind))
+        dirty, self.dirty = self.dirty, {}
+        for kind, entry in dirty.values():
+            self.publish(entry.report(kind))
 
     def run(self):
-        self.eloop.register_timeout(self.mac_interval, self.send_mac)
-        self.eloop.register_timeout(self.sta_mac_interval, self.send_sta_mac)
-        self.eloop.register_timeout(self.ap_mac_interval, self.send_ap_mac)
-        self.eloop.register_timeout(self.vid_interval, self.send_vid)
-        self.eloop.register_timeout(self.heartbeat_interval, self.heartbeat)
-        self.eloop.register_timeout(self.period_interval, self.period_check)
+        for sink in self.sinks:
+            sink.run()
+        self.eloop.register_timeout(self.interval, self._on_interval)
+
+
+class TcpSink(Transport):
+    """JSON lines over a TCP connection, e.g. a local dashboard."""
+
+    interval = 1
+    max_sendbuf = 256 * 1024
+
+    def __init__(self, loop, endpoints, **kwargs):
+        super().__init__(loop, **kwargs)
+        self.sendbuf = bytearray()
+        self.conn = ConnectionManager(loop, endpoints,
+                                      on_disconnect=self._on_disconnect,
+                                      on_writable=self._on_writable)
+
+    def writable(self):
+        return self.conn.connected and len(self.sendbuf) < self.max_sendbuf
+
+    def send_batch(self, records):
+        self.sendbuf += b''.join(records)
+        self.conn.want_write(True)
+
+    def _on_writable(self):
+        r = self.conn.send(self.sendbuf)
+        if r > 0:
+            del self.sendbuf[:r]
+        if self.conn.connected:
+            self.conn.want_write(bool(self.sendbuf))
+
+    def _on_disconnect(self):
+        # a line may have been cut in half; records in flight are lost
+        self.sendbuf = bytearray()
+
+    def run(self):
+        super().run()
+        self.conn.start()
+
+
+class DatagramSink(Transport):
+    """JSON lines packed into datagrams of at most max_datagram bytes.
+
+    Datagrams the kernel cannot take right away are dropped.
+    """
+
+    interval = 1
+    max_datagram = 1400
+
+    def __init__(self, loop, family, address, **kwargs):
+        super().__init__(loop, **kwargs)
+        self.address = address
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def _send(self, buf, n):
+        try:
+            self.sock.sendto(buf, self.address)
+        except OSError:
+            self.sent -= n
+            self.dropped += n
+
+    def send_batch(self, records):
+        buf = b''
+        n = 0
+        for record in records:
+            if buf and len(buf) + len(record) > self.max_datagram:
+                self._send(buf, n)
+                buf = b''
+                n = 0
+            buf += record
+            n += 1
+        if buf:
+            self._send(buf, n)
+
+
+class UdpSink(DatagramSink):
+
+    def __init__(self, loop, address, **kwargs):
+        super().__init__(loop, socket.AF_INET, address, **kwargs)
+
+
+class UnixSink(DatagramSink):
+
+    max_datagram = 16 * 1024
+
+    def __init__(self, loop, path, **kwargs):
+        super().__init__(loop, socket.AF_UNIX, path, **kwargs)
+
+
+class FileSink(Transport):
+    """Appends JSON lines to a local file."""
+
+    interval = 10
+
+    def __init__(self, loop, path, **kwargs):
+        super().__init__(loop, **kwargs)
+        self.path = path
+        self._f = open(path, 'ab')
+
+    def send_batch(self, records):
+        self._f.write(b''.join(records))
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+def sink_from_spec(loop, spec):
+    """Create a sink from "kind:address[,option=value...]", where kind is
+    one of tcp, udp, unix or file and the options are interval, batch,
+    queue and drop (oldest|newest), e.g. "udp:127.0.0.1:9999,interval=5".
+    Host names are resolved here, once.
+    """
+    spec, _, opts = spec.partition(',')
+    kind, _, address = spec.partition(':')
+    kwargs = {}
+    for opt in filter(None, opts.split(',')):
+        k, _, v = opt.partition('=')
+        if k == 'interval':
+            kwargs['interval'] = float(v)
+        elif k == 'batch':
+            kwargs['batch_size'] = int(v)
+        elif k == 'queue':
+            kwargs['queue_size'] = int(v)
+        elif k == 'drop':
+            kwargs['drop_policy'] = DROP_NEWEST if v == 'newest' else DROP_OLDEST
+        else:
+            raise ValueError('unknown sink option %r' % k)
+    if kind in ('tcp', 'udp'):
+        host, port = address.rsplit(':', 1)
+        if kind == 'tcp':
+            endpoints = []
+            for info in socket.getaddrinfo(host.strip('[]'), int(port), type=socket.SOCK_STREAM):
+                if info[4][:2] not in endpoints:
+                    endpoints.append(info[4][:2])
+            return TcpSink(loop, endpoints, **kwargs)
+        info = socket.getaddrinfo(host, int(port), socket.AF_INET, socket.SOCK_DGRAM)[0]
+        return UdpSink(loop, info[4], **kwargs)
+    elif kind == 'unix':
+        return UnixSink(loop, address, **kwargs)
+    elif kind == 'file':
+        return FileSink(loop, address, **kwargs)
+    raise ValueError('unknown sink %r' % kind)
 
 
 class DefaultTransport(Transport):
+    """Reports to the central collector."""
 
-    mac_interval = 5
+    interval = 5
+    heartbeat_interval = 60
+
+    ENDPOINTS = [('123.57.90.192', 10002)]
+    SPOOL_PATH = '/tmp/sniffer.spool'
+
+    # above this many unsent bytes, messages go to the spool instead of
+    # the in-memory send buffer
+    max_sendbuf = 256 * 1024
+    # size of each bulk read from the spool on replay
+    replay_chunk = 64 * 1024
 
     MSG_START_REQ = 0x0A01
     MSG_START_ACK = 0x0A02
@@ -56,56 +564,131 @@ class DefaultTransport(Transport):
     MSG_SET_DATETIME_REQ = 0x0A10
     MSG_SET_DATETIME_ACK = 0x0A11
 
-    def __init__(self, el):
+    # session messages, meaningless on a later connection
+    CONTROL_MSGS = (MSG_START_REQ, MSG_HEARTBEAT_REQ)
+
+    def __init__(self, el, endpoints=None, spool_path=None):
         super().__init__(el)
-        self.sendbuf = b''
+        self.sendbuf = bytearray()
         self.recvbuf = b''
+        self.received = 0
+        self.conn = ConnectionManager(el, endpoints or self.ENDPOINTS,
+                                      on_connect=self._on_connect,
+                                      on_disconnect=self._on_disconnect,
+                                      on_read=self._on_read,
+                                      on_writable=self._on_writable)
+        # opened once the transport is used
+        self.spool_path = spool_path or self.SPOOL_PATH
+        self.spool = None
+        # bytes left of the message at the head of sendbuf
+        self._head_left = 0
+        # spool bytes whose records are currently in sendbuf
+        self._replaying = 0
+
+    @property
+    def sock(self):
+        return self.conn.sock
+
+    def _open_spool(self):
+        if self.spool is None:
+            self.spool = Spool(self.spool_path)
 
     def write(self, buf):
-        self.sendbuf += buf
+        """Queue one complete message for the collector."""
+        self._open_spool()
+        if (not self.conn.connected or len(self.spool) or
+                len(self.sendbuf) + len(buf) > self.max_sendbuf):
+            # keep ordering: once something is spooled, everything after it is too
+            self.spool.append(buf)
+        else:
+            self.sendbuf += buf
+        if self.conn.connected:
+            self._fill_from_spool()
+            self.conn.want_write(bool(self.sendbuf))
+
+    def send_batch(self, records):
+        body = b''.join(records)
+        msg = bytearray(self.CmdHdr.__hdr_len__ + len(body))
+        self.CmdHdr.pack_into(msg, 0, msg_type=self.MSG_WIFI_MAC_REPORT, len=len(msg), data=body)
+        self.write(msg)
+
+    def heartbeat(self, arg):
+        self.eloop.register_timeout(self.heartbeat_interval, self.heartbeat)
+
+    def _fill_from_spool(self):
+        if self.sendbuf or self.spool is None or not len(self.spool):
+            return
+        data, consumed = self.spool.read(self.replay_chunk)
+        self.sendbuf += data
+        self._replaying = consumed
+
+    def _consume(self, n):
+        while n > 0:
+            if not self._head_left:
+                self._head_left = struct.unpack_from('!I', self.sendbuf, 8)[0]
+            k = min(n, self._head_left)
+            del self.sendbuf[:k]
+            self._head_left -= k
+            n -= k
+
+    def _on_writable(self):
+        if not self.sendbuf:
+            self._fill_from_spool()
         if self.sendbuf:
-            self.eloop.modify(self.sock, eloop.EVENT_READ | eloop.EVENT_WRITE, self._on_socket_event)
+            r = self.conn.send(self.sendbuf)
+            if r > 0:
+                self._consume(r)
+        if not self.sendbuf and self.conn.connected:
+            if self._replaying:
+                self.spool.commit(self._replaying)
+                self._replaying = 0
+            self._fill_from_spool()
+        if self.conn.connected:
+            self.conn.want_write(bool(self.sendbuf))
 
-    def send_mac(self, arg):
-        super().send_mac(arg)
-        print('send_mac')
+    def _on_read(self, buf):
+        # replies are not acted on yet
+        self.received += len(buf)
 
-    def _on_socket_event(self, fd, mask, arg):
-        if mask & eloop.EVENT_READ:
-            print("read buffer")
-            buf = fd.recv(4096)
-            # self.recvbuf += buf
-            print(buf)
-
-        if mask & eloop.EVENT_WRITE:
-            if self.sendbuf:
-                print("write buffer")
-                r = fd.send(self.sendbuf)
-                if r > 0:
-                    self.sendbuf = self.sendbuf[r:]
-            else:
-                self.eloop.modify(fd, eloop.EVENT_READ, self._on_socket_event)
+    def _on_connect(self):
+        self._head_left = 0
+        self._start_req()
+
+    def _on_disconnect(self):
+        # a partially sent message cannot be resumed on a new connection
+        if self._head_left:
+            del self.sendbuf[:self._head_left]
+            self._head_left = 0
+        if self._replaying:
+            # the records are still in the spool, replay them again
+            self.sendbuf = bytearray()
+            self._replaying = 0
+        else:
+            # the unsent messages are older than anything spooled since,
+            # they stay ahead of it for the next connection; handshakes and
+            # heartbeats of this session are dropped
+            kept = bytearray()
+            pos = 0
+            while pos + self.CmdHdr.__hdr_len__ <= len(self.sendbuf):
+                msg_type, n = struct.unpack_from('!II', self.sendbuf, pos + 4)
+                if msg_type not in self.CONTROL_MSGS:
+                    kept += self.sendbuf[pos:pos + n]
+                pos += n
+            self.sendbuf = kept
 
     def _start_req(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setblocking(False)
-        self.eloop.register(self.sock, eloop.EVENT_READ | eloop.EVENT_WRITE, self._on_socket_event)
-        try:
-            self.sock.connect(('123.57.90.192', 10002))
-        except BlockingIOError as e:
-            pass
-        body = self.MsgStartReq()
-        body.datas = b'20160112 1757'
-        hdr = self.CmdHdr(data=body.pack())
-        hdr.len = hdr.__hdr_len__ + len(body)
-        hdr.magic_code = 0
-        hdr.msg_type = self.MSG_START_REQ
-        self.write(hdr.pack())
-        print(hdr.pack())
+        msg = bytearray(self.CmdHdr.__hdr_len__ + self.MsgStartReq.__hdr_len__)
+        self.MsgStartReq.pack_into(msg, self.CmdHdr.__hdr_len__, datas=b'20160112 1757')
+        self.CmdHdr.pack_into(msg, 0, magic_code=0, msg_type=self.MSG_START_REQ, len=len(msg))
+        # the session handshake always goes first, ahead of any replay
+        self.sendbuf[0:0] = msg
+        self.conn.want_write(True)
 
     def run(self):
+        self._open_spool()
         super().run()
-        self._start_req()
+        self.eloop.register_timeout(self.heartbeat_interval, self.heartbeat)
+        self.conn.start()
 
     class CmdHdr(dpkt.Packet):
         __byte_order__ = '!'
@@ -123,3 +706,200 @@ class DefaultTransport(Transport):
             ('version', 'H', 0),
             ('datas', '20s', 0)
         )
+
+
+def test_spool():
+    import tempfile
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        spool = Spool(path, max_bytes=64)
+        assert spool.append(b'a' * 10)
+        assert spool.append(b'b' * 20)
+        assert not spool.append(b'c' * 40)
+        assert spool.dropped == 1
+        data, consumed = spool.read(16)
+        assert data == b'a' * 10
+        spool.commit(consumed)
+        data, consumed = spool.read(1024)
+        assert data == b'b' * 20
+        spool.commit(consumed)
+        assert len(spool) == 0 and os.path.getsize(path) == 0
+
+        # a collector slightly slower than the producer: only the unsent
+        # records count against the bound, replayed ones are cut off
+        spool.compact_bytes = 32
+        received = []
+        for i in range(35):
+            assert spool.append(b'%04d' % i)
+            if i % 5:
+                data, consumed = spool.read(8)
+                received.append(data)
+                spool.commit(consumed)
+            assert os.path.getsize(path) <= 2 * spool.max_bytes
+        while len(spool):
+            data, consumed = spool.read(8)
+            received.append(data)
+            spool.commit(consumed)
+        assert spool.dropped == 1 and b''.join(received) == b''.join(b'%04d' % i for i in range(35))
+        spool.close()
+    finally:
+        os.unlink(path)
+
+
+def test_reconnect_and_replay():
+    import tempfile
+
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    endpoint = probe.getsockname()
+    probe.close()
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    loop = eloop.EventLoop()
+    t = DefaultTransport(loop, endpoints=[endpoint], spool_path=path)
+    assert t.spool is None
+    t.conn.min_backoff = 0.01
+    t.conn.max_backoff = 0.05
+
+    def report(i):
+        body = b'report %d' % i
+        hdr = t.CmdHdr(msg_type=t.MSG_WIFI_MAC_REPORT, len=t.CmdHdr.__hdr_len__ + len(body), data=body)
+        return hdr.pack()
+
+    # collector is down: everything goes to the spool
+    reports = [report(i) for i in range(100)]
+    for r in reports:
+        t.write(r)
+    assert len(t.spool) > 0 and not t.sendbuf
+
+    received = bytearray()
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    def on_client(fd, mask, arg):
+        buf = fd.recv(65536)
+        received.extend(buf)
+        if not buf or len(received) >= expected:
+            loop.stop()
+
+    def on_accept(fd, mask, arg):
+        c, _ = fd.accept()
+        c.setblocking(False)
+        loop.register(c, eloop.EVENT_READ, on_client)
+
+    def start_server(arg):
+        server.bind(endpoint)
+        server.listen(1)
+        server.setblocking(False)
+        loop.register(server, eloop.EVENT_READ, on_accept)
+
+    def give_up(arg):
+        loop.stop()
+
+    start = t.CmdHdr.__hdr_len__ + t.MsgStartReq.__hdr_len__
+    expected = start + sum(len(r) for r in reports)
+    t.conn.start()
+    loop.register_timeout(0.1, start_server)
+    loop.register_timeout(5, give_up)
+    loop.run()
+    try:
+        assert t.conn.attempts == 0 and t.conn.reconnects >= 1
+        assert len(received) == expected
+        assert bytes(received[start:]) == b''.join(reports)
+        assert len(t.spool) == 0
+    finally:
+        t.conn.close()
+        server.close()
+        t.spool.close()
+        os.unlink(path)
+
+
+def test_disconnect():
+    import tempfile
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    loop = eloop.EventLoop()
+    t = DefaultTransport(loop, endpoints=[('collector.invalid', 10002)], spool_path=path)
+    try:
+        # host names are not looked up on the loop, retried like a refused connection
+        t.conn.connect()
+        assert t.conn.state == t.conn.DISCONNECTED and t.conn.attempts == 1
+
+        def msg(msg_type, body=b''):
+            return t.CmdHdr(msg_type=msg_type, len=t.CmdHdr.__hdr_len__ + len(body), data=body).pack()
+
+        # the connection drops with a handshake, a heartbeat and two reports
+        # unsent, and a newer report already spooled on overflow
+        reports = [msg(t.MSG_WIFI_MAC_REPORT, b'report %d' % i) for i in range(3)]
+        t._open_spool()
+        t.sendbuf = bytearray(msg(t.MSG_START_REQ) + reports[0] + msg(t.MSG_HEARTBEAT_REQ) + reports[1])
+        t.spool.append(reports[2])
+        t._on_disconnect()
+        # sent first on the next connection, after the new handshake, then the spool
+        assert bytes(t.sendbuf) == reports[0] + reports[1]
+        assert t.spool.read(1024) == (reports[2], len(reports[2]) + 4)
+    finally:
+        t.spool.close()
+        os.unlink(path)
+
+
+def test_dispatcher():
+    import tempfile
+
+    class SlowSink(Transport):
+        def writable(self):
+            return False
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    loop = eloop.EventLoop()
+    d = Dispatcher(loop)
+    f = d.add_sink(sink_from_spec(loop, 'file:%s,batch=2' % path))
+    slow = d.add_sink(SlowSink(loop, queue_size=3, drop_policy=DROP_NEWEST))
+    try:
+        for i in range(5):
+            d.publish({'kind': 'sta', 'seq': i})
+        # encoded once, shared by all sinks
+        assert f.queue[0] is slow.queue[0]
+        assert len(slow.queue) == 3 and slow.dropped == 2
+        f.flush()
+        slow.flush()
+        assert f.sent == 5 and slow.sent == 0
+        with open(path, 'rb') as fp:
+            lines = fp.read().splitlines()
+        assert [json.loads(l)['seq'] for l in lines] == list(range(5))
+
+        # an entry marked on every frame is reported once per interval
+        class Entry(object):
+            def __init__(self, mac):
+                self.mac = mac
+                self.count = 0
+
+            def report(self, kind):
+                return {'kind': kind, 'mac': self.mac, 'count': self.count}
+
+        entries = [Entry(i) for i in range(3)]
+        for n in range(100):
+            e = entries[n % 3]
+            e.count += 1
+            d.mark('sta', e)
+        assert len(d.dirty) == 3 and len(f.queue) == 0
+        d._on_interval(None)
+        assert [json.loads(r) for r in f.queue] == [
+            {'kind': 'sta', 'mac': i, 'count': 34 if i == 0 else 33} for i in range(3)]
+        assert not d.dirty and d._pending is None
+        assert Dispatcher(loop).mark('sta', e) is None
+    finally:
+        f.close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    test_spool()
+    test_reconnect_and_replay()
+    test_disconnect()
+    test_dispatcher()
+    print('Tests Successful...')